@@ -1,14 +1,26 @@
-from PySide6.QtWidgets import (
+from startup import Startup
+
+# Timed from here, before Qt and the main window are imported
+startup = Startup()
+
+from PySide6.QtCore import QTimer  # noqa: E402
+from PySide6.QtWidgets import (  # noqa: E402
     QApplication,
 )
-import sys
-
-from modelview import MainWindowList
+import sys  # noqa: E402
 
 
 app = QApplication(sys.argv)
+startup.mark("QApplication")
+
+from modelview import MainWindowList  # noqa: E402
+
+startup.mark("imports")
 
 w = MainWindowList()
+startup.mark("main window")
 w.show()
+# Runs once the event loop has shown the window
+QTimer.singleShot(0, startup.finish)
 
 app.exec()
@@ -0,0 +1,13 @@
+"""
+Benchmarks of PyVQM, run them from the root of the repository:
+
+    python -m benchmarks.bench_parser   # metrics_parser throughput
+    python -m benchmarks.bench_stdout   # stdout of the jobs stored and plotted by the GUI
+    python -m benchmarks.bench_gui      # end to end latency, with benchmarks/fake_ffmpeg.py
+    python -m benchmarks.bench_ffmpeg   # real ffmpeg on lavfi sources
+    python -m benchmarks.bench_engine   # NumPy engine against the ffmpeg filters
+
+or all of them, recording the results as JSON:
+
+    python -m benchmarks [--real-ffmpeg]
+"""
@@ -0,0 +1,85 @@
+"""
+Runs every benchmark and records the results as JSON, to track regressions between versions:
+
+    python -m benchmarks [--real-ffmpeg] [--quick] [--output results.json]
+
+Results are written to benchmarks/results/<version>-<date>.json by default.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import bench_engine, bench_ffmpeg, bench_gui, bench_parser, bench_stdout
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def version():
+    """Commit of the tree, "unknown" outside of a git checkout."""
+    try:
+        result = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(RESULTS_DIRECTORY),
+        )
+    except OSError:
+        return "unknown"
+    return result.stdout.strip() or "unknown"
+
+
+def run(real_ffmpeg, quick):
+    scale = 10 if quick else 1
+    results = {
+        "parser": bench_parser.run(200_000 // scale, 5 if not quick else 1),
+        "stdout": bench_stdout.run(200_000 // scale, 3),
+        "gui": bench_gui.run(2000 // scale, 500, 3),
+    }
+    if real_ffmpeg:
+        size = "320x240" if quick else "1280x720"
+        results["ffmpeg"] = bench_ffmpeg.run(size, 250 // scale)
+        if "skipped" not in results["ffmpeg"]:
+            with tempfile.TemporaryDirectory() as directory:
+                width, height = (int(value) for value in size.split("x"))
+                paths = bench_engine.make_pair(directory, width, height, 250 // scale)
+                results["engine"] = bench_engine.run(*paths, 1 if quick else 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--real-ffmpeg", action="store_true", help="Also run ffmpeg on lavfi sources")
+    parser.add_argument("--quick", action="store_true", help="Smaller runs, to check the benchmarks work")
+    parser.add_argument("--output", "-o", help="JSON file of the results")
+    args = parser.parse_args()
+
+    started = time.strftime("%Y%m%d-%H%M%S")
+    record = {
+        "version": version(),
+        "date": started,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "quick": args.quick,
+        "results": run(args.real_ffmpeg, args.quick),
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = os.path.join(RESULTS_DIRECTORY, f"{record['version']}-{started}.json")
+    with open(output, "w") as file:
+        json.dump(record, file, indent=2)
+    print(json.dumps(record["results"], indent=2))
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Throughput of the NumPy engine (engine.FrameEngine, ffmpeg only decodes) against the
+ssim and psnr filters of ffmpeg, and the largest difference between their values.
+Without --ref and --dist, a test pair is encoded from the testsrc2 source of ffmpeg.
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from engine import stats_job
+from probe import probe
+from pyvqm import run_job
+from video import Distorded
+
+METRICS = ["ssim", "psnr"]
+
+
+def make_pair(directory, width, height, frames):
+    """Encodes a reference and a distorded video of the testsrc2 source, returns their paths."""
+    source = f"testsrc2=size={width}x{height}:rate=25:duration={frames / 25}"
+    paths = []
+    for name, crf in (("reference.mp4", 10), ("distorded.mp4", 35)):
+        path = os.path.join(directory, name)
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", source, "-c:v", "libx264", "-crf", str(crf), path],
+            check=True,
+        )
+        paths.append(path)
+    return paths
+
+
+def score(engine, reference_path, distorded_path, width, height):
+    """Values of the pair computed with `engine`, and the time it took."""
+    build, parser = stats_job(engine, width, height, METRICS)
+    distorded = Distorded(distorded_path)
+    start = time.perf_counter()
+    run_job(build(distorded_path, reference_path, METRICS), parser(), [distorded])
+    return distorded, time.perf_counter() - start
+
+
+def run(reference_path, distorded_path, repeat):
+    info = probe(reference_path)
+    results = {}
+    for engine in ("ffmpeg", "numpy"):
+        runs = [score(engine, reference_path, distorded_path, info["width"], info["height"]) for _ in range(repeat)]
+        distorded, _ = runs[0]
+        results[engine] = {
+            "frames": len(distorded.ssim),
+            "fps": len(distorded.ssim) / min(elapsed for _, elapsed in runs),
+            "values": {metric: getattr(distorded, metric).values for metric in METRICS},
+        }
+    for metric in METRICS:
+        results["numpy"][f"{metric}_max_difference"] = float(
+            np.max(np.abs(results["numpy"]["values"][metric] - results["ffmpeg"]["values"][metric]))
+        )
+    for engine in ("ffmpeg", "numpy"):
+        del results[engine]["values"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ref", help="Reference video")
+    parser.add_argument("--dist", help="Distorted video")
+    parser.add_argument("--size", default="1280x720", help="Size of the generated test pair")
+    parser.add_argument("--frames", type=int, default=250, help="Frames of the generated test pair")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.ref and args.dist:
+            paths = args.ref, args.dist
+        else:
+            width, height = (int(value) for value in args.size.split("x"))
+            paths = make_pair(directory, width, height, args.frames)
+        results = run(*paths, args.repeat)
+
+    filters, numpy = results["ffmpeg"], results["numpy"]
+    print(f"{numpy['frames']} frames")
+    print(f"ffmpeg filters: {filters['fps']:,.1f} fps")
+    print(
+        f"NumPy engine: {numpy['fps']:,.1f} fps ({numpy['fps'] / filters['fps']:.2f}x), "
+        f"largest difference ssim {numpy['ssim_max_difference']:.2g}, psnr {numpy['psnr_max_difference']:.2g}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Throughput of real ffmpeg jobs, on the testsrc source of ffmpeg (lavfi) so no file is needed:
+the reference is testsrc, the distorded video the same source with noise.
+Jobs are built by filtergraph and parsed by metrics_parser like in the GUI, but run without Qt.
+"""
+import argparse
+import shutil
+import time
+
+from filtergraph import build_metrics_args
+from metrics_parser import StatsParser
+from pyvqm import run_job
+from video import Distorded
+
+METRIC_SETS = (("ssim",), ("psnr",), ("ssim", "psnr"))
+
+
+def lavfi_args(args):
+    """Arguments reading every input from lavfi."""
+    lavfi = []
+    for arg in args:
+        if arg == "-i":
+            lavfi += ["-f", "lavfi"]
+        lavfi.append(arg)
+    return lavfi
+
+
+def run(size, frames, command="ffmpeg"):
+    if shutil.which(command) is None:
+        return {"skipped": f"{command} not found"}
+    # testsrc is RGB, the metrics are computed on YUV like for encoded videos
+    reference = f"testsrc=size={size}:rate=25:duration={frames / 25},format=yuv420p"
+    distorded = f"{reference},noise=alls=12:allf=t"
+    results = {}
+    for metrics in METRIC_SETS:
+        args = lavfi_args(build_metrics_args(distorded, reference, list(metrics)))
+        video = Distorded(distorded)
+        start = time.perf_counter()
+        run_job(args, StatsParser(), [video], command=command)
+        elapsed = time.perf_counter() - start
+        results["+".join(metrics)] = {"frames": len(getattr(video, metrics[0])), "fps": frames / elapsed}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--frames", type=int, default=250)
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    args = parser.parse_args()
+
+    for name, result in run(args.size, args.frames, args.ffmpeg).items():
+        if name == "skipped":
+            print(f"Skipped: {result}")
+        else:
+            print(f"{name}: {result['frames']} frames, {result['fps']:,.1f} fps")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+End to end latency of the GUI: the list window runs its jobs with benchmarks/fake_ffmpeg.py,
+which writes the stats of each frame at a steady rate, and every render tick of the plot
+window records how long ago the last frame it draws was written.
+Runs on the offscreen Qt platform.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtCore import QTimer  # noqa: E402
+from PySide6.QtWidgets import QApplication  # noqa: E402
+
+import processQueue  # noqa: E402
+from benchmarks.bench_stdout import make_window  # noqa: E402
+
+FAKE_FFMPEG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ffmpeg.py")
+# Time the jobs have to start before the fake ffmpeg writes its first frame
+STARTUP = 1.0
+
+
+def run(frames, rate, renditions, timeout=600):
+    app = QApplication.instance() or QApplication([])
+    window = make_window(renditions)
+    window.metrics = ["ssim", "psnr"]  # The fake ffmpeg only writes stats files
+    window.batch_mode = False
+    plot = window.plotWindow
+    plot.show()
+
+    start = time.monotonic() + STARTUP
+    os.environ.update(
+        PYVQM_FAKE_FRAMES=str(frames), PYVQM_FAKE_RATE=str(rate), PYVQM_FAKE_START=repr(start)
+    )
+    command = processQueue.FFMPEG_COMMAND
+    processQueue.FFMPEG_COMMAND = FAKE_FFMPEG
+
+    latencies = []
+    render = plot.render
+
+    def timed_render():
+        pending = [series for series in plot.pending.values() if hasattr(series, "frames")]
+        began = time.monotonic()
+        render()
+        now = time.monotonic()
+        render_times.append(now - began)
+        for series in pending:
+            if len(series):
+                # The fake ffmpeg writes frame n at start + (n - 1) / rate
+                latencies.append(now - start - (series.frames[-1] - 1) / rate)
+
+    render_times = []
+    plot.render = timed_render
+    plot.render_timer.timeout.disconnect()
+    plot.render_timer.timeout.connect(timed_render)
+
+    window.queue.drained.connect(app.quit)
+    QTimer.singleShot(timeout * 1000, app.quit)
+    try:
+        window.start_compute()
+        app.exec()
+    finally:
+        processQueue.FFMPEG_COMMAND = command
+    elapsed = time.monotonic() - start
+    timed_render()  # The frames parsed after the last tick
+    plot.close()
+
+    drawn = min(len(distorded.ssim) for distorded in window.model.distordedList)
+    latencies = np.array(latencies) * 1000
+    render_times = np.array(render_times) * 1000
+    return {
+        "frames": drawn,
+        "complete": drawn == frames,
+        "frames_per_s": drawn / elapsed,
+        "latency_ms_median": float(np.median(latencies)) if len(latencies) else None,
+        "latency_ms_p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+        "latency_ms_max": float(latencies.max()) if len(latencies) else None,
+        "render_ms_median": float(np.median(render_times)) if len(render_times) else None,
+        "render_ms_max": float(render_times.max()) if len(render_times) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="Frames written per second by each job")
+    parser.add_argument("--renditions", type=int, default=3)
+    args = parser.parse_args()
+
+    result = run(args.frames, args.rate, args.renditions)
+    print(
+        f"{result['frames']} frames at {result['frames_per_s']:,.0f} frames/s: latency "
+        f"median {result['latency_ms_median']:.1f} ms, p95 {result['latency_ms_p95']:.1f} ms, "
+        f"max {result['latency_ms_max']:.1f} ms, render median {result['render_ms_median']:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
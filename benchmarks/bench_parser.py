@@ -0,0 +1,92 @@
+"""
+Throughput of the stats parsers: the line by line parsing handle_stdout used to do,
+against the chunk parser (metrics_parser.StatsParser), for the stats of each metric alone
+and for the ssim and psnr lines interleaved on the stdout of a single pass graph.
+"""
+import argparse
+import random
+import timeit
+
+from benchmarks.fake_ffmpeg import LINES
+from metrics_parser import StatsParser, parse_metrics_line, parse_psnr_values, parse_ssim_values
+
+# Size of the chunks read from ffmpeg stdout, the size of a pipe buffer
+CHUNK_SIZE = 65536
+# Streams parsed: the metrics of their lines, and the parser of a line handle_stdout used
+CASES = {
+    "ssim": (("ssim",), parse_ssim_values),
+    "psnr": (("psnr",), parse_psnr_values),
+    "ssim+psnr": (("ssim", "psnr"), lambda line: parse_metrics_line(line)[1]),
+}
+
+
+def make_stats(metrics, frames, seed=0):
+    """Stats lines of `frames` frames, the lines of each frame in the order of `metrics` like fake_ffmpeg."""
+    rng = random.Random(seed)
+    return "".join(LINES[metric](frame, rng) for frame in range(1, frames + 1) for metric in metrics).encode()
+
+
+def chunks(data, size=CHUNK_SIZE):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def parse_line_by_line(data_chunks, parser):
+    """What handle_stdout used to do for each read."""
+    stdout_buffer = ""
+    records = 0
+    for chunk in data_chunks:
+        stdout_buffer += chunk.decode("utf8")
+        lines = stdout_buffer.split("\n")
+        stdout_buffer = lines.pop() if lines else ""
+        for line in lines:
+            if line.strip() and parser(line):
+                records += 1
+    return records
+
+
+def parse_chunks(data_chunks):
+    parser = StatsParser()
+    records = 0
+    for chunk in data_chunks:
+        for _, columns in parser.feed(chunk):
+            records += len(columns["frame"])
+    return records
+
+
+def best_rate(function, records, repeat):
+    """Best records per second over `repeat` runs."""
+    return records / min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def run(frames, repeat):
+    results = {}
+    for name, (metrics, line_parser) in CASES.items():
+        data_chunks = chunks(make_stats(metrics, frames))
+        records = frames * len(metrics)
+        assert parse_line_by_line(data_chunks, line_parser) == parse_chunks(data_chunks) == records
+        line_rate = best_rate(lambda: parse_line_by_line(data_chunks, line_parser), records, repeat)
+        chunk_rate = best_rate(lambda: parse_chunks(data_chunks), records, repeat)
+        results[name] = {
+            "line_records_per_s": line_rate,
+            "chunk_records_per_s": chunk_rate,
+            "speedup": chunk_rate / line_rate,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, result in run(args.frames, args.repeat).items():
+        print(
+            f"{name}: line by line {result['line_records_per_s']:,.0f} records/s, "
+            f"chunks {result['chunk_records_per_s']:,.0f} records/s "
+            f"({result['speedup']:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Throughput of the stdout handling of the GUI: the chunks ffmpeg writes go through Job.parse_chunk
+(what the reader thread of a Job does with each read), Job.deliver hands the batches to
+MainWindowList.handle_records, which stores them and marks the curves dirty. The plots are drawn at the end, from their pyramids.
+Runs on the offscreen Qt platform.
+"""
+import argparse
+import logging
+import os
+import random
+import time
+
+from benchmarks.bench_parser import chunks
+from benchmarks.fake_ffmpeg import psnr_line, ssim_line
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtWidgets import QApplication  # noqa: E402
+
+from cache import ResultCache  # noqa: E402
+from metrics_parser import StatsParser  # noqa: E402
+from modelview import MainWindowList  # noqa: E402
+from processQueue import Job  # noqa: E402
+from video import Distorded, Reference  # noqa: E402
+
+
+def make_window(renditions):
+    """List window with a reference and `renditions` distorded videos that are never opened."""
+    QApplication.instance() or QApplication([])
+    # The log of each job would be measured too
+    logging.getLogger("rich").setLevel(logging.WARNING)
+    window = MainWindowList(cache=ResultCache(":memory:"))
+    window.reference = Reference("reference.mp4")
+    for i in range(renditions):
+        distorded = Distorded(f"distorded{i}.mp4")
+        window.model.distordedList.append(distorded)
+        window.plotWindow.add_plot(distorded.video_path)
+    return window
+
+
+def make_stats(frames, seed=0):
+    """What a job computing ssim and psnr writes on stdout, the lines of both metrics alternating."""
+    rng = random.Random(seed)
+    return "".join(ssim_line(n, rng) + psnr_line(n, rng) for n in range(1, frames + 1)).encode()
+
+
+def run(frames, renditions):
+    window = make_window(renditions)
+    data_chunks = chunks(make_stats(frames))
+    jobs = []
+    for distorded in window.model.distordedList:
+        job = Job([], StatsParser(), [distorded], ["ssim", "psnr"])
+        job.parsed.connect(window.handle_records)
+        jobs.append(job)
+
+    # Shown first, so its render tick would draw the curves (no tick runs during the benchmark)
+    window.plotWindow.show()
+    start = time.perf_counter()
+    for chunk in data_chunks:
+        for job in jobs:
+            job.parse_chunk(chunk)
+    for job in jobs:
+        job.parse_chunk(b"", flush=True)
+        # No event loop runs the scheduled deliveries, what they would deliver is delivered now
+        job.deliver(force=True)
+    stored = time.perf_counter() - start
+
+    start = time.perf_counter()
+    window.plotWindow.render()
+    rendered = time.perf_counter() - start
+    window.plotWindow.close()
+
+    records = sum(job.records for job in jobs)
+    assert records == 2 * frames * renditions
+    return {
+        "records": records,
+        "records_per_s": records / stored,
+        "chunks_per_s": len(data_chunks) * renditions / stored,
+        "render_ms": rendered * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=200_000)
+    parser.add_argument("--renditions", type=int, default=3)
+    args = parser.parse_args()
+
+    result = run(args.frames, args.renditions)
+    print(
+        f"{result['records']:,} records: {result['records_per_s']:,.0f} records/s, "
+        f"{result['chunks_per_s']:,.0f} chunks/s, full render {result['render_ms']:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
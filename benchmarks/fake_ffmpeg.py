@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Stand-in for ffmpeg, to benchmark the parse, store and plot pipeline without decoding anything.
+
+It takes the arguments of filtergraph.build_metrics_args, and writes on stdout the lines
+the ssim=stats_file=- and psnr=stats_file=- filters of its graph would write, and on stderr
+the stream description and the progress lines (fps=) of ffmpeg. Other graphs are refused.
+It only uses the standard library, so it runs as a command of its own:
+
+    PYVQM_FFMPEG=benchmarks/fake_ffmpeg.py python3 app.py
+
+Environment variables:
+    PYVQM_FAKE_FRAMES   frames written (1000)
+    PYVQM_FAKE_RATE     frames written per second, 0 for as fast as possible (0)
+    PYVQM_FAKE_FPS      frame rate of the inputs it describes (25)
+    PYVQM_FAKE_SEED     seed of the values (0)
+    PYVQM_FAKE_START    time.monotonic() at which the first frame is written, to measure
+                        latencies from another process (now)
+"""
+import os
+import random
+import sys
+import time
+
+# Interval between two progress lines on stderr, like ffmpeg
+PROGRESS_INTERVAL = 0.5
+# Frames written at once when there is no rate to follow
+BLOCK_FRAMES = 256
+
+
+def ssim_line(frame, rng):
+    values = [rng.uniform(0.8, 1) for _ in range(4)]
+    return "n:%d Y:%f U:%f V:%f All:%f (%f)\n" % (frame, *values, rng.uniform(10, 30))
+
+
+def psnr_line(frame, rng):
+    mse = [rng.uniform(0, 200) for _ in range(4)]
+    psnr = [rng.uniform(20, 60) for _ in range(4)]
+    return (
+        "n:%d mse_avg:%.2f mse_y:%.2f mse_u:%.2f mse_v:%.2f "
+        "psnr_avg:%.2f psnr_y:%.2f psnr_u:%.2f psnr_v:%.2f \n" % (frame, *mse, *psnr)
+    )
+
+
+LINES = {"ssim": ssim_line, "psnr": psnr_line}
+
+
+def graph_metrics(args):
+    """Metrics whose stats the graph of the arguments writes on stdout, None for another graph."""
+    if "-filter_complex" not in args:
+        return None
+    graph = args[args.index("-filter_complex") + 1]
+    metrics = [metric for metric in LINES if f"{metric}=stats_file=-" in graph]
+    return metrics or None
+
+
+def header(fps):
+    return (
+        "Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'fake.mp4':\n"
+        f"  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p, 1920x1080, {fps:g} fps, "
+        f"{fps:g} tbr, 12800 tbn (default)\n"
+    )
+
+
+def progress(frame, start, fps):
+    elapsed = max(time.monotonic() - start, 1e-6)
+    return f"frame={frame:5d} fps={frame / elapsed:.1f} q=-0.0 size=N/A time={frame / fps:.2f} speed=N/A\r"
+
+
+def main(args):
+    metrics = graph_metrics(args)
+    if metrics is None:
+        sys.stderr.write("fake_ffmpeg: only the graphs of filtergraph.build_metrics_args are supported\n")
+        return 1
+    frames = int(os.environ.get("PYVQM_FAKE_FRAMES", 1000))
+    rate = float(os.environ.get("PYVQM_FAKE_RATE", 0))
+    fps = float(os.environ.get("PYVQM_FAKE_FPS", 25))
+    rng = random.Random(int(os.environ.get("PYVQM_FAKE_SEED", 0)))
+
+    stdout, stderr = sys.stdout, sys.stderr
+    stderr.write(header(fps))
+    stderr.flush()
+    start = float(os.environ.get("PYVQM_FAKE_START", 0)) or time.monotonic()
+    time.sleep(max(start - time.monotonic(), 0))
+    last_progress = start
+    frame = 0
+    while frame < frames:
+        if rate:
+            # Write the frames due by now, then sleep until the next one
+            due = min(int((time.monotonic() - start) * rate) + 1, frames)
+            if due <= frame:
+                time.sleep(max(start + frame / rate - time.monotonic(), 0))
+                continue
+        else:
+            due = min(frame + BLOCK_FRAMES, frames)
+        stdout.write("".join(LINES[metric](n, rng) for n in range(frame + 1, due + 1) for metric in metrics))
+        stdout.flush()
+        frame = due
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            stderr.write(progress(frame, start, fps))
+            stderr.flush()
+    stderr.write(progress(frame, start, fps) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
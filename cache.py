@@ -0,0 +1,212 @@
+"""
+Persistent cache of the computed metrics, so an unchanged pair of videos is never scored twice.
+
+Entries are stored in a SQLite database, addressed by the fingerprints of both files,
+the metric, the settings its values depend on and the time window.
+The database also keeps the probe results of the files (see probe.Prober), by fingerprint.
+The least recently used values and probes are evicted once the database holds more than `max_bytes` of them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from series import COMPONENTS
+
+log = logging.getLogger("rich")
+
+# Default location of the cache database
+CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "pyvqm",
+    "results.sqlite",
+)
+# Size of the values and probes kept in the cache before evicting the least recently used ones
+MAX_BYTES = 512 * 1024**2
+
+# Blocks read to fingerprint a file: the first, the last, and some in between
+SAMPLED_BLOCKS = 16
+BLOCK_SIZE = 64 * 1024
+
+
+def fingerprint(path: str):
+    """
+    Fast content fingerprint of a file: its size, mtime and a hash of sampled blocks.
+    Only SAMPLED_BLOCKS * BLOCK_SIZE bytes are read, whatever the size of the file.
+    """
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as file:
+        if stat.st_size <= SAMPLED_BLOCKS * BLOCK_SIZE:
+            digest.update(file.read())
+        else:
+            step = (stat.st_size - BLOCK_SIZE) // (SAMPLED_BLOCKS - 1)
+            for i in range(SAMPLED_BLOCKS):
+                file.seek(i * step)
+                digest.update(file.read(BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Per-frame values of a metric, addressed by `key()`.
+    Values are stored as the raw bytes of the frames (int64) and of the components (float32).
+    The cache can be used from several threads.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Fingerprints already computed, by (path, size, mtime)
+        self.fingerprints = {}
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " frames BLOB NOT NULL,"
+            " vals BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(probes)")]
+        if columns and "last_used" not in columns:
+            # Probes stored by older versions can't be evicted, they are cheap to run again
+            self.connection.execute("DROP TABLE probes")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            " fingerprint TEXT PRIMARY KEY,"
+            " info TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)"
+        )
+        self.connection.commit()
+
+    def fingerprint(self, path: str):
+        stat = os.stat(path)
+        cache_key = (path, stat.st_size, stat.st_mtime_ns)
+        if cache_key not in self.fingerprints:
+            self.fingerprints[cache_key] = fingerprint(path)
+        return self.fingerprints[cache_key]
+
+    def key(self, reference_path, distorded_path, metric, options="", window=""):
+        """
+        Key of the values of `metric` between two files.
+        `options` are the filter options of the metric, `window` the part of the videos scored.
+        Returns None if one of the files can't be read.
+        """
+        try:
+            fingerprints = [self.fingerprint(reference_path), self.fingerprint(distorded_path)]
+        except OSError as e:
+            log.warning(f"Can't fingerprint {e.filename}: {e.strerror}")
+            return None
+        description = json.dumps([*fingerprints, metric, options, window])
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the frames and values (one row per component) stored for `key`, or None."""
+        if key is None:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT frames, vals FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+        frames = np.frombuffer(row[0], dtype=np.int64)
+        values = np.frombuffer(row[1], dtype=np.float32).reshape(len(COMPONENTS), -1)
+        return frames, values
+
+    def put(self, key, frames, values):
+        """Stores the frames and values of a metric, then evicts old entries if needed."""
+        if key is None:
+            return
+        frames = np.ascontiguousarray(frames, dtype=np.int64).tobytes()
+        values = np.ascontiguousarray(values, dtype=np.float32).tobytes()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, frames, values, len(frames) + len(values), time.time()),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT (SELECT COALESCE(SUM(size), 0) FROM results)"
+                " + (SELECT COALESCE(SUM(size), 0) FROM probes)"
+            ).fetchone()[0]
+
+    def evict(self):
+        """Removes the least recently used values and probes until the cache fits in max_bytes."""
+        with self.lock:
+            excess = self.size() - self.max_bytes
+            if excess <= 0:
+                return
+            removed = {"results": [], "probes": []}
+            for table, key, size, _ in self.connection.execute(
+                "SELECT 'results', key, size, last_used FROM results"
+                " UNION ALL SELECT 'probes', fingerprint, size, last_used FROM probes"
+                " ORDER BY last_used"
+            ).fetchall():
+                if excess <= 0:
+                    break
+                removed[table].append((key,))
+                excess -= size
+            self.connection.executemany("DELETE FROM results WHERE key = ?", removed["results"])
+            self.connection.executemany("DELETE FROM probes WHERE fingerprint = ?", removed["probes"])
+        log.debug(f"Evicted {len(removed['results'])} cached results and {len(removed['probes'])} probes")
+
+    def get_probe(self, fingerprint):
+        """Probe result of the file with this fingerprint, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT info FROM probes WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE probes SET last_used = ? WHERE fingerprint = ?", (time.time(), fingerprint)
+            )
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def put_probe(self, fingerprint, info):
+        """Stores a probe result, then evicts old entries if needed."""
+        info = json.dumps(info)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                (fingerprint, info, len(info), time.time()),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM results")
+            self.connection.execute("DELETE FROM probes")
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,210 @@
+"""
+In-process metric engine: ffmpeg only decodes, and SSIM and PSNR are computed with NumPy.
+
+ffmpeg writes each distorded frame stacked over its reference frame as raw yuv420p on stdout
+(see filtergraph.build_rawvideo_args), so each plane holds the rows of the distorded frame
+then the rows of the reference frame. The frames are copied into a preallocated buffer of
+`batch` frames, and the metrics are computed on the whole batch at once.
+FrameEngine has the interface of the metrics_parser parsers, so a Job can use it the same way,
+and its values follow the formulas of the ssim and psnr filters of ffmpeg.
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from filtergraph import build_metrics_args, build_rawvideo_args
+from metrics_parser import COMPONENTS, StatsParser
+
+log = logging.getLogger("rich")
+
+# Ways to compute ssim and psnr: the filters of ffmpeg, or FrameEngine
+ENGINES = ("ffmpeg", "numpy")
+
+# Frames computed at once
+BATCH_FRAMES = 8
+# Pixel formats of 8 bits 4:2:0, converted to yuv420p without changing a sample. The ffmpeg filters
+# score other formats as they are (10 bits, 4:4:4, full range) while FrameEngine would score them converted
+EIGHT_BIT_420 = ("yuv420p", "nv12", "nv21")
+
+# Constants of the ssim filter of ffmpeg, for sums over 8x8 windows of 8 bits samples
+SSIM_C1 = int(0.01 * 0.01 * 255 * 255 * 64 + 0.5)
+SSIM_C2 = int(0.03 * 0.03 * 255 * 255 * 64 * 63 + 0.5)
+
+
+def supported(width: int, height: int):
+    """
+    True if FrameEngine can score frames of this size: stacking frames of an odd size
+    would mix the chroma rows of both, and SSIM needs two blocks of 4x4 samples in the chroma planes.
+    """
+    return width >= 16 and height >= 16 and not width % 2 and not height % 2
+
+
+def stats_job(engine: str, width: int, height: int, metrics, pix_fmts=()):
+    """
+    Function building the ffmpeg arguments of the jobs computing `metrics` (ssim and psnr),
+    like filtergraph.build_metrics_args, and the parser of their output.
+    The "numpy" engine needs the resolution of the reference, and `pix_fmts` the pixel formats
+    of the videos of the jobs (empty when unknown, they are not checked): it only scores 8 bits 4:2:0.
+    The ffmpeg filters are used otherwise.
+    """
+    if engine == "numpy":
+        names = ", ".join(metrics)
+        others = sorted({pix_fmt for pix_fmt in pix_fmts if pix_fmt and pix_fmt not in EIGHT_BIT_420})
+        if others:
+            log.warning(f"Can't compute {names} with NumPy in {', '.join(others)}, using the ffmpeg filters")
+        elif supported(width, height):
+            return build_rawvideo_args, lambda: FrameEngine(width, height, metrics)
+        else:
+            log.warning(f"Can't compute {names} with NumPy at {width}x{height}, using the ffmpeg filters")
+    return build_metrics_args, StatsParser
+
+
+def plane_shapes(width: int, height: int):
+    """Shapes of the Y, U and V planes of a yuv420p frame."""
+    chroma = ((height + 1) // 2, (width + 1) // 2)
+    return [(height, width), chroma, chroma]
+
+
+def plane_weights(shapes):
+    """Weight of each plane in the All value: its share of the samples, like ffmpeg."""
+    sizes = np.array([h * w for h, w in shapes], dtype=np.float64)
+    return sizes / sizes.sum()
+
+
+def psnr(distorded, reference):
+    """
+    Mean squared error of each frame of a batch of planes (frames, height, width).
+    """
+    diff = distorded.astype(np.int32) - reference
+    return np.einsum("fhw,fhw->f", diff, diff, dtype=np.int64) / (diff.shape[1] * diff.shape[2])
+
+
+def mse_to_psnr(mse):
+    """PSNR of 8 bits samples, capped to 100 when the frames are identical like cap_psnr."""
+    with np.errstate(divide="ignore"):
+        values = 10 * np.log10(255.0**2 / mse)
+    return np.where(mse > 0, values, 100.0)
+
+
+def block_sums(samples):
+    """
+    Sums over the 4x4 blocks of a batch of planes (frames, height, width).
+    The rows and columns are added one by one, which is much faster than sum() over strided axes.
+    """
+    frames, height, width = samples.shape
+    rows = samples[:, : height // 4 * 4, : width // 4 * 4].reshape(frames, height // 4, 4, width // 4 * 4)
+    rows = rows[:, :, 0] + rows[:, :, 1] + rows[:, :, 2] + rows[:, :, 3]
+    columns = rows.reshape(frames, height // 4, width // 4, 4)
+    return columns[..., 0] + columns[..., 1] + columns[..., 2] + columns[..., 3]
+
+
+def ssim(distorded, reference):
+    """
+    SSIM of each frame of a batch of planes, like the ssim filter of ffmpeg: the sums of
+    4x4 blocks are added 2x2 into 8x8 windows overlapping by 4 samples, and the SSIM
+    of the windows is averaged.
+    """
+    a = distorded.astype(np.int32)
+    b = reference.astype(np.int32)
+    sums = [block_sums(a), block_sums(b), block_sums(a * a + b * b), block_sums(a * b)]
+    s1, s2, ss, s12 = (s[:, :-1, :-1] + s[:, 1:, :-1] + s[:, :-1, 1:] + s[:, 1:, 1:] for s in sums)
+    # Like ffmpeg, the terms fit in int32 and their products are computed in float
+    variances = ss * 64 - s1 * s1 - s2 * s2
+    covariance = s12 * 64 - s1 * s2
+    numerator = (2 * s1 * s2 + SSIM_C1).astype(np.float32) * (2 * covariance + SSIM_C2).astype(np.float32)
+    denominator = (s1 * s1 + s2 * s2 + SSIM_C1).astype(np.float32) * (variances + SSIM_C2).astype(np.float32)
+    return (numerator / denominator).mean(axis=(1, 2), dtype=np.float64)
+
+
+class FrameEngine:
+    """
+    Computes `metrics` (ssim and psnr) from the raw frames written by filtergraph.build_rawvideo_args,
+    for a reference of `width` x `height`.
+    feed() copies the chunks of stdout into a preallocated buffer, readinto() reads a stream straight
+    into it: the jobs of runtime.run_process read their pipe with it, so no frame is allocated or copied.
+    Both return a list of (metric, columns) like the parsers of metrics_parser.
+    """
+
+    def __init__(self, width, height, metrics=("ssim", "psnr"), batch=BATCH_FRAMES):
+        self.metrics = list(metrics)
+        self.shapes = plane_shapes(width, height)
+        self.weights = plane_weights(self.shapes)
+        # A stacked frame holds both frames
+        self.frame_size = 2 * sum(h * w for h, w in self.shapes)
+        self.buffer = np.empty((batch, self.frame_size), dtype=np.uint8)
+        self.view = memoryview(self.buffer.reshape(-1))
+        self.filled = 0  # Bytes of the buffer holding frames not computed yet
+        self.bytes_read = 0  # Bytes given by feed() and readinto()
+        self.frames = 0  # Frames computed so far
+        self.compute_time = 0.0  # Time spent computing the metrics, in seconds
+
+    def feed(self, chunk):
+        chunk = memoryview(chunk)
+        batches = []
+        while len(chunk):
+            size = min(len(chunk), len(self.view) - self.filled)
+            self.view[self.filled : self.filled + size] = chunk[:size]
+            self.filled += size
+            self.bytes_read += size
+            chunk = chunk[size:]
+            if self.filled == len(self.view):
+                batches += self.compute()
+        return batches
+
+    def readinto(self, stream):
+        """
+        Reads a stream straight into the buffer until a batch is full, and computes it.
+        Returns None once the stream ends, the frames left are computed by flush().
+        """
+        while self.filled < len(self.view):
+            read = stream.readinto(self.view[self.filled :])
+            if not read:
+                return None
+            self.filled += read
+            self.bytes_read += read
+        return self.compute()
+
+    def flush(self):
+        """Computes the frames left in the buffer."""
+        return self.compute()
+
+    def planes(self, frames):
+        """Distorded and reference planes of the first `frames` frames of the buffer."""
+        planes = []
+        offset = 0
+        for height, width in self.shapes:
+            size = 2 * height * width
+            plane = self.buffer[:frames, offset : offset + size].reshape(frames, 2 * height, width)
+            planes.append((plane[:, :height], plane[:, height:]))
+            offset += size
+        return planes
+
+    def compute(self):
+        frames = self.filled // self.frame_size
+        self.filled = 0
+        if not frames:
+            return []
+        start = time.perf_counter()
+        planes = self.planes(frames)
+        numbers = np.arange(self.frames + 1, self.frames + frames + 1, dtype=np.int64)
+        self.frames += frames
+
+        batches = []
+        if "ssim" in self.metrics:
+            values = [ssim(distorded, reference) for distorded, reference in planes]
+            batches.append(("ssim", self.columns(numbers, values, sum(v * w for v, w in zip(values, self.weights)))))
+        if "psnr" in self.metrics:
+            mse = [psnr(distorded, reference) for distorded, reference in planes]
+            values = [mse_to_psnr(m) for m in mse]
+            average = mse_to_psnr(sum(m * w for m, w in zip(mse, self.weights)))
+            batches.append(("psnr", self.columns(numbers, values, average)))
+        self.compute_time += time.perf_counter() - start
+        return batches
+
+    def columns(self, numbers, values, average):
+        columns = {"frame": numbers}
+        for component, value in zip(COMPONENTS, [*values, average]):
+            columns[component] = value
+        return columns
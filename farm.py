@@ -0,0 +1,746 @@
+"""
+Farm of workers: the jobs of the GUI also run on worker processes, on this machine or others of
+the network, connected to a coordinator over TCP or a Unix socket.
+
+    PYVQM_FARM=0.0.0.0:7800 PYVQM_FARM_TOKEN=... python3 ./app.py       # the GUI listens for workers
+    PYVQM_FARM_TOKEN=... python3 -m pyvqm worker --connect studio.local:7800   # on each worker
+
+The coordinator (Coordinator) runs on the loop of the runtime. Each worker announces its slots
+when it connects, and the queue of the GUI (processQueue.ProcessQueue) gives the coordinator the
+jobs that don't fit its local slots while the workers have free ones. A remote job is still a
+processQueue.Job: its values, progress and telemetry come from a worker instead of a process,
+so the jobs panel, the plots and the run report show it like any other.
+
+Workers run ffmpeg with runtime.run_process and parse its output themselves, the coordinator
+only gets the values. Inputs are read from the same paths (a shared volume, --map rewrites its
+mount point), or staged: with --stage, the inputs a worker can't find are copied from the
+coordinator over the connection, and kept for the next jobs.
+
+Messages are framed by HEADER, the type and the length of their payload. Control messages are
+JSON, the per-frame values (BATCH) are binary: BATCH_HEADER, the int64 frame numbers, then a row
+of float32 values per component. Both ends send a HEARTBEAT every HEARTBEAT_INTERVAL seconds and
+drop a peer silent for HEARTBEAT_TIMEOUT. The jobs of a dropped worker run again on another one,
+without delivering the frames their first run did; with no worker left for ORPHAN_TIMEOUT
+seconds, they run here.
+
+Workers run the command lines of the coordinator, and the coordinator stores what workers send:
+keep the farm on a trusted network, with the same PYVQM_FARM_TOKEN on both ends. Without a token,
+the coordinator only listens on a Unix socket or a loopback address.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from engine import FrameEngine
+from metrics_parser import MetadataParser, StatsParser, VmafParser
+from runtime import FFMPEG_COMMAND, JobResult, background_loop, run_process
+from series import COMPONENTS
+
+log = logging.getLogger("rich")
+
+# Address the GUI listens for workers on (host:port or unix:path), no farm without it
+FARM_ADDRESS = os.environ.get("PYVQM_FARM")
+# Secret a worker gives the coordinator when it connects, required to listen beyond this machine
+FARM_TOKEN = os.environ.get("PYVQM_FARM_TOKEN", "")
+PROTOCOL = 1
+# Port of an address without one
+DEFAULT_PORT = 7800
+
+# Type and length of the payload of a message
+HEADER = struct.Struct("<BI")
+HELLO, JOB, BATCH, PROGRESS, DONE, CANCEL, HEARTBEAT, FETCH, DATA, FETCHED = range(1, 11)
+# Job, metric, rendition (NO_RENDITION without one) and number of frames of a BATCH
+BATCH_HEADER = struct.Struct("<IBHI")
+NO_RENDITION = 0xFFFF
+METRICS = ("ssim", "psnr", "vmaf")
+# Fetch a DATA payload belongs to, the bytes of the input follow
+DATA_HEADER = struct.Struct("<I")
+# A larger message comes from a broken peer
+MAX_MESSAGE = 64 * 1024 * 1024
+# Bytes of a staged input sent at once
+STAGE_CHUNK = 1024 * 1024
+
+# Seconds between two heartbeats, and without any message from a peer before it is dropped
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 10.0
+# Seconds a job waits for a worker while none is connected, before it runs here
+ORPHAN_TIMEOUT = 30.0
+# Seconds a worker waits before connecting again
+RECONNECT_DELAY = 2.0
+
+# Result of RemoteJob.done for a job to run here
+LOCAL = object()
+
+
+class FarmError(OSError):
+    """A job could not run on its worker."""
+
+
+class ProtocolError(Exception):
+    """A peer sent a message that doesn't follow the protocol."""
+
+
+def parse_address(address):
+    """("unix", path) for unix:path, ("tcp", host, port) for host:port, host or port."""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    if not host:
+        host, port = (port, "") if not port.isdigit() else ("localhost", port)
+    return "tcp", host.strip("[]") or "localhost", int(port or DEFAULT_PORT)
+
+
+def is_local(address):
+    """True if only this machine can connect to `address`: a Unix socket, or a loopback address."""
+    kind, *where = parse_address(address)
+    if kind == "unix" or where[0] == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(where[0]).is_loopback
+    except ValueError:
+        # A host name, it may resolve to any interface
+        return False
+
+
+async def read_message(reader):
+    """Type and payload of the next message."""
+    kind, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ProtocolError(f"Message of {length} bytes")
+    return kind, await reader.readexactly(length)
+
+
+def write_message(writer, kind, payload=b""):
+    """Writes a message, unless the connection is closing."""
+    if not writer.is_closing():
+        writer.write(HEADER.pack(kind, len(payload)))
+        writer.write(payload)
+
+
+def write_json(writer, kind, message):
+    write_message(writer, kind, json.dumps(message).encode())
+
+
+def encode_batch(job, metric, columns):
+    """BATCH payload of parsed columns (see metrics_parser.records_to_columns)."""
+    frames = np.asarray(columns["frame"], dtype="<i8")
+    values = np.array([columns[component] for component in COMPONENTS], dtype="<f4")
+    rendition = columns.get("rendition")
+    header = BATCH_HEADER.pack(
+        job, METRICS.index(metric), NO_RENDITION if rendition is None else rendition, len(frames)
+    )
+    return b"".join((header, frames.tobytes(), values.tobytes()))
+
+
+def decode_batch(payload):
+    """Job, metric and columns of a BATCH payload."""
+    job, metric, rendition, count = BATCH_HEADER.unpack_from(payload)
+    if metric >= len(METRICS) or len(payload) != BATCH_HEADER.size + count * (8 + 4 * len(COMPONENTS)):
+        raise ProtocolError("Malformed batch")
+    frames = np.frombuffer(payload, dtype="<i8", count=count, offset=BATCH_HEADER.size)
+    values = np.frombuffer(
+        payload, dtype="<f4", count=count * len(COMPONENTS), offset=BATCH_HEADER.size + 8 * count
+    ).reshape(len(COMPONENTS), count)
+    columns = {"frame": frames.astype(np.int64)}
+    for component, row in zip(COMPONENTS, values):
+        columns[component] = row
+    if rendition != NO_RENDITION:
+        columns["rendition"] = rendition
+    return job, METRICS[metric], columns
+
+
+def parser_spec(parser):
+    """What a worker builds a parser like `parser` from, None if the job can't run on a worker."""
+    if isinstance(parser, StatsParser):
+        return {"parser": "stats"}
+    if isinstance(parser, MetadataParser):
+        return {"parser": "metadata"}
+    # A log file would be written on the worker, and read here
+    if isinstance(parser, VmafParser) and parser.log_path is None:
+        return {"parser": "vmaf"}
+    if isinstance(parser, FrameEngine):
+        height, width = parser.shapes[0]
+        return {"parser": "engine", "width": width, "height": height, "metrics": parser.metrics}
+    return None
+
+
+def build_parser(spec):
+    kind = spec.get("parser")
+    if kind == "stats":
+        return StatsParser()
+    if kind == "metadata":
+        return MetadataParser()
+    if kind == "vmaf":
+        return VmafParser()
+    if kind == "engine":
+        return FrameEngine(spec["width"], spec["height"], spec["metrics"])
+    raise ProtocolError(f"Unknown parser {kind}")
+
+
+def input_paths(args):
+    """Paths of the inputs of an ffmpeg command line."""
+    return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == "-i"]
+
+
+class RemoteJob:
+    """A job given to the coordinator, and the frames it delivered so far."""
+
+    def __init__(self, id, message, post, result, progress=None):
+        self.id = id
+        self.message = message  # JOB message sent to its worker
+        self.post = post
+        self.result = result
+        self.progress = progress
+        self.worker = None  # WorkerConnection running it
+        self.waiting_since = time.monotonic()
+        self.done = asyncio.get_running_loop().create_future()  # Exit code, or LOCAL
+        self.delivered = {}  # Last frame delivered for each (metric, rendition)
+
+    def deliver(self, batches):
+        """Posts parsed batches, without the frames a previous run of the job delivered."""
+        kept = []
+        for metric, columns in batches:
+            key = (metric, columns.get("rendition"))
+            frames = columns["frame"]
+            last = self.delivered.get(key, 0)
+            if not len(frames) or frames[-1] <= last:
+                continue
+            if frames[0] <= last:
+                keep = frames > last
+                columns = {
+                    name: column[keep] if isinstance(column, np.ndarray) else column
+                    for name, column in columns.items()
+                }
+            self.delivered[key] = int(columns["frame"][-1])
+            kept.append((metric, columns))
+        if kept:
+            self.post(kept)
+
+    def progressed(self, fps, speed):
+        self.result.telemetry.report_progress(fps, speed)
+        if fps is not None:
+            self.result.fps = fps
+            if self.progress is not None:
+                self.progress(fps)
+
+    def finished(self, message):
+        """Reads the DONE message of its worker."""
+        result = self.result
+        result.stderr_tail.extend(message.get("stderr", []))
+        if result.input_fps is None:
+            result.input_fps = message.get("input_fps")
+        result.telemetry.parse_time += message.get("parse_time", 0.0)
+        result.telemetry.bytes_read += message.get("bytes_read", 0)
+        if self.done.done():
+            return
+        if message.get("error"):
+            self.done.set_exception(FarmError(f"{result.worker}: {message['error']}"))
+        else:
+            result.returncode = message["returncode"]
+            self.done.set_result(result.returncode)
+
+
+class WorkerConnection:
+    """A worker connected to the coordinator, and the jobs it runs."""
+
+    def __init__(self, name, slots, writer):
+        self.name = name
+        self.slots = slots
+        self.writer = writer
+        self.jobs = {}  # RemoteJob by id
+        self.inputs = set()  # Paths it may fetch: the inputs of its jobs
+        self.heard_at = time.monotonic()
+        self.sending = set()  # Tasks sending it inputs
+
+    @property
+    def free(self):
+        return self.slots - len(self.jobs)
+
+
+class Coordinator:
+    """
+    Runs jobs on the workers connected to it, see the module docstring. `command` is the ffmpeg
+    executable of the jobs that end up running here. Its methods run on its loop, except
+    reserve(), release(), free_slots() and accepts(), which the GUI calls from its thread.
+    """
+
+    def __init__(self, token=FARM_TOKEN, command=None):
+        self.token = token
+        self.command = command or FFMPEG_COMMAND
+        self.workers = []
+        self.pending = deque()  # RemoteJobs waiting for a worker
+        self.ids = itertools.count(1)
+        self.server = None
+        self.address = None  # Address it listens on, with the port the system chose
+        self.watcher = None
+        self.sessions = set()  # Tasks of the sessions of the workers
+        self.listeners = []  # Called on its loop when workers join or leave
+        self.lock = threading.Lock()
+        self.capacity = 0  # Slots of the connected workers
+        self.reserved = 0
+
+    async def start(self, address):
+        """Listens on `address`. Raises FarmError for an address beyond this machine without a token."""
+        if not self.token and not is_local(address):
+            raise FarmError(f"Listening on {address} lets any machine run jobs here, set PYVQM_FARM_TOKEN")
+        kind, *where = parse_address(address)
+        if kind == "unix":
+            self.server = await asyncio.start_unix_server(self.serve, where[0])
+            self.address = address
+        else:
+            self.server = await asyncio.start_server(self.serve, *where)
+            host, port = self.server.sockets[0].getsockname()[:2]
+            self.address = f"{host}:{port}"
+        self.watcher = asyncio.create_task(self.watch())
+        log.info(f"Farm coordinator listening on {self.address}")
+
+    async def stop(self):
+        self.server.close()
+        self.watcher.cancel()
+        for worker in list(self.workers):
+            self.drop(worker, "coordinator stopped")
+        # Their connections are closed, the sessions end
+        await asyncio.gather(*self.sessions, return_exceptions=True)
+
+    def accepts(self, parser):
+        return parser_spec(parser) is not None
+
+    def free_slots(self):
+        with self.lock:
+            return max(0, self.capacity - self.reserved)
+
+    def reserve(self):
+        """Takes a free slot of the workers for a job, False if there is none. run() gives it back."""
+        with self.lock:
+            if self.capacity <= self.reserved:
+                return False
+            self.reserved += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.reserved -= 1
+
+    async def run(self, command, args, parser, post, result, progress=None, reserved=False):
+        """
+        Runs a job on a worker, like runtime.run_process: the parsed batches go to `post`, its fps
+        to `progress`, and its exit code is returned and set in `result`. `reserved` gives back
+        the slot taken by reserve(). A job left without workers runs here with `command`.
+        Raises FarmError if the worker can't run it, cancelling the coroutine cancels the job.
+        """
+        spec = parser_spec(parser)
+        if spec is None:
+            if reserved:
+                self.release()
+            raise FarmError(f"Jobs parsed by {type(parser).__name__} can't run on a worker")
+        # Size and modification time, so the staged copies of a changed input are not used
+        inputs = {}
+        for path in input_paths(args):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            inputs[path] = [stat.st_size, stat.st_mtime_ns]
+        job_id = next(self.ids)
+        job = RemoteJob(job_id, {"job": job_id, "args": list(args), **spec, "inputs": inputs}, post, result, progress)
+        if result.telemetry.started_at is None:
+            result.telemetry.started()
+        self.pending.append(job)
+        self.dispatch()
+        try:
+            returncode = await job.done
+            if returncode is LOCAL:
+                log.warning(f"No worker to run job {job.id}, running it here")
+                result.worker = None
+                return await run_process(command or self.command, args, parser, job.deliver, result, progress)
+            return returncode
+        except asyncio.CancelledError:
+            self.cancel(job)
+            raise
+        finally:
+            result.telemetry.finished()
+            if reserved:
+                self.release()
+
+    def cancel(self, job):
+        if job in self.pending:
+            self.pending.remove(job)
+        elif job.worker is not None:
+            job.worker.jobs.pop(job.id, None)
+            write_json(job.worker.writer, CANCEL, {"job": job.id})
+            job.worker = None
+            self.dispatch()
+
+    def dispatch(self):
+        """Sends the pending jobs to the workers with free slots, the least busy first."""
+        while self.pending:
+            worker = max(self.workers, key=lambda worker: worker.free, default=None)
+            if worker is None or worker.free <= 0:
+                return
+            job = self.pending.popleft()
+            job.worker = worker
+            worker.jobs[job.id] = job
+            worker.inputs.update(input_paths(job.message["args"]))
+            job.result.worker = worker.name
+            if job.result.telemetry.spawned_at is None:
+                job.result.telemetry.spawned(None)
+            write_json(worker.writer, JOB, job.message)
+            log.debug(f"Job {job.id} sent to {worker.name}")
+
+    async def serve(self, reader, writer):
+        """Session of a worker, from its HELLO until it disconnects or is dropped."""
+        try:
+            kind, payload = await asyncio.wait_for(read_message(reader), HEARTBEAT_TIMEOUT)
+            if kind != HELLO:
+                raise ProtocolError("Expected a HELLO")
+            hello = json.loads(payload)
+            if hello.get("protocol") != PROTOCOL:
+                raise ProtocolError(f"Protocol {hello.get('protocol')}, expected {PROTOCOL}")
+            if not hmac.compare_digest(str(hello.get("token", "")).encode(), self.token.encode()):
+                raise ProtocolError("Wrong token")
+            worker = WorkerConnection(str(hello["name"]), max(1, int(hello["slots"])), writer)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ProtocolError, ValueError, KeyError) as e:
+            log.warning(f"Refused a worker: {e}")
+            writer.close()
+            return
+        self.workers.append(worker)
+        self.sessions.add(asyncio.current_task())
+        log.info(f"Worker {worker.name} joined with {worker.slots} slots")
+        self.update_capacity()
+        self.dispatch()
+        reason = "disconnected"
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                worker.heard_at = time.monotonic()
+                self.handle(worker, kind, payload)
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ProtocolError, ValueError, KeyError, struct.error) as e:
+            reason = str(e) or type(e).__name__
+        finally:
+            self.sessions.discard(asyncio.current_task())
+            self.drop(worker, reason)
+
+    def handle(self, worker, kind, payload):
+        if kind == HEARTBEAT:
+            return
+        if kind == BATCH:
+            job_id, metric, columns = decode_batch(payload)
+            job = worker.jobs.get(job_id)
+            if job is not None:
+                job.deliver([(metric, columns)])
+        elif kind == PROGRESS:
+            message = json.loads(payload)
+            job = worker.jobs.get(message["job"])
+            if job is not None:
+                job.progressed(message.get("fps"), message.get("speed"))
+        elif kind == DONE:
+            message = json.loads(payload)
+            job = worker.jobs.pop(message["job"], None)
+            if job is not None:
+                job.finished(message)
+                self.dispatch()
+        elif kind == FETCH:
+            message = json.loads(payload)
+            task = asyncio.create_task(self.send_input(worker, message["fetch"], message["path"]))
+            worker.sending.add(task)
+            task.add_done_callback(worker.sending.discard)
+        else:
+            raise ProtocolError(f"Unexpected message {kind}")
+
+    async def send_input(self, worker, fetch, path):
+        """Sends an input of its jobs to a worker staging it: DATA messages, then FETCHED."""
+        if path not in worker.inputs:
+            write_json(worker.writer, FETCHED, {"fetch": fetch, "error": f"{path} is not an input of its jobs"})
+            return
+        size = 0
+        try:
+            with open(path, "rb") as file:
+                while chunk := await asyncio.to_thread(file.read, STAGE_CHUNK):
+                    write_message(worker.writer, DATA, DATA_HEADER.pack(fetch) + chunk)
+                    size += len(chunk)
+                    await worker.writer.drain()
+        except OSError as e:
+            write_json(worker.writer, FETCHED, {"fetch": fetch, "error": str(e)})
+            return
+        write_json(worker.writer, FETCHED, {"fetch": fetch, "size": size})
+
+    def drop(self, worker, reason):
+        """Disconnects a worker, its jobs run again on the others."""
+        if worker not in self.workers:
+            return
+        self.workers.remove(worker)
+        worker.writer.close()
+        for task in worker.sending:
+            task.cancel()
+        jobs = list(worker.jobs.values())
+        worker.jobs.clear()
+        now = time.monotonic()
+        for job in jobs:
+            job.worker = None
+            job.waiting_since = now
+        self.pending.extendleft(reversed(jobs))
+        if jobs:
+            log.warning(f"Worker {worker.name} lost ({reason}), its {len(jobs)} jobs run again")
+        else:
+            log.info(f"Worker {worker.name} left ({reason})")
+        self.update_capacity()
+        self.dispatch()
+
+    def update_capacity(self):
+        with self.lock:
+            self.capacity = sum(worker.slots for worker in self.workers)
+        for listener in self.listeners:
+            listener()
+
+    async def watch(self):
+        """Sends the heartbeats, drops the silent workers, and runs here the jobs left without any."""
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for worker in list(self.workers):
+                if now - worker.heard_at > HEARTBEAT_TIMEOUT:
+                    self.drop(worker, "no heartbeat")
+                else:
+                    write_message(worker.writer, HEARTBEAT)
+            if self.workers:
+                continue
+            for job in [job for job in self.pending if now - job.waiting_since > ORPHAN_TIMEOUT]:
+                self.pending.remove(job)
+                job.done.set_result(LOCAL)
+
+
+def start_coordinator(address, token=FARM_TOKEN):
+    """
+    Coordinator listening on `address`, on the loop of the runtime (see runtime.background_loop).
+    None if it can't listen, like on an address beyond this machine without a token.
+    """
+    coordinator = Coordinator(token)
+    try:
+        background_loop().submit(coordinator.start(address)).result()
+    except OSError as e:
+        log.error(f"No farm: {e}")
+        return None
+    return coordinator
+
+
+class Worker:
+    """
+    Runs the jobs of the coordinator at `address`, `slots` at most (the core count by default),
+    and connects again when the connection is lost. `path_map` is a list of (prefix, local prefix)
+    rewriting the paths of the inputs. The inputs it still can't find are fetched from the
+    coordinator to the `stage` directory, without one their jobs fail.
+    """
+
+    def __init__(self, address, slots=None, name=None, command=None, token=FARM_TOKEN, path_map=(), stage=None):
+        self.address = address
+        self.slots = slots or os.cpu_count() or 1
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.command = command or FFMPEG_COMMAND
+        self.token = token
+        self.path_map = list(path_map)
+        self.stage = stage
+        self.writer = None
+        self.jobs = {}  # Task of each job, by id
+        self.fetches = {}  # File and future of each fetch, by id
+        self.staging = {}  # Task of each input being staged, by staged path
+        self.fetch_ids = itertools.count(1)
+
+    async def serve(self):
+        """Runs jobs until cancelled."""
+        if self.stage is not None:
+            os.makedirs(self.stage, exist_ok=True)
+        waiting = False
+        while True:
+            try:
+                reader, self.writer = await self.connect()
+            except OSError as e:
+                if not waiting:
+                    log.warning(f"Can't connect to {self.address} ({e}), trying again every {RECONNECT_DELAY:.0f} s")
+                    waiting = True
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            waiting = False
+            try:
+                await self.session(reader)
+            except asyncio.IncompleteReadError:
+                log.warning(f"{self.address} closed the connection")
+            except (OSError, asyncio.TimeoutError, ProtocolError, ValueError, KeyError, struct.error) as e:
+                log.warning(f"Connection to {self.address} lost: {e or type(e).__name__}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def connect(self):
+        kind, *where = parse_address(self.address)
+        if kind == "unix":
+            return await asyncio.open_unix_connection(where[0])
+        return await asyncio.open_connection(*where)
+
+    async def session(self, reader):
+        write_json(
+            self.writer, HELLO, {"protocol": PROTOCOL, "name": self.name, "slots": self.slots, "token": self.token}
+        )
+        log.info(f"Connected to {self.address} as {self.name}, {self.slots} jobs at most")
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            while True:
+                kind, payload = await asyncio.wait_for(read_message(reader), HEARTBEAT_TIMEOUT)
+                self.handle(kind, payload)
+        finally:
+            heartbeat.cancel()
+            # The coordinator runs them again elsewhere
+            jobs = list(self.jobs.values())
+            for task in jobs:
+                task.cancel()
+            await asyncio.gather(*jobs, return_exceptions=True)
+            for file, future in self.fetches.values():
+                file.close()
+                future.cancel()
+            self.fetches.clear()
+            self.writer.close()
+
+    async def heartbeat(self):
+        while True:
+            write_message(self.writer, HEARTBEAT)
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def handle(self, kind, payload):
+        if kind == HEARTBEAT:
+            return
+        if kind == JOB:
+            message = json.loads(payload)
+            job = message["job"]
+            task = asyncio.create_task(self.run_job(message))
+            self.jobs[job] = task
+            task.add_done_callback(lambda task: self.jobs.pop(job, None))
+        elif kind == CANCEL:
+            task = self.jobs.get(json.loads(payload)["job"])
+            if task is not None:
+                task.cancel()
+        elif kind == DATA:
+            (fetch,) = DATA_HEADER.unpack_from(payload)
+            if fetch in self.fetches:
+                self.fetches[fetch][0].write(memoryview(payload)[DATA_HEADER.size :])
+        elif kind == FETCHED:
+            message = json.loads(payload)
+            file, future = self.fetches.pop(message["fetch"], (None, None))
+            if file is None:
+                return
+            file.close()
+            if "error" in message:
+                future.set_exception(FarmError(message["error"]))
+            else:
+                future.set_result(message["size"])
+        else:
+            raise ProtocolError(f"Unexpected message {kind}")
+
+    async def run_job(self, message):
+        """Runs a job of the coordinator, sends its values as they are parsed, then DONE."""
+        job = message["job"]
+        result = JobResult()
+        done = {"job": job}
+
+        async def post(batches):
+            for metric, columns in batches:
+                if len(columns["frame"]):
+                    write_message(self.writer, BATCH, encode_batch(job, metric, columns))
+            # The job stops reading ffmpeg while the coordinator doesn't keep up
+            await self.writer.drain()
+
+        def progress(fps):
+            write_json(self.writer, PROGRESS, {"job": job, "fps": fps, "speed": result.telemetry.speed})
+
+        try:
+            args = await self.local_args(message["args"], message.get("inputs", {}))
+            parser = build_parser(message)
+            done["returncode"] = await run_process(self.command, args, parser, post, result, progress)
+            log.info(f"Job {job} exited with code {result.returncode}")
+        except asyncio.CancelledError:
+            # Cancelled by the coordinator, or the connection is lost: it ignores this DONE
+            done["error"] = "Cancelled"
+            raise
+        except Exception as e:
+            # Whatever failed, the coordinator must hear of it or the job waits forever
+            done["error"] = str(e) if isinstance(e, (OSError, ProtocolError)) else f"{type(e).__name__}: {e}"
+            log.warning(f"Job {job} failed: {done['error']}")
+        finally:
+            telemetry = result.telemetry
+            done.update(
+                stderr=list(result.stderr_tail),
+                input_fps=result.input_fps,
+                parse_time=telemetry.parse_time,
+                bytes_read=telemetry.bytes_read,
+            )
+            write_json(self.writer, DONE, done)
+
+    async def local_args(self, args, inputs):
+        """`args` with the paths of their inputs on this machine."""
+        args = list(args)
+        for i in range(len(args) - 1):
+            if args[i] == "-i":
+                args[i + 1] = await self.local_path(args[i + 1], inputs.get(args[i + 1]))
+        return args
+
+    async def local_path(self, path, stat):
+        """Path of an input of the coordinator here: mapped, or staged."""
+        if "://" in path:
+            return path
+        local = path
+        for prefix, local_prefix in self.path_map:
+            if path.startswith(prefix):
+                local = local_prefix + path[len(prefix) :]
+                break
+        if os.path.exists(local):
+            return local
+        if self.stage is None:
+            raise FarmError(f"{local} not found, see --map and --stage")
+        return await self.staged_path(path, stat)
+
+    async def staged_path(self, path, stat):
+        """Copy of the input `path` of the coordinator in the stage directory, fetched on first use."""
+        key = hashlib.sha1(json.dumps([path, stat]).encode()).hexdigest()[:16]
+        staged = os.path.join(self.stage, key + os.path.splitext(path)[1])
+        if stat is not None and os.path.isfile(staged) and os.path.getsize(staged) == stat[0]:
+            return staged
+        if staged not in self.staging:
+            task = asyncio.create_task(self.fetch(path, staged))
+            self.staging[staged] = task
+            task.add_done_callback(lambda task: self.staging.pop(staged, None))
+        # Other jobs may wait for the same input
+        await asyncio.shield(self.staging[staged])
+        return staged
+
+    async def fetch(self, path, staged):
+        fetch = next(self.fetch_ids)
+        partial = f"{staged}.part"
+        future = asyncio.get_running_loop().create_future()
+        self.fetches[fetch] = (open(partial, "wb"), future)
+        write_json(self.writer, FETCH, {"fetch": fetch, "path": path})
+        log.info(f"Staging {path}")
+        try:
+            size = await future
+        except BaseException:
+            file, _ = self.fetches.pop(fetch, (None, None))
+            if file is not None:
+                file.close()
+            os.remove(partial)
+            raise
+        os.replace(partial, staged)
+        log.info(f"Staged {path} to {staged} ({size} bytes)")
@@ -0,0 +1,355 @@
+"""
+Helpers to build the ffmpeg command lines used to compute the metrics.
+"""
+
+import os
+
+# Filter used for each metric. Stats are written on stdout so they can be parsed while ffmpeg runs.
+METRIC_FILTERS = {
+    "ssim": "ssim=stats_file=-",
+    "psnr": "psnr=stats_file=-",
+}
+
+# Part of the videos that is scored, in seconds
+DURATION = "60"
+
+
+def seek_args(start: float, duration: str, length: float = None):
+    """
+    Input options reading `duration` seconds from `start`, to resume a run, or only
+    `length` seconds when it is given, to score a segment. A `duration` of None reads until the end.
+    With -ss before -i, ffmpeg seeks to the previous keyframe and drops the frames before `start`.
+    """
+    if duration is None:
+        args = ["-ss", f"{start:.6f}"] if start else []
+        return args + (["-t", f"{length:.6f}"] if length is not None else [])
+    if length is not None:
+        length = min(length, max(float(duration) - start, 0))
+    elif not start:
+        return ["-t", duration]
+    else:
+        length = max(float(duration) - start, 0)
+    args = ["-ss", f"{start:.6f}"] if start else []
+    return args + ["-t", f"{length:.6f}"]
+
+
+def seek_time(frame: int, fps: float):
+    """Time to seek to so the first frame read is `frame` (numbered from 0)."""
+    if not frame:
+        return 0.0
+    # Half a frame before its timestamp, so rounding never skips it
+    return (frame - 0.5) / fps
+
+
+def split_segments(frame_count: int, count: int, keyframes=(), step: int = 1):
+    """
+    Splits `frame_count` frames into `count` segments of about the same size, as a list of
+    (first frame, number of frames), frames numbered from 0. Segments start on the closest
+    of the `keyframes`, when they are known, so seeking to them doesn't decode frames for nothing.
+    With a `step`, segments start on a multiple of it.
+    """
+    starts = {0}
+    inner = [frame for frame in keyframes if 0 < frame < frame_count]
+    for i in range(1, count):
+        target = i * frame_count // count
+        if inner:
+            target = min(inner, key=lambda frame: abs(frame - target))
+        target -= target % step
+        if 0 < target < frame_count:
+            starts.add(target)
+    starts = sorted(starts)
+    return [
+        (first, end - first) for first, end in zip(starts, starts[1:] + [frame_count])
+    ]
+
+
+def select_chains(select=None):
+    """
+    Chains keeping only the sampled frames of each input (see sampling.py), and the labels of
+    the inputs after them. `select` holds the select expressions of the distorded video and of
+    the reference, None keeps every frame of an input.
+    """
+    chains = []
+    labels = []
+    for i, (expression, label) in enumerate(zip(select or (None, None), ("[sd]", "[sr]"))):
+        if expression is None:
+            labels.append(f"[{i}:v]")
+        else:
+            chains.append(f"[{i}:v]select='{expression}'{label}")
+            labels.append(label)
+    return chains, labels
+
+
+def build_metrics_graph(metrics: list, select=None):
+    """
+    Build a filter graph computing every metric of `metrics` from a single decode.
+    Input 0 is the distorded video and input 1 the reference, each one is decoded once
+    and split between the metric branches. `select` samples their frames, see select_chains.
+    Returns the graph and the list of output labels that must be mapped.
+    """
+    count = len(metrics)
+    chains, (distorded, reference) = select_chains(select)
+    if count == 1:
+        distorded_labels = [distorded]
+        reference_labels = [reference]
+    else:
+        distorded_labels = [f"[d{i}]" for i in range(count)]
+        reference_labels = [f"[r{i}]" for i in range(count)]
+        chains += [
+            f"{distorded}split={count}{''.join(distorded_labels)}",
+            f"{reference}split={count}{''.join(reference_labels)}",
+        ]
+
+    outputs = []
+    for i, metric in enumerate(metrics):
+        chains.append(
+            f"{distorded_labels[i]}{reference_labels[i]}{METRIC_FILTERS[metric]}[{metric}]"
+        )
+        outputs.append(f"[{metric}]")
+    return ";".join(chains), outputs
+
+
+def build_metrics_args(
+    distorded_path: str,
+    reference_path: str,
+    metrics: list,
+    duration: str = DURATION,
+    start: float = 0.0,
+    length: float = None,
+    select=None,
+    distorded_options=(),
+):
+    """
+    Build the ffmpeg arguments to compute `metrics` between a distorded file and its reference.
+    Both inputs are read from `start` seconds, during `length` seconds when it is given.
+    A sampled job only scores the frames of `select` (see select_chains), and
+    `distorded_options` are input options of the distorded video, like -skip_frame.
+    """
+    graph, outputs = build_metrics_graph(metrics, select)
+    inputs = seek_args(start, duration, length)
+    args = [
+        *inputs,
+        *distorded_options,
+        "-i",
+        distorded_path,
+        *inputs,
+        "-i",
+        reference_path,
+        "-filter_complex",
+        graph,
+    ]
+    for output in outputs:
+        args += ["-map", output]
+    args += ["-f", "null", "-"]
+    return args
+
+
+# Metadata key holding the index of the rendition in a batch graph
+RENDITION_KEY = "pyvqm.rendition"
+
+# Filters of a batch graph: they set their values as frame metadata instead of writing a stats file
+METADATA_FILTERS = {
+    "ssim": "ssim",
+    "psnr": "psnr",
+}
+
+# Frames ffmpeg may keep queued for each rendition of a batch graph
+BUFFERED_FRAMES = 8
+
+# Memory a batch graph may use for its queued frames
+MEMORY_BUDGET = 2 * 1024**3
+
+
+def max_batch_size(width=0, height=0, memory_budget=MEMORY_BUDGET):
+    """
+    Number of renditions a batch graph can score at once without exceeding `memory_budget`.
+    When the resolution is unknown, assume 4K.
+    """
+    width = width or 3840
+    height = height or 2160
+    # 3 bytes per pixel covers 4:4:4 8 bits and 4:2:0 up to 16 bits
+    frame_bytes = width * height * 3
+    return max(1, memory_budget // (frame_bytes * BUFFERED_FRAMES))
+
+
+def build_batch_graph(count: int, metrics: list):
+    """
+    Build a filter graph scoring `count` distorded videos against a single decode of the reference.
+    Input 0 is the reference, inputs 1 to `count` the distorded videos.
+    Every distorded video is tagged with its index (RENDITION_KEY), and each
+    metric branch prints its frame metadata on stdout, to be parsed by metrics_parser.MetadataParser.
+    Returns the graph and the list of output labels that must be mapped.
+    """
+    branches = count * len(metrics)
+    if branches == 1:
+        reference_labels = ["[0:v]"]
+        chains = []
+    else:
+        reference_labels = [f"[r{i}]" for i in range(branches)]
+        chains = [f"[0:v]split={branches}{''.join(reference_labels)}"]
+
+    outputs = []
+    for k in range(count):
+        tag = f"metadata=mode=add:key={RENDITION_KEY}:value={k}"
+        if len(metrics) == 1:
+            distorded_labels = [f"[d{k}]"]
+            chains.append(f"[{k + 1}:v]{tag}{distorded_labels[0]}")
+        else:
+            distorded_labels = [f"[d{k}_{m}]" for m in range(len(metrics))]
+            chains.append(f"[{k + 1}:v]{tag},split={len(metrics)}{''.join(distorded_labels)}")
+
+        for m, metric in enumerate(metrics):
+            reference_label = reference_labels[k * len(metrics) + m]
+            # direct=1 writes each line at once, so the branches don't mix their lines
+            chains.append(
+                f"{distorded_labels[m]}{reference_label}{METADATA_FILTERS[metric]},"
+                f"metadata=mode=print:file=-:direct=1[{metric}{k}]"
+            )
+            outputs.append(f"[{metric}{k}]")
+    return ";".join(chains), outputs
+
+
+def build_batch_args(
+    reference_path: str,
+    distorded_paths: list,
+    metrics: list,
+    duration: str = DURATION,
+    start: float = 0.0,
+):
+    """
+    Build the ffmpeg arguments to compute `metrics` for several distorded files, decoding the reference once.
+    Every input is read from `start` seconds.
+    """
+    graph, outputs = build_batch_graph(len(distorded_paths), metrics)
+    inputs = seek_args(start, duration)
+    args = [*inputs, "-i", reference_path]
+    for path in distorded_paths:
+        args += [*inputs, "-i", path]
+    args += ["-filter_complex", graph]
+    for output in outputs:
+        args += ["-map", output]
+    args += ["-f", "null", "-"]
+    return args
+
+
+# Options of the libvmaf filter, n_threads and n_subsample are the expensive ones
+VMAF_OPTIONS = {
+    "n_threads": os.cpu_count() or 1,
+    "n_subsample": 1,
+    "model": "version=vmaf_v0.6.1",
+}
+# Options of libvmaf that only change how fast it runs, not its scores
+VMAF_SPEED_OPTIONS = ("n_threads",)
+# libvmaf writes its log when the filter is closed, so videos are scored in chunks
+# of this many frames to get the values while the video is scored
+VMAF_CHUNK_FRAMES = 250
+# The log goes to stdout through a pipe, there is no such file on Windows
+VMAF_LOG_PATH = "/dev/stdout" if os.name != "nt" else None
+
+
+def escape_option(value: str):
+    """
+    Escapes a filter option value, such as a Windows path: backslashes become slashes,
+    and ":" is escaped for both the graph and the option parsers of ffmpeg.
+    """
+    return str(value).replace("\\", "/").replace(":", "\\\\:")
+
+
+def vmaf_options(options: dict = None):
+    """VMAF_OPTIONS updated with `options`."""
+    return {**VMAF_OPTIONS, **(options or {})}
+
+
+def score_settings(metric: str, engine: str = "ffmpeg", options: dict = None, batch: bool = False):
+    """
+    Settings the values of `metric` depend on, for their cache key (see cache.ResultCache.key):
+    the libvmaf options updated with `options` besides VMAF_SPEED_OPTIONS, or the engine
+    computing ssim and psnr (see engine.ENGINES), whose values differ in the last decimals.
+    `batch` is set for the values of a batch graph (see build_batch_graph): they are read from
+    the frame metadata, not from the rounded stats files of the other ffmpeg jobs.
+    """
+    if metric == "vmaf":
+        return ":".join(
+            f"{name}={value}" for name, value in vmaf_options(options).items() if name not in VMAF_SPEED_OPTIONS
+        )
+    if batch and engine == "ffmpeg":
+        return "engine=ffmpeg:graph=batch"
+    return f"engine={engine}"
+
+
+def build_vmaf_args(
+    distorded_path: str,
+    reference_path: str,
+    metrics: list = ("vmaf",),
+    duration: str = DURATION,
+    start: float = 0.0,
+    length: float = None,
+    options: dict = None,
+    log_path: str = VMAF_LOG_PATH,
+):
+    """
+    Build the ffmpeg arguments to compute VMAF between a distorded file and its reference,
+    see build_metrics_args. `options` update VMAF_OPTIONS. libvmaf writes a csv log to `log_path`,
+    parsed by metrics_parser.VmafParser.
+    """
+    settings = ":".join(
+        f"{name}={escape_option(value)}" for name, value in vmaf_options(options).items()
+    )
+    graph = f"[0:v][1:v]libvmaf={settings}:log_fmt=csv:log_path={escape_option(log_path)}"
+    inputs = seek_args(start, duration, length)
+    return [
+        *inputs,
+        "-i",
+        distorded_path,
+        *inputs,
+        "-i",
+        reference_path,
+        "-filter_complex",
+        graph,
+        "-f",
+        "null",
+        "-",
+    ]
+
+
+def build_rawvideo_args(
+    distorded_path: str,
+    reference_path: str,
+    metrics: list = (),
+    duration: str = DURATION,
+    start: float = 0.0,
+    length: float = None,
+    select=None,
+    distorded_options=(),
+):
+    """
+    Build the ffmpeg arguments decoding a distorded file and its reference for engine.FrameEngine,
+    see build_metrics_args. Each distorded frame is stacked over its reference frame and written
+    on stdout as raw yuv420p, so both are read from a single pipe and always stay in sync.
+    `metrics` is not used: the metrics are computed by the engine.
+    Frames are passed through as they are, the rawvideo muxer would duplicate or drop them to keep a constant rate.
+    """
+    chains, (distorded, reference) = select_chains(select)
+    chains += [f"{distorded}format=yuv420p[d]", f"{reference}format=yuv420p[r]", "[d][r]vstack[frames]"]
+    graph = ";".join(chains)
+    inputs = seek_args(start, duration, length)
+    return [
+        *inputs,
+        *distorded_options,
+        "-i",
+        distorded_path,
+        *inputs,
+        "-i",
+        reference_path,
+        "-filter_complex",
+        graph,
+        "-map",
+        "[frames]",
+        "-fps_mode",
+        "passthrough",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "yuv420p",
+        "-",
+    ]
@@ -0,0 +1,130 @@
+"""
+Thread budget of the ffmpeg jobs, so concurrent jobs keep every core busy without oversubscribing them.
+
+Left alone, ffmpeg sizes the threads of each decoder and filter graph for the whole machine, so
+N concurrent jobs start N times as many threads as there are cores. The governor divides the cores
+between the jobs expected to run at the same time, and gives each job an explicit budget:
+-threads for each of its decoders, -filter_threads and -filter_complex_threads for its filters,
+and n_threads for libvmaf.
+
+Profiles:
+
+- "throughput": a job per core. Jobs scale better than the threads of a job, so this scores
+  the most frames per second.
+- "latency": fewer jobs with LATENCY_THREADS threads each, so each video is scored sooner.
+
+Jobs can also be pinned to cores of their own (affinity, with taskset) and run with a nice level,
+so the GUI stays responsive while they run.
+"""
+
+import itertools
+import logging
+import os
+import re
+import shutil
+import threading
+
+log = logging.getLogger("rich")
+
+PROFILES = ("throughput", "latency")
+
+# Threads of a job with the latency profile
+LATENCY_THREADS = 4
+
+# Threads option of libvmaf in a filter graph, see filtergraph.VMAF_OPTIONS
+vmaf_threads_pattern = re.compile(r"\bn_threads=\d+")
+
+
+def available_cpus():
+    """Cores the process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class Budget:
+    """Threads of a job, and the cores it is pinned to (none without affinity)."""
+
+    def __init__(self, slot, threads, cpus=()):
+        self.slot = slot  # Index of the job among the running ones, released when it ends
+        self.threads = threads
+        self.cpus = list(cpus)
+
+
+class ThreadGovernor:
+    """
+    Gives a Budget to each job when it starts, with acquire(), and gets it back with release()
+    when it ends. It can be used from several threads.
+    `profile` is one of PROFILES, `nice` the nice level of the jobs, None to keep the one of pyvqm.
+    """
+
+    def __init__(self, profile="throughput", cpus=None, affinity=False, nice=None):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile {profile}, expected one of {', '.join(PROFILES)}")
+        self.profile = profile
+        self.cpus = sorted(cpus) if cpus else available_cpus()
+        self.nice = nice
+        self.taskset = shutil.which("taskset") if affinity else None
+        if affinity and self.taskset is None:
+            log.warning("taskset is not installed, jobs are not pinned to their cores")
+        self.nice_command = shutil.which("nice") if nice is not None else None
+        if nice is not None and self.nice_command is None:
+            log.warning("nice is not installed, jobs run with the nice level of pyvqm")
+        self.lock = threading.Lock()
+        self.slots = set()  # Slots of the running jobs
+
+    @property
+    def cores(self):
+        return len(self.cpus)
+
+    @property
+    def max_jobs(self):
+        """Jobs run at the same time."""
+        if self.profile == "latency":
+            return max(1, self.cores // LATENCY_THREADS)
+        return self.cores
+
+    def acquire(self, concurrency):
+        """Budget of a job starting while `concurrency` jobs, itself included, are expected to run."""
+        concurrency = max(1, min(concurrency, self.max_jobs))
+        with self.lock:
+            slot = next(slot for slot in itertools.count() if slot not in self.slots)
+            self.slots.add(slot)
+        # The first slots get the cores left over by the division
+        share, extra = divmod(self.cores, concurrency)
+        position = slot % concurrency
+        threads = max(1, share + (position < extra))
+        cpus = ()
+        if self.taskset:
+            first = position * share + min(position, extra)
+            cpus = [self.cpus[(first + i) % self.cores] for i in range(threads)]
+        return Budget(slot, threads, cpus)
+
+    def release(self, budget):
+        with self.lock:
+            self.slots.discard(budget.slot)
+
+    def apply(self, budget, command, args):
+        """
+        Command line running the ffmpeg `command` with `args` within `budget`, as the command line
+        before the arguments of ffmpeg (nice and taskset, then `command`) and the arguments.
+        Decoding and filtering work on the frames in turn, so the filters get the whole budget
+        and the decoders share it.
+        """
+        threads = str(budget.threads)
+        decode_threads = str(max(1, budget.threads // max(args.count("-i"), 1)))
+        governed = ["-filter_threads", threads, "-filter_complex_threads", threads]
+        for i, arg in enumerate(args):
+            if arg == "-i":
+                governed += ["-threads", decode_threads]
+            elif i and args[i - 1] == "-filter_complex":
+                arg = vmaf_threads_pattern.sub(f"n_threads={threads}", arg)
+            governed.append(arg)
+
+        # nice and taskset exec the command, the process of the job is still ffmpeg
+        launcher = []
+        if self.nice_command:
+            launcher += [self.nice_command, "-n", str(self.nice)]
+        if budget.cpus:
+            launcher += [self.taskset, "-c", ",".join(str(cpu) for cpu in budget.cpus)]
+        return [*launcher, command], governed
@@ -0,0 +1,102 @@
+"""
+Panel listing the jobs of a run with their telemetry (see telemetry.py), refreshed while they run.
+"""
+
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtWidgets import QHeaderView, QPushButton, QTableWidget, QTableWidgetItem, QVBoxLayout, QWidget
+
+# Refreshes of the panel per second
+REFRESH_RATE = 2
+
+COLUMNS = (
+    "Job",
+    "State",
+    "Queue wait",
+    "Duration",
+    "fps",
+    "Speed",
+    "Records",
+    "Parsed",
+    "Parse",
+    "UI",
+    "Peak RSS",
+    "Limited by",
+)
+
+
+def seconds(value):
+    return "" if value is None else f"{value:.2f} s"
+
+
+def size(value):
+    if value is None:
+        return ""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024 or unit == "GiB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+class JobsPanel(QWidget):
+    """
+    Table of the jobs given to set_jobs(), a job is anything with describe(), state and telemetry
+    like processQueue.Job. export_requested is emitted by the export button.
+    """
+
+    export_requested = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.jobs = []
+        self.table = QTableWidget(0, len(COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.exportButton = QPushButton("Export run report...", self)
+        self.exportButton.clicked.connect(self.export_requested)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.table)
+        layout.addWidget(self.exportButton)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000 // REFRESH_RATE)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start()
+
+    def set_jobs(self, jobs):
+        self.jobs = jobs
+        self.refresh()
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        self.table.setRowCount(len(self.jobs))
+        for row, job in enumerate(self.jobs):
+            telemetry = job.telemetry
+            fps, speed = telemetry.fps, telemetry.speed
+            cells = (
+                job.describe(),
+                job.state,
+                seconds(telemetry.queue_wait),
+                seconds(telemetry.duration),
+                "" if fps is None else f"{fps:g}",
+                "" if speed is None else f"{speed:g}x",
+                f"{telemetry.records:,}",
+                size(telemetry.bytes_read),
+                seconds(telemetry.parse_time),
+                seconds(telemetry.ui_time),
+                size(telemetry.peak_rss),
+                telemetry.limited_by() or "",
+            )
+            for column, text in enumerate(cells):
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QTableWidgetItem(text))
+                elif item.text() != text:
+                    item.setText(text)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
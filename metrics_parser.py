@@ -1,15 +1,48 @@
-import sys
+import logging
+import os
 import re
-from random import randint
-import pyqtgraph as pg
+import numpy as np
+
+from filtergraph import RENDITION_KEY
 
 # A regular expression, to extract the % complete.
 progress_re = re.compile(r"fps=([\d\.]+)")
+# Speed of the run against the duration of the video, on the same progress lines
+speed_re = re.compile(r"speed=\s*([\d\.]+)x")
 
 ssim_pattern = re.compile(r"n:(\d+) Y:(\d+\.\d+) U:(\d+\.\d+) V:(\d+\.\d+) All:(\d+\.\d+)")
 
 psnr_pattern = re.compile(r"n:(\d+) mse_avg:\d+\.\d+ mse_y:\d+\.\d+ mse_u:\d+\.\d+ mse_v:\d+\.\d+ psnr_avg:(\S+) psnr_y:(\S+) psnr_u:(\S+) psnr_v:(\S+)")
 
+# Frame rate of the first input, from the stream description ffmpeg prints on stderr
+stream_fps_pattern = re.compile(r"Stream #0:\d+.*: Video: .*?, ([\d.]+) fps")
+
+# Header of a frame printed by the metadata filter
+metadata_header_pattern = re.compile(r"frame:(\d+)")
+
+log = logging.getLogger("rich")
+
+# Columns of the parsed values, besides the frame numbers
+COMPONENTS = ("Y", "U", "V", "All")
+
+# Offsets of the Y, U, V and All values from the "Y" of a ssim stats line
+# ("n:%d Y:%f U:%f V:%f All:%f (%f)"). Every value of "%f" in [0, 1] is written
+# on 8 bytes ("d.dddddd") followed by a space.
+SSIM_STARTS = np.array([2, 13, 24, 37])
+# Weights of the bytes of a ssim value to get its mantissa. Mantissas are below 2**24,
+# so they are exact in float32, and the division by 1e6 rounds like float() does.
+SSIM_WEIGHTS = np.array([1e6, 0, 1e5, 1e4, 1e3, 1e2, 10, 1], dtype=np.float32)
+# Weights of the first 8 bytes of a psnr value ("%0.2f") to get its mantissa,
+# one column for each number of digits before the dot (1 to 3)
+PSNR_WEIGHTS = np.array(
+    [[100, 0, 10, 1, 0, 0, 0, 0], [1e3, 100, 0, 10, 1, 0, 0, 0], [1e4, 1e3, 100, 0, 10, 1, 0, 0]],
+    dtype=np.float32,
+).T
+# Offsets of the psnr_avg, psnr_y, psnr_u and psnr_v values from their "p"
+PSNR_STARTS = np.array([9, 7, 7, 7])
+# Bytes read after the last line, so a value window never overflows the buffer
+PADDING = b" " * 64
+
 
 
 def parse_ssim_values(output):
@@ -41,14 +74,334 @@ def parse_psnr_values(output):
     if m:
         return {
             'frame': int(m.group(1)),
-            'Y': float(m.group(3)) if float(m.group(3)) != float('inf') else float(100),
-            'U': float(m.group(4)) if float(m.group(4)) != float('inf') else float(100),
-            'V': float(m.group(5)) if float(m.group(5)) != float('inf') else float(100), 
-            'All': float(m.group(2)) if float(m.group(2)) != float('inf') else float(100),
+            'Y': cap_psnr(m.group(3)),
+            'U': cap_psnr(m.group(4)),
+            'V': cap_psnr(m.group(5)),
+            'All': cap_psnr(m.group(2)),
         }
     return None
 
 
+def parse_metrics_line(output):
+    """
+    Demultiplex a line written by a single pass graph (see filtergraph.build_metrics_graph).
+    Every branch writes its stats on the same stdout, the metric is recognized from the line itself.
+    Returns a tuple (metric, values), or (None, None) if the line can't be parsed.
+    """
+    if "mse_avg:" in output:
+        return "psnr", parse_psnr_values(output)
+    if "All:" in output:
+        return "ssim", parse_ssim_values(output)
+    return None, None
+
+
+def cap_psnr(value):
+    """PSNR is infinite when the frames are identical, cap it to 100."""
+    value = float(value)
+    return value if value != float('inf') else float(100)
+
+
+def metadata_to_values(metadata):
+    """
+    Converts the metadata printed for a frame of a batch graph to a tuple (metric, values).
+    The values also hold the index of the rendition they belong to.
+    """
+    rendition = int(metadata.get(RENDITION_KEY, 0))
+    if "lavfi.ssim.All" in metadata:
+        return "ssim", {
+            'frame': metadata['frame'],
+            'rendition': rendition,
+            'Y': float(metadata['lavfi.ssim.Y']),
+            'U': float(metadata['lavfi.ssim.U']),
+            'V': float(metadata['lavfi.ssim.V']),
+            'All': float(metadata['lavfi.ssim.All']),
+        }
+    if "lavfi.psnr.psnr_avg" in metadata:
+        return "psnr", {
+            'frame': metadata['frame'],
+            'rendition': rendition,
+            'Y': cap_psnr(metadata['lavfi.psnr.psnr.y']),
+            'U': cap_psnr(metadata['lavfi.psnr.psnr.u']),
+            'V': cap_psnr(metadata['lavfi.psnr.psnr.v']),
+            'All': cap_psnr(metadata['lavfi.psnr.psnr_avg']),
+        }
+    return None, None
+
+
+def records_to_columns(records):
+    """
+    Converts a list of (metric, values) to columns: a list of (metric, columns) where
+    columns holds the frame numbers and the values of each component as arrays.
+    Records are grouped by metric and rendition, in the order they come.
+    """
+    groups = {}
+    for metric, values in records:
+        groups.setdefault((metric, values.get('rendition')), []).append(values)
+
+    batches = []
+    for (metric, rendition), group in groups.items():
+        columns = {'frame': np.array([values['frame'] for values in group], dtype=np.int64)}
+        for component in COMPONENTS:
+            columns[component] = np.array([values[component] for values in group])
+        if rendition is not None:
+            columns['rendition'] = rendition
+        batches.append((metric, columns))
+    return batches
+
+
+def values_bytes(data, starts):
+    """
+    The 8 bytes at each of `starts` in data, as rows of an array. They are read as one unaligned
+    uint64 each, which gathers them several times faster than indexing the bytes one by one.
+    """
+    words = np.ndarray((len(data) - 7,), dtype=np.uint64, buffer=data, strides=(1,))
+    return words[starts].view(np.uint8).reshape(-1, 8)
+
+
+def first_frame_number(data, anchor):
+    """Frame number ("n:") of the line holding the byte at `anchor`."""
+    start = data.rfind(b"n:", 0, anchor) + 2
+    return int(data[start : data.find(b" ", start)])
+
+
+class StatsParser:
+    """
+    Streaming parser of the ssim and psnr stats files written on stdout (see filtergraph.build_metrics_args).
+
+    feed() takes raw chunks of stdout, keeps the partial trailing line for the next call,
+    and extracts every record of the chunk at once with NumPy: the lines are located by
+    a byte only found in their metric ("Y" for ssim, the four "p" of psnr_* for psnr),
+    and values are read from the fixed layout ffmpeg writes them with.
+    A chunk that doesn't match this layout is parsed line by line with parse_metrics_line.
+    """
+
+    def __init__(self):
+        self.remainder = b""  # Partial line kept between two chunks
+
+    def feed(self, chunk):
+        """Returns a list of (metric, columns), see records_to_columns."""
+        data = b"".join((self.remainder, bytes(chunk), PADDING))
+        end = data.rfind(b"\n", 0, len(data) - len(PADDING)) + 1
+        self.remainder = data[end : len(data) - len(PADDING)]
+        if not end:
+            return []
+        batches = self.parse(data, end)
+        if batches is None:
+            batches = self.parse_lines(data[:end])
+        return batches
+
+    def flush(self):
+        """Parses the last line if it was not terminated."""
+        remainder, self.remainder = self.remainder, b""
+        if not remainder.strip():
+            return []
+        return self.feed(remainder + b"\n")
+
+    def parse(self, data, end):
+        """Vectorized parsing of the complete lines in data[:end], None if the layout is not the expected one."""
+        buf = np.frombuffer(data, dtype=np.uint8)
+        lines = np.count_nonzero(buf[:end] == ord("\n"))
+        ssim = np.flatnonzero(buf[:end] == ord("Y"))
+        psnr = np.flatnonzero(buf[:end] == ord("p"))
+        if len(psnr) % 4 or len(ssim) + len(psnr) // 4 != lines:
+            return None
+
+        batches = []
+        if len(ssim):
+            starts = (ssim[:, None] + SSIM_STARTS).ravel()
+            window = values_bytes(data, starts)
+            if not ((window[:, 1] == ord(".")) & (buf[starts + 8] == ord(" "))).all():
+                return None
+            frames = self.frame_numbers(data, ssim)
+            if frames is None:
+                return None
+            mantissas = (window - np.uint8(48)).astype(np.float32) @ SSIM_WEIGHTS
+            values = mantissas.astype(np.float64) / 1e6
+            batches.append(("ssim", self.columns(frames, values.reshape(-1, 4))))
+
+        if len(psnr):
+            psnr = psnr.reshape(-1, 4)
+            labels = buf[psnr + 5]
+            if not (labels == np.frombuffer(b"ayuv", dtype=np.uint8)).all():
+                return None
+            frames = self.frame_numbers(data, psnr[:, 0])
+            if frames is None:
+                return None
+            window = values_bytes(data, (psnr + PSNR_STARTS).ravel())
+            infinite = window[:, 0] == ord("i")
+            # Digits before the dot, compared column by column: reductions along rows of 3 are slow
+            two, three = window[:, 2] == ord("."), window[:, 3] == ord(".")
+            if not (infinite | (window[:, 1] == ord(".")) | two | three).all():
+                return None
+            candidates = (window - np.uint8(48)).astype(np.float32) @ PSNR_WEIGHTS
+            mantissas = np.where(three, candidates[:, 2], np.where(two, candidates[:, 1], candidates[:, 0]))
+            values = mantissas.astype(np.float64) / 100
+            # PSNR is infinite when the frames are identical, cap it to 100
+            values[infinite] = 100
+            # psnr_avg comes first, it is the All column
+            batches.append(("psnr", self.columns(frames, values.reshape(-1, 4)[:, [1, 2, 3, 0]])))
+        return batches
+
+    def frame_numbers(self, data, anchors):
+        """
+        Frame numbers of the lines at `anchors`. ffmpeg numbers them one by one, so only
+        the first and last lines are read. None if the numbers are not consecutive.
+        """
+        first = first_frame_number(data, anchors[0])
+        last = first_frame_number(data, anchors[-1])
+        if last - first + 1 != len(anchors):
+            return None
+        return np.arange(first, last + 1, dtype=np.int64)
+
+    def columns(self, frames, values):
+        columns = {'frame': frames}
+        for i, component in enumerate(COMPONENTS):
+            columns[component] = values[:, i]
+        return columns
+
+    def parse_lines(self, data):
+        """Slow path, parses the lines one by one."""
+        records = []
+        for line in data.decode("utf8", errors="replace").split("\n"):
+            if not line.strip():  # Ignorer les lignes vides
+                continue
+            try:
+                metric, values = parse_metrics_line(line)
+            except ValueError:
+                metric, values = None, None
+            if values:
+                records.append((metric, values))
+            else:
+                log.error(f"Failed to parse line: {line.strip()}")
+        return records_to_columns(records)
+
+
+class MetadataParser:
+    """
+    Parser of a batch graph (see filtergraph.build_batch_graph), where the metadata
+    filter prints each frame as a "frame:" header followed by one key=value line per metadata.
+    Records of different branches never interleave, so a record ends at the next header.
+    feed() takes raw chunks of stdout, like StatsParser.
+    """
+
+    def __init__(self):
+        self.remainder = b""  # Partial line kept between two chunks
+        self.current = None  # Metadata of the frame being read
+
+    def feed(self, chunk):
+        data = self.remainder + bytes(chunk)
+        end = data.rfind(b"\n") + 1
+        self.remainder = data[end:]
+        return records_to_columns(self.feed_lines(data[:end].decode("utf8").split("\n")))
+
+    def feed_lines(self, lines):
+        records = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            m = metadata_header_pattern.match(line)
+            if m:
+                records += self.flush_record()
+                # The metadata filter counts from 0, ssim and psnr stats from 1
+                self.current = {'frame': int(m.group(1)) + 1}
+            elif self.current is not None and "=" in line:
+                key, value = line.split("=", 1)
+                self.current[key] = value
+            else:
+                log.error(f"Failed to parse line: {line}")
+        return records
+
+    def flush(self):
+        """Returns the records still being read."""
+        remainder, self.remainder = self.remainder, b""
+        records = self.feed_lines(remainder.decode("utf8").split("\n"))
+        return records_to_columns(records + self.flush_record())
+
+    def flush_record(self):
+        """Returns the record being read, if it is complete."""
+        metadata, self.current = self.current, None
+        if not metadata:
+            return []
+        metric, values = metadata_to_values(metadata)
+        if not values:
+            log.error(f"Frame {metadata['frame']} has no metric metadata")
+            return []
+        return [(metric, values)]
+
+
+class VmafParser:
+    """
+    Parser of the csv log of libvmaf (see filtergraph.build_vmaf_args), written on stdout.
+    libvmaf writes its log when the filter is closed, the rows are parsed as the chunks come.
+    VMAF has no value per plane: the score goes in the All column, Y, U and V are NaN.
+    When the log is written to a file instead (`log_path`), flush() reads and removes it.
+    """
+
+    def __init__(self, log_path=None):
+        self.remainder = b""  # Partial line kept between two chunks
+        self.log_path = log_path
+        self.score_column = None  # Index of the score in a row, known once the header is read
+
+    def feed(self, chunk):
+        data = self.remainder + bytes(chunk)
+        end = data.rfind(b"\n") + 1
+        self.remainder = data[end:]
+        return self.parse_lines(data[:end].decode("utf8", errors="replace").splitlines())
+
+    def parse_lines(self, lines):
+        frames, scores = [], []
+        for line in lines:
+            fields = line.strip().split(",")
+            if not fields[0]:
+                continue
+            if self.score_column is None:
+                if fields[0] != "Frame":
+                    log.error(f"Failed to parse line: {line.strip()}")
+                    continue
+                # The score column is named after the model, "vmaf" by default
+                names = [name for name in fields if name]
+                self.score_column = names.index("vmaf") if "vmaf" in names else len(names) - 1
+                continue
+            try:
+                frame, score = int(fields[0]), float(fields[self.score_column])
+            except (ValueError, IndexError):
+                log.error(f"Failed to parse line: {line.strip()}")
+                continue
+            # libvmaf counts the frames from 0, ssim and psnr stats from 1
+            frames.append(frame + 1)
+            scores.append(score)
+        if not frames:
+            return []
+        nan = np.full(len(scores), np.nan)
+        columns = {'frame': np.array(frames, dtype=np.int64), 'Y': nan, 'U': nan, 'V': nan}
+        columns['All'] = np.array(scores)
+        return [("vmaf", columns)]
+
+    def flush(self):
+        remainder, self.remainder = self.remainder, b""
+        batches = self.parse_lines(remainder.decode("utf8", errors="replace").splitlines())
+        if self.log_path and os.path.exists(self.log_path):
+            with open(self.log_path, encoding="utf8", errors="replace") as log_file:
+                batches += self.parse_lines(log_file.read().splitlines())
+            os.remove(self.log_path)
+        return batches
+
+
+def stream_fps_parser(output):
+    """Frame rate of the first input, None if its stream description is not in `output`."""
+    m = stream_fps_pattern.search(output)
+    if m:
+        return float(m.group(1))
+
+
+def speed_parser(output):
+    """Last speed reported by ffmpeg in `output` (1.0 is real time), None if there is none."""
+    speeds = speed_re.findall(output)
+    if speeds:
+        return float(speeds[-1])
+
+
 def simple_fps_parser(output):
     """
     Matches lines using the progress_re regex,
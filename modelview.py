@@ -1,23 +1,73 @@
 import logging
+import os
 import sys
+import tempfile
+from concurrent.futures import CancelledError
 
 from PySide6 import QtCore, QtGui, QtWidgets
-from PySide6.QtWidgets import QFileDialog
-from PySide6.QtCore import QProcess, Qt
-from rich.logging import RichHandler
-
+from PySide6.QtWidgets import QDockWidget, QFileDialog
+from PySide6.QtCore import Qt, Signal
+
+from cache import ResultCache
+from engine import stats_job
+from farm import FARM_ADDRESS, start_coordinator
+from filtergraph import (
+    DURATION,
+    MEMORY_BUDGET,
+    METRIC_FILTERS,
+    VMAF_CHUNK_FRAMES,
+    VMAF_LOG_PATH,
+    build_batch_args,
+    build_vmaf_args,
+    max_batch_size,
+    score_settings,
+    seek_time,
+    vmaf_options,
+)
+from jobspanel import JobsPanel
 from ListWindow import Ui_MainWindow
-from metrics_parser import parse_psnr_values, parse_ssim_values, simple_fps_parser
-from plotwindows import PlotWindow
+from metrics_parser import MetadataParser, VmafParser
+from probe import Prober, ProbeError
+from project import EXTENSION, ProjectError, open_project, save_project
+from sampling import Sampling
+from segments import SegmentedScore
+from series import MappedSeries
+from stats import describe
+from processQueue import Job, ProcessQueue
+from telemetry import run_report, write_report
 from video import Distorded, Reference
 
+
+
+class DeferredRichHandler(logging.Handler):
+    """RichHandler imported with the first record, rich takes a while to import (see startup.py)."""
+
+    def __init__(self):
+        super().__init__()
+        self.handler = None
+
+    def emit(self, record):
+        if self.handler is None:
+            from rich.logging import RichHandler
+
+            self.handler = RichHandler()
+            self.handler.setFormatter(self.formatter)
+        self.handler.emit(record)
+
+
 FORMAT = "%(message)s"
 logging.basicConfig(
-    level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+    level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[DeferredRichHandler()]
 )
 
 log = logging.getLogger("rich")
 
+# Metrics computed from the stats of the ssim and psnr filters, they share their decodes
+STATS_METRICS = tuple(METRIC_FILTERS)
+
+# Scored frames from which the values of a distorded video are kept on disk (series.MappedSeries)
+MAPPED_FRAMES = 1_000_000
+
 
 # Load the tick icon.
 tick = QtGui.QImage("tick.png")
@@ -31,8 +81,13 @@ class DistordedModel(QtCore.QAbstractListModel):
     def data(self, index, role):
         if role == Qt.DisplayRole:
             distorded = self.distordedList[index.row()]
-
-            return distorded.video_path
+            # Summary of each metric below the path, the summaries only read the frames added since the last paint
+            lines = [distorded.video_path]
+            for metric in ("ssim", "psnr", "vmaf"):
+                text = describe(getattr(distorded, metric).summary(), metric)
+                if text:
+                    lines.append(f"    {metric.upper()}: {text}")
+            return "\n".join(lines)
 
         if role == Qt.DecorationRole:
             distorded = self.distordedList[index.row()]
@@ -43,9 +98,19 @@ class DistordedModel(QtCore.QAbstractListModel):
     def rowCount(self, index):
         return len(self.distordedList)
 
+    def refresh(self, distorded):
+        """Draws the row of a video again, with the summaries of its values."""
+        if distorded in self.distordedList:
+            index = self.index(self.distordedList.index(distorded))
+            self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
 
 class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
-    def __init__(self):
+    # Emitted from the probe threads with the video and the future of its probe
+    probed = Signal(object, object)
+    keyframes_probed = Signal(object, object)
+
+    def __init__(self, max_jobs=None, cache=None, governor=None, farm=None):
         super().__init__()
         self.setupUi(self)
         self.__init_ui___()
@@ -53,20 +118,59 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
         self.model = DistordedModel()
         self.distordedView.setModel(self.model)
 
-        self.plotWindow = PlotWindow(self)  # Reference to the plot window.
-
-        self.stdout_buffer = ""  # Buffer pour stocker les données partielles
-        self.all_ssim_values = []  # Pour stocker toutes les valeurs SSIM
-
-        self.SSIM_frames = []  # Liste pour stocker les frames
-        self.ssim_values = []  # Liste pour stocker les valeurs SSIM
-
-        self.psnr_frames = []  # Liste pour stocker les frames PSNR
-        self.psnr_values = []  # Liste pour stocker les valeurs PSNR
+        # Plot window, built by plotWindow when it is first shown or values arrive
+        self.plots = None
+
+        # Metrics computed when running
+        self.metrics = ["ssim", "psnr", "vmaf"]
+        # Options of libvmaf, they update filtergraph.VMAF_OPTIONS (n_threads, n_subsample, model)
+        self.vmaf_options = {}
+        # Compute all the metrics of a distorded video from a single decode
+        self.single_pass = True
+        # Score several distorded videos against a single decode of the reference
+        self.batch_mode = True
+        self.memory_budget = MEMORY_BUDGET  # Memory a batch may use for its queued frames
+        # Split each pair in time segments scored in parallel, when there are fewer pairs than job slots
+        self.segment_mode = False
+        self.segment_jobs = {}  # Segment jobs, with their SegmentedScore and segment index
+        # How ssim and psnr are computed: "ffmpeg" filters, or "numpy" from the decoded frames (see engine.py)
+        self.engine = "ffmpeg"
+        # Preview: only score the frames picked by a sampling.Sampling, None scores every frame
+        self.sampling: Sampling = None
+        # Values computed by previous runs, so unchanged pairs are not scored again
+        self.cache = cache if cache is not None else ResultCache()
+        # Probes the files as they are added, without blocking the GUI
+        self.prober = Prober(self.cache)
+        self.probed.connect(self.handle_probe)
+        self.keyframes_probed.connect(self.handle_keyframes)
+
+        # Runs the ffmpeg jobs, up to max_jobs at the same time (defaults to the core count),
+        # with the thread budgets of a governor.ThreadGovernor when one is given.
+        # The workers of a farm.Coordinator run the others, PYVQM_FARM starts one (see farm.py)
+        if farm is None and FARM_ADDRESS:
+            farm = start_coordinator(FARM_ADDRESS)
+        self.queue = ProcessQueue(max_jobs, parent=self, governor=governor, farm=farm)
+        self.queue.job_finished.connect(self.job_finished)
+        self.queue.job_failed.connect(self.job_failed)
+        self.queue.drained.connect(self.queue_drained)
+        self.total_jobs = 0
+        self.done_jobs = 0
+        self.run_jobs = []  # Jobs of the current run, with their telemetry
+        self.stop = False
 
-        
+        # Jobs panel, shown from the menu bar
+        self.jobsPanel = JobsPanel(self)
+        self.jobsPanel.export_requested.connect(self.export_report)
+        self.jobsDock = QDockWidget("Jobs", self)
+        self.jobsDock.setWidget(self.jobsPanel)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.jobsDock)
+        self.jobsDock.hide()
+        self.menubar.addAction(self.jobsDock.toggleViewAction())
 
-        self.p = None  # Initialize the QProcess to None as we don't have any running processes at start.
+        # Projects save the session with its values, see project.py
+        projectMenu = self.menubar.addMenu("Project")
+        projectMenu.addAction("Open project...", self.openProject)
+        projectMenu.addAction("Save project...", self.saveProject)
 
     def __init_ui___(self):
         # Connect the add reference button
@@ -95,8 +199,10 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
             log.debug(f"Adding distorded file: {file_name}")
             # Create a Distorded object and append it to the model
             distorded = Distorded(file_name)
+            self.probe(distorded)
             self.model.distordedList.append(distorded)
-            self.plotWindow.add_plot(distorded.video_path)
+            if self.plots is not None:
+                self.plots.add_plot(distorded.video_path)
             self.runButton.setEnabled(True)
 
             self.runButton.setText("Run !")
@@ -116,6 +222,7 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
         if file_name:
             log.debug(f"Reference file selected is now: {file_name}")
             self.reference = Reference(file_name)
+            self.probe(self.reference)
             self.referenceEdit.setText(f"{self.reference.video_path}")
             # Make sure to reanable the run button
             self.runButton.setEnabled(True)
@@ -124,9 +231,140 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
             # TODO : Clear all plots if we chhange the reference
         return
 
+    def probe(self, video):
+        """Probes a video on the thread pool of the prober, handle_probe gets the result."""
+        future = self.prober.submit(video.video_path)
+        future.add_done_callback(lambda future: self.probed.emit(video, future))
+
+    def handle_probe(self, video, future):
+        try:
+            info = future.result()
+        except ProbeError as e:
+            log.warning(f"Can't probe {video.video_path}: {e}")
+            return
+        except CancelledError:
+            return
+        log.debug(f"{video.video_path}: {info}")
+        video.set_info(info)
+        self.model.layoutChanged.emit()
+        if (
+            isinstance(video, Distorded)
+            and not isinstance(video.ssim, MappedSeries)
+            and self.scored_frames([video]) >= MAPPED_FRAMES
+        ):
+            log.info(f"Keeping the values of {video.video_path} on disk")
+            video.set_series(MappedSeries)
+        if isinstance(video, Reference) and video.fps:
+            # Segments start on the keyframes of the reference
+            future = self.prober.submit_keyframes(video.video_path, video.fps)
+            future.add_done_callback(lambda future: self.keyframes_probed.emit(video, future))
+
+    def handle_keyframes(self, video, future):
+        try:
+            video.keyframes = future.result()
+        except (ProbeError, CancelledError):
+            return
+
     def showPlots(self):
         return
 
+    @property
+    def plotWindow(self):
+        """
+        The plot window, built on the first call with the curves of the videos already there.
+        Building it imports pyqtgraph, so the list window shows up without waiting for it.
+        Until then, the curves are only changed when the window exists (see self.plots).
+        """
+        if self.plots is None:
+            from plotwindows import PlotWindow
+
+            self.plots = PlotWindow(self)
+            for index, distorded in enumerate(self.model.distordedList):
+                self.plots.add_plot(distorded.video_path)
+                for metric in ("ssim", "psnr", "vmaf"):
+                    if len(getattr(distorded, metric)):
+                        self.plots.update_series(metric, getattr(distorded, metric), index)
+        return self.plots
+
+    def settings(self):
+        """Settings of the jobs, stored in projects."""
+        return {
+            "metrics": list(self.metrics),
+            "vmaf_options": dict(self.vmaf_options),
+            "single_pass": self.single_pass,
+            "batch_mode": self.batch_mode,
+            "segment_mode": self.segment_mode,
+            "engine": self.engine,
+            "sampling": None if self.sampling is None else str(self.sampling),
+        }
+
+    def apply_settings(self, settings):
+        for name in ("single_pass", "batch_mode", "segment_mode", "engine"):
+            if name in settings:
+                setattr(self, name, settings[name])
+        self.metrics = list(settings.get("metrics", self.metrics))
+        self.vmaf_options = dict(settings.get("vmaf_options", self.vmaf_options))
+        sampling = settings.get("sampling")
+        self.sampling = None if sampling is None else Sampling.parse(sampling)
+
+    def saveProject(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save project", f"comparison{EXTENSION}", f"pyvqm projects (*{EXTENSION});;All Files *"
+        )
+        if not path:
+            return
+        try:
+            save_project(path, getattr(self, "reference", None), self.model.distordedList, self.settings())
+        except OSError as e:
+            log.error(f"Can't save the project to {path}: {e}")
+
+    def openProject(self):
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Open project", "", f"pyvqm projects (*{EXTENSION});;All Files *"
+        )
+        if path:
+            self.load_project(path)
+
+    def load_project(self, path):
+        """
+        Replaces the videos and the settings by the ones of a project. Only its header is read,
+        the series of a curve are read when it is first drawn.
+        """
+        try:
+            project = open_project(path)
+        except (OSError, ValueError, KeyError, ProjectError) as e:
+            log.error(f"Can't open the project {path}: {e}")
+            return
+        if self.queue.is_busy():
+            self.stop_compute()
+        for index in reversed(range(len(self.model.distordedList))):
+            if self.plots is not None:
+                self.plots.reset_all(index)
+                self.plots.remove_plot(index)
+        self.model.distordedList.clear()
+        self.segment_jobs = {}
+
+        self.apply_settings(project.settings)
+        if project.reference is not None:
+            self.reference = project.reference
+            self.referenceEdit.setText(f"{self.reference.video_path}")
+            # Its keyframes are not stored, segments start on them
+            self.probe(self.reference)
+        for index, distorded in enumerate(project.renditions):
+            self.model.distordedList.append(distorded)
+            if self.plots is None:
+                # Its curves are added when the plot window is built
+                continue
+            self.plots.add_plot(distorded.video_path)
+            for metric in ("ssim", "psnr", "vmaf"):
+                if len(getattr(distorded, metric)):
+                    self.plots.update_series(metric, getattr(distorded, metric), index)
+        pending = any(self.pending_metrics(distorded) for distorded in project.renditions)
+        self.runButton.setEnabled(pending)
+        self.runButton.setText("Run !" if pending else "All done")
+        self.model.layoutChanged.emit()
+        log.info(f"Opened the project {path} with {len(project.renditions)} videos")
+
     def add(self):
         """
         Add an item to our todo list, getting the text from the QLineEdit .todoEdit
@@ -146,18 +384,19 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
         if indexes:
             # Indexes is a list of a single item in single-select mode.
             index = indexes[0]
+            # Cancel the jobs still running on this video
+            distorded = self.model.distordedList[index.row()]
+            for job in self.queue.jobs():
+                if distorded in self.job_videos(job):
+                    self.queue.cancel(job)
             # Remove the item and refresh.
             del self.model.distordedList[index.row()]
             self.model.layoutChanged.emit()
             # Clear the selection (as it is no longer valid).
             self.distordedView.clearSelection()
-            self.plotWindow.reset_all(index.row())
-            self.plotWindow.remove_plot(index.row())
-            self.ssim_values.clear()
-            self.psnr_values.clear()
-            self.SSIM_frames.clear()
-            self.psnr_frames.clear()
-            
+            if self.plots is not None:
+                self.plots.reset_all(index.row())
+                self.plots.remove_plot(index.row())
 
     def show_new_window(self, checked):
         """
@@ -206,8 +445,10 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
                 log.info(f"Got {file_path} drag & dropped into the window")
                 # Create a Distorded object and append it to the model
                 distorded = Distorded(file_path)
+                self.probe(distorded)
                 self.model.distordedList.append(distorded)
-                self.plotWindow.add_plot(distorded.video_path)
+                if self.plots is not None:
+                    self.plots.add_plot(distorded.video_path)
                 self.runButton.setEnabled(True)
                 self.runButton.setText("Run !")
                 self.model.layoutChanged.emit()
@@ -216,14 +457,14 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
             e.ignore()
 
     def closeEvent(self, event):
-        if self.plotWindow:
-            self.plotWindow.close()
+        if self.plots is not None:
+            self.plots.close()
 
-        if self.p is not None and self.p.state() != QProcess.NotRunning:
-            log.info("Closing MainWindow, killing process...")
-            self.p.kill()
-            self.p.waitForFinished()
-            self.p = None
+        self.prober.shutdown()
+        if self.queue.is_busy():
+            log.info("Closing MainWindow, killing processes...")
+            self.stop = True
+            self.queue.cancel_all(wait=True)
 
     def run(self):
         """
@@ -233,309 +474,522 @@ class MainWindowList(QtWidgets.QMainWindow, Ui_MainWindow):
         for distorded in distordedList:
             log.info(f"Got to run on {distorded.video_path}")
 
-    """  
-    Function to start a new process with the given arguments and connect the signals to the handlers.
-            This function is used to start both SSIM and PSNR processes.
-            It takes the following parameters:
-            - plot_to_reset: function to reset the plot
-            - stdout_handler: function to handle standard output, produced by FFMpeg 
-            - std_err_handler: function to handle standard error
-            - p_finished_handler: function to handle process finished signal
-            - frames_data: list to store frames data
-            - fps_data: list to store fps data
-            - args: list of arguments for the process
-            - index: index of the video being processed
-    """
-
-    def start_process(
-        self,
-        plot_to_reset,
-        stdout_handler,
-        std_err_handler,
-        p_finished_handler,
-        frames_data: list,
-        fps_data: list,
-        metric_to_update: str ,
-        args: list = [],
-        index: int = 0,
-        
-    ):
-        frames_data.clear()
-        # Clear the list before starting a new process
-        getattr(self.model.distordedList[index], metric_to_update).clear()
-        getattr(self.model.distordedList[index], "frames").clear()
-
-        fps_data.clear()
-
-        # Before we plot, make sure to reset the plot
-        plot_to_reset(index)
-        # Reset the values stored in the lists
-        frames_data.clear()
-        fps_data.clear()
-        # Clear the buffer
-        self.stdout_buffer = ""
-        # Create a new QProcess instance
-        self.p = QProcess()
-
-        self.p.readyReadStandardOutput.connect(stdout_handler)
-        self.p.readyReadStandardError.connect(std_err_handler)
-        self.p.stateChanged.connect(self.handle_state)
-        self.p.finished.connect(
-            lambda exitCode, exitStatus: p_finished_handler(
-                self.p, index, exitCode, exitStatus
-            )
-        )
-        self.p.start(
-            "ffmpeg",
-            args,
+    def resume(self, indexes, metrics):
+        """
+        Frame the next job on the videos at `indexes` starts after, and the time to seek to.
+        The values an interrupted job parsed up to this frame are kept, the others are cleared.
+        Without a known frame rate, the job can't seek and starts from the beginning.
+        """
+        renditions = [self.model.distordedList[index] for index in indexes]
+        fps = self.reference.fps or max(distorded.fps for distorded in renditions)
+        frame = min(distorded.resume_frame(metrics) for distorded in renditions) if fps else 0
+        for index, distorded in zip(indexes, renditions):
+            if not frame:
+                distorded.reset_values(metrics)
+            for metric in metrics:
+                getattr(distorded, metric).truncate(frame)
+                if self.plots is not None:
+                    self.plots.reset(metric, index)
+                if frame:
+                    self.plotWindow.update_series(metric, getattr(distorded, metric), index)
+        if frame:
+            log.info(f"Resuming {', '.join(metrics)} for indexes {indexes} after frame {frame}")
+        return frame, seek_time(frame, fps)
+
+    def start_job(self, index, metrics):
+        """
+        Queue a job computing `metrics` for the distorded video at `index`.
+        It goes on from where an interrupted job stopped, see resume().
+        The job starts as soon as the queue has a free slot.
+        """
+        distorded = self.model.distordedList[index]
+        frame, start = self.resume([index], metrics)
+
+        build, parser = self.stats_job(metrics, distorded)
+        args = build(distorded.video_path, self.reference.video_path, list(metrics), start=start)
+        job = Job(args, parser(), [distorded], metrics, frame_offset=frame)
+        return self.add_job(job)
+
+    def stats_job(self, metrics, distorded):
+        """
+        Arguments builder and parser factory of the jobs computing `metrics` for `distorded`,
+        with the engine of self.engine.
+        """
+        pix_fmts = (self.reference.pix_fmt, distorded.pix_fmt)
+        return stats_job(self.engine, self.reference.width, self.reference.height, list(metrics), pix_fmts)
+
+    def start_batch(self, indexes, metrics):
+        """
+        Queue a job computing `metrics` for all the distorded videos at `indexes`
+        in a single ffmpeg graph: the reference is decoded once and split between them.
+        """
+        renditions = [self.model.distordedList[index] for index in indexes]
+        frame, start = self.resume(indexes, metrics)
+
+        args = build_batch_args(
+            self.reference.video_path,
+            [distorded.video_path for distorded in renditions],
+            list(metrics),
+            start=start,
         )
+        job = Job(args, MetadataParser(), renditions, metrics, frame_offset=frame)
+        return self.add_job(job)
+
+    def add_job(self, job: Job):
+        job.parsed.connect(self.handle_records)
+        job.progress.connect(self.handle_fps)
+        self.total_jobs += 1
+        self.run_jobs.append(job)
+        self.jobsPanel.set_jobs(self.run_jobs)
+        self.queue.add(job)
+        return job
 
     def start_SSIM(self, index):
-        # Build the arguments for SSIM for the given index
-        args = [
-            "-i",
-            self.model.distordedList[index].video_path,
-            "-t",
-            "60",
-            "-i",
-            self.reference.video_path,
-            "-t",
-            "60",
-            "-lavfi",
-            "ssim=stats_file=-",
-            "-f",
-            "null",
-            "-",
-        ]
+        return self.start_job(index, ["ssim"])
+
+    def start_PSNR(self, index):
+        return self.start_job(index, ["psnr"])
 
-        self.start_process(
-            self.plotWindow.reset_ssim,
-            lambda: self.handle_stdout_SSIM(index),
-            self.handle_stderr_SSIM,
-            self.SSIM_finished,
-            self.model.distordedList[index].frames,
-            self.model.distordedList[index].ssim_values,
-            "ssim_values",
-            args,
-            index,
+    def start_metrics(self, index, metrics=("ssim", "psnr")):
+        """
+        Compute every metric of `metrics` for the given index with a single ffmpeg process.
+        Both videos are decoded once, and the stats of each branch are demultiplexed
+        by parse_metrics_line.
+        """
+        return self.start_job(index, list(metrics))
+
+    def handle_fps(self, job: Job, fps: float):
+        # Sum of the fps of all the running jobs
+        total = sum(running.fps for running in self.queue.running)
+        text = f"Fps: {total:g} ({len(self.queue.running)} jobs)"
+        remaining = sum(
+            max(self.job_frames(queued) - self.job_progress(queued), 0)
+            for queued in self.queue.jobs()
+        )
+        if total and remaining:
+            minutes, seconds = divmod(int(remaining / total), 60)
+            text += f" ETA: {minutes}:{seconds:02d}"
+        self.speed.setText(text)
+
+    def handle_records(self, job: Job, batches: list):
+        updated = set()
+        for metric, columns in batches:
+            distorded = job.rendition(columns)
+            distorded.extend(metric, columns)
+            updated.add((distorded, metric))
+
+        for distorded, metric in updated:
+            if distorded not in self.model.distordedList:
+                continue  # The video was removed while its job was running
+            index = self.model.distordedList.index(distorded)
+            self.plotWindow.update_series(metric, getattr(distorded, metric), index)
+        for distorded in {distorded for distorded, _ in updated}:
+            self.model.refresh(distorded)
+        self.update_progress()
+
+    def job_videos(self, job: Job):
+        """Distorded videos a job scores. Segment jobs store their values in parts of their own."""
+        if job in self.segment_jobs:
+            return [self.segment_jobs[job][0].distorded]
+        return job.renditions
+
+    def scored_frames(self, renditions):
+        """Number of frames scored for the renditions, 0 until the videos are probed."""
+        videos = [self.reference, *renditions]
+        counts = [video.frame_count for video in videos if video.frame_count]
+        if not counts:
+            return 0
+        # ffmpeg stops at the end of the shortest input, or after DURATION
+        fps = max(video.fps for video in videos)
+        if fps:
+            counts.append(int(float(DURATION) * fps))
+        return min(counts)
+
+    def title_frames(self, renditions):
+        """Number of frames of the shortest of the reference and the renditions, 0 until they are probed."""
+        counts = [video.frame_count for video in (self.reference, *renditions) if video.frame_count]
+        return min(counts, default=0)
+
+    def job_frames(self, job: Job):
+        """Number of frames a job scores, 0 until its videos are probed."""
+        if job in self.segment_jobs:
+            score, i = self.segment_jobs[job]
+            return score.segments[i][1]
+        if job.frames is not None:
+            # Sampled jobs progress through the source frames up to the last sampled one
+            return int(job.frames[-1])
+        return max(self.scored_frames(job.renditions) - job.frame_offset, 0)
+
+    def job_progress(self, job: Job):
+        """Number of frames a job has scored."""
+        return max(job.last_frame - job.frame_offset, 0)
+
+    def update_progress(self):
+        if not self.total_jobs:
+            return
+        running = sum(
+            min(self.job_progress(job) / frames, 1)
+            for job in self.queue.running
+            if (frames := self.job_frames(job))
+        )
+        self.progress.setValue(
+            int((self.done_jobs + running) * 100 / self.total_jobs)
         )
 
-    def start_PSNR(self, index):
-        # Build the arguments for SSIM for the given index
-        args = [
-            "-i",
-            self.model.distordedList[index].video_path,
-            "-t",
-            "60",
-            "-i",
-            self.reference.video_path,
-            "-t",
-            "60",
-            "-lavfi",
-            "psnr=stats_file=-",
-            "-f",
-            "null",
-            "-",
+    def pending_metrics(self, distorded: Distorded, metrics=None):
+        """Metrics of `metrics` (all by default) not computed yet for a video, and not handled by a queued job."""
+        active = [
+            metric
+            for job in self.queue.jobs()
+            if distorded in self.job_videos(job)
+            for metric in job.metrics
+        ]
+        return [
+            metric
+            for metric in (self.metrics if metrics is None else metrics)
+            if metric in self.metrics
+            and not getattr(distorded, f"{metric}_computed") and metric not in active
         ]
 
-        self.start_process(
-            self.plotWindow.reset_psnr,
-            lambda: self.handle_stdout_PSNR(index),
-            self.handle_stderr_PSNR,
-            self.PSNR_finished,
-            self.psnr_frames,
-            self.psnr_values,
-            "psnr_values",
-            args,
-            index,
+    def process_finished(self):
+        """
+        Queue a job for every metric that is not computed yet.
+        The queue runs them concurrently and emits drained once everything is done.
+        """
+        log.info("Got into process_finished")
+        self.load_cached()
+        if self.sampling is not None:
+            self.schedule_preview()
+        if self.segment_mode:
+            self.schedule_segments()
+        # Batches share a decode of the reference between ffmpeg filters
+        if self.batch_mode and self.engine == "ffmpeg":
+            self.schedule_batches()
+        for index, distorted_video in enumerate(self.model.distordedList):
+            metrics = self.pending_metrics(distorted_video, STATS_METRICS)
+            if not metrics:
+                continue
+            if self.single_pass:
+                self.start_metrics(index, metrics)
+                log.info(f"Starting {', '.join(metrics)} for index {index}")
+            else:
+                for metric in metrics:
+                    self.start_job(index, [metric])
+                    log.info(f"Starting {metric} for index {index}")
+        # VMAF is the slowest, it is queued after the other metrics
+        for index, distorted_video in enumerate(self.model.distordedList):
+            if self.pending_metrics(distorted_video, ["vmaf"]):
+                self.start_VMAF(index)
+
+        if not self.queue.is_busy():
+            self.all_done()
+
+    def cache_key(self, distorded: Distorded, metric: str, batch: bool = False):
+        """Cache key of the values of `metric` for `distorded`, `batch` if they come from a batch graph."""
+        options = score_settings(metric, self.engine, self.vmaf_options, batch)
+        window = DURATION if self.sampling is None else str(self.sampling)
+        return self.cache.key(
+            self.reference.video_path, distorded.video_path, metric, options, window=window
         )
 
-    def handle_stderr(self, process: QProcess):
-        data = process.readAllStandardError()
-        stderr = bytes(data).decode("utf8")
-        # Extract progress if it is in the data.
-        speed = simple_fps_parser(stderr)
-        if speed:
-            self.speed.setText(f"Fps: {speed}")
-        else:
-            # self.message(stderr)
-            pass
-
-    def handle_stderr_SSIM(self):
-        self.handle_stderr(self.p)
-
-    def handle_stderr_PSNR(self):
-        self.handle_stderr(self.p)
-
-    def handle_stdout(
-        self,
-        process: QProcess,
-        frames_data: list,
-        fps_data: list,
-        plot_to_update,
-        index,
-        parser,
-        metric_to_update: str,
-    ):
-        data = process.readAllStandardOutput()
-        stdout = bytes(data).decode("utf8")
-
-        # Ajouter les nouvelles données au buffer
-        self.stdout_buffer += stdout
-
-        # Traiter chaque ligne complète
-        lines = self.stdout_buffer.split("\n")
-        # Garder la dernière ligne potentiellement incomplète dans le buffer
-        self.stdout_buffer = lines.pop() if lines else ""
-
-        for line in lines:
-            if line.strip():  # Ignorer les lignes vides
-                ssim_values = parser(line)
-                if ssim_values:
-                    frames_data.append(ssim_values["frame"])
-                    fps_data.append(ssim_values["All"])
-                    getattr(self.model.distordedList[index], metric_to_update).append(
-                        ssim_values["All"]
-                    )
-                    if not (
-                        self.model.distordedList[index].ssim_computed
-                        or self.model.distordedList[index].psnr_computed
-                    ):
-                        getattr(
-                            self.model.distordedList[index],"frames"
-                        ).append(ssim_values["frame"])
-                    """ self.model.distordedList[index].frames.append(ssim_values["frame"])
-                    self.model.distordedList[index].ssim_values.append(
-                        ssim_values["All"]
-                    )
- """
-                    # TODO : Broken since we compute multiple times
-                    # Mettre à jour la barre de progression si vous connaissez le nombre total de frames
-                    # Si vous connaissez le nombre total de frames (total_frames):
-                    self.progress.setValue(int(ssim_values["frame"] * 100 / 5202))
-                    plot_to_update(
-                        frames_data, fps_data, index
-                    )  # Mettre à jour le graphique
-                else:
-                    log.error(f"Failed to parse line: {line.strip()}")
-                    # self.message(f"Failed to parse line: {line.strip()}")
-
-    def handle_stdout_SSIM(self, index):
-        self.handle_stdout(
-            self.p,
-            self.SSIM_frames,
-            self.ssim_values,
-            self.plotWindow.update_SSIM_data,
-            index,
-            parse_ssim_values,
-            "ssim_values",
+    def load_cached(self):
+        """Load the pending metrics already computed by a previous run from the cache."""
+        for index, distorded in enumerate(self.model.distordedList):
+            for metric in self.pending_metrics(distorded):
+                cached = self.cache.get(self.cache_key(distorded, metric, self.batch_mode))
+                if cached is None:
+                    continue
+                log.info(f"Loaded {metric} for {distorded.video_path} from the cache")
+                distorded.reset_values([metric])
+                getattr(distorded, metric).extend(*cached)
+                setattr(distorded, f"{metric}_computed", True)
+                if self.plots is not None:
+                    self.plots.reset(metric, index)
+                self.plotWindow.update_series(metric, getattr(distorded, metric), index)
+        self.model.layoutChanged.emit()
+
+    def schedule_segments(self):
+        """
+        Split the pending pairs in segments, so that every job slot is used.
+        Pairs are only split once the videos are probed, and when there are fewer of them than slots.
+        """
+        pending = [
+            (index, metrics)
+            for index, distorded in enumerate(self.model.distordedList)
+            if (metrics := self.pending_metrics(distorded, STATS_METRICS))
+        ]
+        if not pending or not self.reference.fps:
+            return
+        count = self.queue.max_jobs // len(pending)
+        if count < 2:
+            return
+        for index, metrics in pending:
+            self.start_segments(index, metrics, count)
+
+    def start_segments(self, index, metrics, count):
+        """Queue `count` jobs scoring the segments of the pair at `index`, see segments.py."""
+        distorded = self.model.distordedList[index]
+        frame_count = self.scored_frames([distorded])
+        if not frame_count:
+            return
+        distorded.reset_values(metrics)
+        for metric in metrics:
+            if self.plots is not None:
+                self.plots.reset(metric, index)
+
+        build, parser = self.stats_job(metrics, distorded)
+        score = SegmentedScore.split(
+            distorded, metrics, frame_count, count, self.reference.keyframes, build=build
         )
+        self.add_segment_jobs(score, parser)
+        log.info(f"Starting {', '.join(metrics)} for index {index} in {len(score.segments)} segments")
+
+    def add_segment_jobs(self, score: SegmentedScore, parser):
+        """Queue a job for every segment of `score`, `parser` makes the parser of each job."""
+        for i, (args, start) in enumerate(score.args(self.reference.video_path, self.reference.fps)):
+            job = Job(args, parser(), [score.parts[i]], score.metrics, frame_offset=start)
+            self.segment_jobs[job] = (score, i)
+            self.add_job(job)
+
+    def schedule_preview(self):
+        """Queue the sampled jobs of every pending pair, see sampling.py."""
+        for index, distorded in enumerate(self.model.distordedList):
+            metrics = self.pending_metrics(distorded, STATS_METRICS)
+            if metrics:
+                self.start_preview(index, metrics)
+
+    def start_preview(self, index, metrics):
+        """
+        Queue the jobs scoring the frames of the pair at `index` picked by self.sampling, over the whole title.
+        Pairs that are not probed yet are scored in full.
+        """
+        distorded = self.model.distordedList[index]
+        frame_count = self.title_frames([distorded])
+        fps = self.reference.fps or distorded.fps
+        if not (frame_count and fps):
+            log.warning(f"Can't sample {distorded.video_path} before it is probed, scoring every frame")
+            return
+        keyframes = ()
+        if self.sampling.strategy == "keyframes":
+            try:
+                keyframes = self.prober.keyframes(distorded.video_path, distorded.fps or fps)
+            except ProbeError as e:
+                log.warning(f"Can't read the keyframes of {distorded.video_path}: {e}")
+                return
+        distorded.reset_values(metrics)
+        for metric in metrics:
+            if self.plots is not None:
+                self.plots.reset(metric, index)
+
+        build, parser = self.stats_job(metrics, distorded)
+        if self.sampling.strategy == "windows":
+            # Windows are read past DURATION, until the end of the title
+            score = SegmentedScore(
+                distorded,
+                metrics,
+                self.sampling.segments(frame_count, fps),
+                build=build,
+                options={"duration": None},
+                to_end=False,
+            )
+            self.add_segment_jobs(score, parser)
+        else:
+            frames = self.sampling.frames(frame_count, keyframes)
+            if not len(frames):
+                log.warning(f"No frame of {distorded.video_path} to sample, scoring every frame")
+                return
+            args = build(
+                distorded.video_path,
+                self.reference.video_path,
+                list(metrics),
+                **self.sampling.job_args(frames, fps),
+            )
+            self.add_job(Job(args, parser(), [distorded], metrics, frames=frames + 1))
+        log.info(f"Starting {', '.join(metrics)} for index {index} on {self.sampling} frames")
 
-    def handle_stdout_PSNR(self, index):
-        self.handle_stdout(
-            self.p,
-            self.psnr_frames,
-            self.psnr_values,
-            self.plotWindow.update_PSNR_data,
-            index,
-            parse_psnr_values,
-            "psnr_values",
+    def start_VMAF(self, index):
+        """
+        Queue the jobs computing VMAF for the distorded video at `index`, with the libvmaf options of vmaf_options.
+        libvmaf only writes its log when it is closed: once the videos are probed, they are scored in
+        chunks of VMAF_CHUNK_FRAMES frames, stitched like segments, so the curve is drawn while the
+        video is scored and libvmaf never holds the features of a whole long video.
+        """
+        distorded = self.model.distordedList[index]
+        distorded.reset_values(["vmaf"])
+        if self.plots is not None:
+            self.plots.reset("vmaf", index)
+        frame_count = self.scored_frames([distorded])
+
+        if VMAF_LOG_PATH is None or not (frame_count and self.reference.fps):
+            # A single job, its log is parsed when it ends
+            log_path = VMAF_LOG_PATH
+            if log_path is None:
+                log_path = os.path.join(tempfile.gettempdir(), f"pyvqm-vmaf-{os.getpid()}-{index}.csv")
+            args = build_vmaf_args(
+                distorded.video_path, self.reference.video_path, options=self.vmaf_options, log_path=log_path
+            )
+            parser = VmafParser(None if log_path == VMAF_LOG_PATH else log_path)
+            log.info(f"Starting vmaf for index {index}")
+            return self.add_job(Job(args, parser, [distorded], ["vmaf"]))
+
+        step = vmaf_options(self.vmaf_options)["n_subsample"]
+        score = SegmentedScore.split(
+            distorded,
+            ["vmaf"],
+            frame_count,
+            -(-frame_count // VMAF_CHUNK_FRAMES),
+            self.reference.keyframes,
+            # The motion feature compares each frame with the previous and the next one
+            overlap=(step, 1),
+            step=step,
+            build=build_vmaf_args,
+            options={"options": self.vmaf_options},
         )
+        self.add_segment_jobs(score, VmafParser)
+        log.info(f"Starting vmaf for index {index} in {len(score.segments)} chunks")
 
-    def handle_state(self, state):
-        states = {
-            QProcess.NotRunning: "Not running",
-            QProcess.Starting: "Starting",
-            QProcess.Running: "Running",
-        }
-        state_name = states[state]
-        # self.message(f"State changed: {state_name}")
+    def segment_finished(self, job: Job):
+        """Stitches the values of a segment job, the metrics are computed once every segment is."""
+        score, i = self.segment_jobs.pop(job)
+        if score.failed:
+            return
+        if not score.finish(i):
+            self.segment_failed(score)
+            return
+        distorded = score.distorded
+        if distorded in self.model.distordedList:
+            index = self.model.distordedList.index(distorded)
+            for metric in score.metrics:
+                self.plotWindow.update_series(metric, getattr(distorded, metric), index)
+            self.model.refresh(distorded)
+        if score.done():
+            for metric in score.metrics:
+                log.info(f"Setting {metric}_computed for {distorded.video_path} to True")
+                setattr(distorded, f"{metric}_computed", True)
+                series = getattr(distorded, metric)
+                self.cache.put(self.cache_key(distorded, metric), series.frames, series.values)
+            self.model.layoutChanged.emit()
 
-    def process_finished(self, process: QProcess):
+    def segment_failed(self, score: SegmentedScore):
+        """Cancels the other segments of a pair. The segments already stitched are kept, to be resumed."""
+        score.failed = True
+        for job, (other, _) in list(self.segment_jobs.items()):
+            if other is score:
+                self.queue.cancel(job)
+        for metric in score.metrics:
+            setattr(score.distorded, f"{metric}_computed", False)
 
-        log.info("Got into process_finished")
-        if self.p is not None:
-            log.info("self.p is NOT None, process is stil running. Aborting")
+    def schedule_batches(self):
+        """
+        Group the distorded videos missing the same metrics, and queue them in batches
+        as large as the memory budget allows.
+        """
+        groups = {}
+        for index, distorted_video in enumerate(self.model.distordedList):
+            metrics = tuple(self.pending_metrics(distorted_video, STATS_METRICS))
+            if metrics:
+                groups.setdefault(metrics, []).append(index)
+
+        batch_size = max_batch_size(
+            self.reference.width, self.reference.height, self.memory_budget
+        )
+        for metrics, indexes in groups.items():
+            if len(indexes) == 1:
+                continue  # Nothing to share, scored as a single video
+            for start in range(0, len(indexes), batch_size):
+                batch = indexes[start : start + batch_size]
+                self.start_batch(batch, list(metrics))
+                log.info(f"Starting {', '.join(metrics)} for indexes {batch}")
+
+    def job_done(self, job: Job):
+        self.done_jobs += 1
+        # Frame rate read from the stream description of ffmpeg, to resume the next jobs
+        for distorded in self.job_videos(job):
+            if not distorded.fps and job.input_fps:
+                distorded.fps = job.input_fps
+
+    def job_finished(self, job: Job):
+        self.job_done(job)
+        if job in self.segment_jobs:
+            self.segment_finished(job)
+            self.update_progress()
+            return
+        batch = isinstance(job.parser, MetadataParser)
+        for distorded in job.renditions:
+            for metric in job.metrics:
+                log.info(f"Setting {metric}_computed for {distorded.video_path} to True")
+                setattr(distorded, f"{metric}_computed", True)
+                series = getattr(distorded, metric)
+                self.cache.put(self.cache_key(distorded, metric, batch), series.frames, series.values)
+        self.model.layoutChanged.emit()
+        self.update_progress()
+
+    def job_failed(self, job: Job, reason: str):
+        self.job_done(job)
+        paths = ", ".join(distorded.video_path for distorded in self.job_videos(job))
+        log.error(f"{', '.join(job.metrics)} on {paths} failed: {reason}")
+        if job in self.segment_jobs:
+            score, _ = self.segment_jobs.pop(job)
+            if not score.failed:
+                self.segment_failed(score)
+            self.update_progress()
+            return
+        for distorded in job.renditions:
+            for metric in job.metrics:
+                setattr(distorded, f"{metric}_computed", False)
+        self.update_progress()
+
+    def queue_drained(self):
+        if self.stop:
             return
+        self.all_done()
 
-        if getattr(self, "p", None) is None:
-            # Iterate over distorted videos to check SSIM computation
-            for index, distorted_video in enumerate(self.model.distordedList):
-                if not distorted_video.ssim_computed:
-                    self.start_SSIM(index=index)
-                    log.info(f"Starting SSIM for index {index}")
-                    return  # Exit the method after starting the process
-            # If all SSIM computations are done, check PSNR
-            for index, distorted_video in enumerate(self.model.distordedList):
-                if not distorted_video.psnr_computed:
-                    self.start_PSNR(index=index)
-                    log.info(f"Starting PSNR for index {index}")
-                    return  # Exit the method after starting the process
-
-            # self.message("All process completed. Nothing to do")
+    def all_done(self):
+        self.runButton.pressed.disconnect()
+        self.runButton.pressed.connect(self.start_compute)
+        if all(not self.pending_metrics(d) for d in self.model.distordedList):
             log.info("All process completed. Hanging out, chill there")
             self.runButton.setText("All done")
-            self.runButton.pressed.disconnect()
-            self.runButton.pressed.connect(self.start_compute)
+            self.progress.setValue(100)
             self.runButton.setEnabled(False)
-
-    def SSIM_finished(self, p: QProcess, index: int, exitCode, exitStatus):
-        if self.p is None:
-            # If we are here, it means the process is killed
-            log.info("Process killed in SSIM_finished, exiting")
-            return
-
-        if exitStatus == QProcess.ExitStatus.NormalExit and exitCode == 0:
-            # self.message("SSIM process finished successfully.")
-            log.info(f"Setting ssim_computed  for index {index} to True")
-            self.model.distordedList[index].ssim_computed = True
-            self.p.waitForFinished()
-            self.p = None
-            self.process_finished(p)
         else:
-            log.error("SSIM process finished with an error.")
-            log.info(f"Setting ssim_computed  for index {index} to False")
-            self.model.distordedList[index].ssim_computed = False
-            return  # Stop the process if it crashed
-
-    def PSNR_finished(self, p: QProcess, index: int, exitCode, exitStatus):
-        if self.p is None:
-            # If we are here, it means the process is killed
-            log.info("Process killed in PSNR_finished, exiting")
-            return
+            # Some jobs failed, let the user run them again
+            self.runButton.setText("Run !")
 
-        if exitStatus == QProcess.ExitStatus.NormalExit and exitCode == 0:
-            # self.message("PSNR process finished successfully.")
-            log.info(f"Setting psnr_computed  for index {index} to True")
-            self.model.distordedList[index].psnr_computed = True
-            self.p.waitForFinished()
-            self.p = None
-            self.process_finished(p)
+    def run_report(self):
+        """Telemetry of the jobs of the current run, see telemetry.run_report."""
+        return run_report(
+            [(job.describe(), job.state, job.telemetry) for job in self.run_jobs],
+            render={
+                "ticks": self.plots.render_count if self.plots else 0,
+                "time": self.plots.render_time if self.plots else 0.0,
+            },
+        )
 
-        else:
-            log.error("PSNR process finished with an error.")
-            log.info(f"Setting psnr_computed  for index {index} to False")
-            self.model.distordedList[index].psnr_computed = False
-            return
+    def export_report(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export run report", "run-report.json", "JSON (*.json)")
+        if path:
+            write_report(path, self.run_report())
+            log.info(f"Run report written to {path}")
 
     def start_compute(self):
         self.stop = False
+        self.total_jobs = 0
+        self.done_jobs = 0
+        self.run_jobs = []
+        self.jobsPanel.set_jobs(self.run_jobs)
         self.runButton.setText("Stop")
         self.runButton.pressed.disconnect()
         self.runButton.pressed.connect(self.stop_compute)
-        self.process_finished(self.p)
+        self.process_finished()
 
     def stop_compute(self):
-        if self.p is not None and self.p.state() != QProcess.NotRunning:
-            log.info("Stopping process...")
-            self.p.kill()
-            self.p.waitForFinished()
-            self.p = None
+        self.stop = True
+        if self.queue.is_busy():
+            log.info("Stopping processes...")
+            self.queue.cancel_all()
         else:
             log.info("No process is running to stop.")
         self.runButton.setText("Execute")
         self.runButton.pressed.disconnect()
         self.runButton.pressed.connect(self.start_compute)
-
-
-
@@ -10,11 +10,21 @@ from PySide6.QtWidgets import (
     QTabWidget,
 )
 
+from PySide6.QtCore import QTimer
+
 import pyqtgraph as pg
 import logging
+import time
+
+from stats import describe
 
 log = logging.getLogger("rich")
 
+# Number of plot refreshes per second while values are computed
+REFRESH_RATE = 25
+# Width of a plot that is not laid out yet, in pixels
+DEFAULT_WIDTH = 1000
+
 
 class PlotWindow(QMainWindow):
     def __init__(self, parent=None):
@@ -67,31 +77,62 @@ class PlotWindow(QMainWindow):
             pg.mkPen(color=(0, 0, 255)),
         ]
 
+        # Latest data of each curve not drawn yet, pushed by the render tick
+        self.pending = {}
+        # Ticks that drew something, and the time they took, for the run report
+        self.render_count = 0
+        self.render_time = 0.0
+        # Series drawn by each curve, drawn again when the visible range changes
+        self.sources = {}
+        for widget in (self.graphWidgetSSIM, self.graphWidgetPSNR, self.graphWidgetVMAF):
+            view = widget.getViewBox()
+            view.sigXRangeChanged.connect(lambda view, _, widget=widget: self.range_changed(widget))
+            view.sigResized.connect(lambda view, widget=widget: self.range_changed(widget))
+        self.render_timer = QTimer(self)
+        self.render_timer.setInterval(1000 // REFRESH_RATE)
+        self.render_timer.timeout.connect(self.render)
+        self.render_timer.start()
+        # Curves of the other tabs are drawn when their tab is shown
+        self.tabs.currentChanged.connect(lambda _: self.render())
+
     def reset_all(self, index):
-        self.data_linesSSIM[index].clear()
-        self.data_linesPSNR[index].clear()
-        self.data_linesVMAF[index].clear()
+        for metric in ("ssim", "psnr", "vmaf"):
+            self.reset(metric, index)
+
+    def pen(self, index):
+        if index < len(self.pens):
+            return self.pens[index]
+        # Past the first pens, spread the colors over the hues
+        return pg.mkPen(color=pg.intColor(index, hues=9, values=2))
+
+    def plot_curve(self, graphWidget, name, index):
+        # Series are drawn from their level of detail pyramid, which only gives the visible
+        # points, the min and max of each bucket when there are more than pixels
+        return graphWidget.plot(
+            self.x,
+            self.y,
+            pen=self.pen(index),
+            name=name,
+            skipFiniteCheck=True,
+        )
 
     def add_plot(self, name: str):
         len_data_lines = len(self.data_linesSSIM)
         self.data_linesSSIM.append(
-            self.graphWidgetSSIM.plot(
-                self.x, self.y, pen=self.pens[len_data_lines], name=name
-            )
+            self.plot_curve(self.graphWidgetSSIM, name, len_data_lines)
         )
         self.data_linesPSNR.append(
-            self.graphWidgetPSNR.plot(
-                self.x, self.y, pen=self.pens[len_data_lines], name=name
-            )
+            self.plot_curve(self.graphWidgetPSNR, name, len_data_lines)
         )
         self.data_linesVMAF.append(
-            self.graphWidgetVMAF.plot(
-                self.x, self.y, pen=self.pens[len_data_lines], name=name
-            )
+            self.plot_curve(self.graphWidgetVMAF, name, len_data_lines)
         )
 
     def remove_plot(self, index):
         if index < len(self.data_linesSSIM):
+            for metric in ("ssim", "psnr", "vmaf"):
+                self.pending.pop(self.lines(metric)[index], None)
+                self.sources.pop(self.lines(metric)[index], None)
             self.data_linesSSIM[index].setData([], [])
             self.data_linesPSNR[index].setData([], [])
             self.data_linesVMAF[index].setData([], [])
@@ -105,20 +146,116 @@ class PlotWindow(QMainWindow):
             log.info(self.data_linesSSIM)
             log.info(len(self.data_linesSSIM))
 
+    def lines(self, metric):
+        """Returns the data lines of a metric."""
+        return {
+            "ssim": self.data_linesSSIM,
+            "psnr": self.data_linesPSNR,
+            "vmaf": self.data_linesVMAF,
+        }[metric]
+
+    def reset(self, metric, index):
+        curve = self.lines(metric)[index]
+        self.pending.pop(curve, None)
+        self.sources.pop(curve, None)
+        curve.clear()
+        self.update_legend(curve)
+
+    def update_data(self, metric, x, y, index):
+        """
+        Marks a curve as dirty. It is only drawn by the next render tick,
+        so parsing many frames between two ticks costs a single setData.
+        """
+        curve = self.lines(metric)[index]
+        self.sources.pop(curve, None)
+        self.pending[curve] = (x, y)
+
+    def update_series(self, metric, series, index):
+        """
+        Marks a curve as drawing the "All" values of a series.Series, see update_data.
+        Only the points of its visible range are drawn, from the pyramid of the series.
+        """
+        curve = self.lines(metric)[index]
+        self.sources[curve] = series
+        self.pending[curve] = series
+
+    def update_legend(self, curve, series=None):
+        """Shows the summary of the series of a curve (see stats.py) after its name in the legend."""
+        for widget, metric in (
+            (self.graphWidgetSSIM, "ssim"),
+            (self.graphWidgetPSNR, "psnr"),
+            (self.graphWidgetVMAF, "vmaf"),
+        ):
+            label = widget.getPlotItem().legend.getLabel(curve)
+            if label is not None:
+                text = describe(series.summary(), metric) if series is not None else ""
+                label.setText(f"{curve.name()}  {text}" if text else curve.name())
+                return
+
+    def range_changed(self, widget):
+        """The visible range of a plot changed, its series are drawn again at the matching level."""
+        for curve in widget.getPlotItem().listDataItems():
+            if curve in self.sources:
+                self.pending[curve] = self.sources[curve]
+
+    def visible_data(self, curve, series):
+        """Points of a series to draw in the visible range of its curve."""
+        view = curve.getViewBox()
+        first = last = None
+        pixels = DEFAULT_WIDTH
+        if view is not None:
+            if not view.autoRangeEnabled()[0]:
+                first, last = view.viewRange()[0]
+            pixels = int(view.width()) or DEFAULT_WIDTH
+        return series.envelope(first, last, pixels)
+
+    def render(self):
+        """
+        Render tick: draws the latest data of every dirty curve of the shown tab.
+        The series of the other tabs are only read when their tab is shown, like the ones of a project.
+        """
+        if not self.pending or not self.isVisible():
+            return
+        start = time.perf_counter()
+        shown = self.tabs.currentWidget().getViewBox()
+        pending, self.pending = self.pending, {}
+        drawn = False
+        for curve, data in pending.items():
+            if curve in self.sources and curve.getViewBox() is not shown:
+                self.pending[curve] = data
+                continue
+            drawn = True
+            if curve in self.sources:
+                x, y = self.visible_data(curve, data)
+                # Only reads the frames added since the last tick
+                self.update_legend(curve, data)
+            else:
+                x, y = data
+            curve.setData(x, y)
+        if not drawn:
+            return
+        self.render_count += 1
+        self.render_time += time.perf_counter() - start
+
+    def showEvent(self, event):
+        # Curves are not drawn while the window is hidden, catch up now
+        super().showEvent(event)
+        self.render()
+
     def reset_ssim(self, index):
-        self.data_linesSSIM[index].clear()
+        self.reset("ssim", index)
 
     def reset_psnr(self, index):
-        self.data_linesPSNR[index].clear()
+        self.reset("psnr", index)
 
     def reset_vmaf(self, index):
-        self.data_linesVMAF[index].clear()
+        self.reset("vmaf", index)
 
     def update_SSIM_data(self, x, y, index):
-        self.data_linesSSIM[index].setData(x, y)
+        self.update_data("ssim", x, y, index)
 
     def update_PSNR_data(self, x, y, index):
-        self.data_linesPSNR[index].setData(x, y)
+        self.update_data("psnr", x, y, index)
 
     def update_VMAF_data(self, x, y, index):
-        self.data_linesVMAF[index].setData(x, y)
+        self.update_data("vmaf", x, y, index)
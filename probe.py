@@ -0,0 +1,241 @@
+"""
+Probing of the media files: resolution, pixel format, frame rate, frame count and duration
+of their first video stream.
+
+The ffprobe of the configured ffmpeg build (see runtime.FFMPEG_COMMAND) is used when it is
+installed, otherwise the stream description that ffmpeg prints when it opens a file is parsed.
+Probes run on a thread pool, and their results are cached by file fingerprint (see
+cache.ResultCache), so a file is only probed once.
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import fingerprint
+from runtime import FFMPEG_COMMAND
+
+log = logging.getLogger("rich")
+
+# Header printed by ffmpeg when it opens a file
+duration_pattern = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+video_stream_pattern = re.compile(r"Stream #0:\d+.*: Video: (.*)")
+resolution_pattern = re.compile(r", (\d{2,5})x(\d{2,5})\b")
+stream_fps_pattern = re.compile(r", ([\d.]+) fps")
+# Timestamp of a frame printed by the showinfo filter
+pts_time_pattern = re.compile(r"pts_time:(-?[\d.]+)")
+
+# Probes run at the same time
+MAX_WORKERS = 4
+
+
+class ProbeError(Exception):
+    pass
+
+
+def parse_rate(rate):
+    """Frame rate from a fraction like "30000/1001", 0 if it is unknown."""
+    numerator, _, denominator = str(rate).partition("/")
+    try:
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def info(width=0, height=0, fps=0.0, frame_count=0, duration=0.0, pix_fmt=""):
+    """Probe result, the frame count is estimated from the duration when the container doesn't tell it."""
+    if not frame_count and duration and fps:
+        frame_count = round(duration * fps)
+    return {
+        "width": width,
+        "height": height,
+        "pix_fmt": pix_fmt,
+        "fps": fps,
+        "frame_count": frame_count,
+        "duration": duration,
+    }
+
+
+def ffprobe_command(ffmpeg_command):
+    """
+    The ffprobe of the build of `ffmpeg_command`: the executable next to it, named like it with
+    "ffprobe" instead of "ffmpeg" (ffprobe.exe, ffprobe-6). None if it doesn't have one.
+    """
+    directory, name = os.path.split(ffmpeg_command)
+    if "ffmpeg" not in name:
+        return None
+    command = os.path.join(directory, name.replace("ffmpeg", "ffprobe", 1))
+    return command if shutil.which(command) else None
+
+
+def ffprobe(path, command="ffprobe"):
+    result = subprocess.run(
+        [
+            command, "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=width,height,pix_fmt,r_frame_rate,avg_frame_rate,nb_frames,duration:format=duration",
+            "-of", "json", path,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise ProbeError(result.stderr.strip() or f"ffprobe exited with code {result.returncode}")
+    output = json.loads(result.stdout)
+    if not output.get("streams"):
+        raise ProbeError(f"No video stream in {path}")
+    stream = output["streams"][0]
+    fps = parse_rate(stream.get("avg_frame_rate")) or parse_rate(stream.get("r_frame_rate"))
+    duration = float(stream.get("duration") or output.get("format", {}).get("duration") or 0)
+    return info(
+        int(stream.get("width", 0)),
+        int(stream.get("height", 0)),
+        fps,
+        int(stream.get("nb_frames") or 0),
+        duration,
+        stream.get("pix_fmt", ""),
+    )
+
+
+def parse_header(output):
+    """Probe result from the header ffmpeg prints on stderr when it opens a file."""
+    stream = video_stream_pattern.search(output)
+    if stream is None:
+        return None
+    width = height = 0
+    resolution = resolution_pattern.search(stream.group(1))
+    if resolution:
+        width, height = int(resolution.group(1)), int(resolution.group(2))
+    fps = stream_fps_pattern.search(stream.group(1))
+    # The pixel format is the second field of the description ("h264 (High), yuv420p(tv, bt709), 1920x1080")
+    fields = re.sub(r"\([^()]*\)", "", stream.group(1)).split(",")
+    pix_fmt = fields[1].strip() if len(fields) > 1 else ""
+    duration = duration_pattern.search(output)
+    seconds = 0.0
+    if duration:
+        hours, minutes, secs = duration.groups()
+        seconds = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+    return info(width, height, float(fps.group(1)) if fps else 0.0, 0, seconds, pix_fmt)
+
+
+def ffmpeg_header(path, command="ffmpeg"):
+    # Without an output, ffmpeg prints the description of the input and exits
+    result = subprocess.run(
+        [command, "-hide_banner", "-nostdin", "-i", path], capture_output=True, text=True
+    )
+    probed = parse_header(result.stderr)
+    if probed is None:
+        lines = result.stderr.strip().splitlines()
+        raise ProbeError(lines[-1] if lines else f"No video stream in {path}")
+    return probed
+
+
+def probe(path, ffmpeg_command=None):
+    """
+    Returns the probe result of a file, raises ProbeError if it can't be read.
+    `ffmpeg_command` is the ffmpeg executable, FFMPEG_COMMAND by default.
+    """
+    ffmpeg_command = ffmpeg_command or FFMPEG_COMMAND
+    command = ffprobe_command(ffmpeg_command)
+    if command:
+        return ffprobe(path, command)
+    return ffmpeg_header(path, ffmpeg_command)
+
+
+def keyframes(path, fps, ffmpeg_command=None):
+    """
+    Numbers of the keyframes of a file, from 0. Only the keyframes are decoded,
+    so this is much faster than reading the whole file.
+    """
+    ffmpeg_command = ffmpeg_command or FFMPEG_COMMAND
+    command = ffprobe_command(ffmpeg_command)
+    if command:
+        result = subprocess.run(
+            [
+                command, "-v", "error", "-skip_frame", "nokey", "-select_streams", "v:0",
+                "-show_entries", "frame=pts_time", "-of", "csv=p=0", path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        times = [line for line in result.stdout.split() if line != "N/A"]
+    else:
+        result = subprocess.run(
+            [
+                ffmpeg_command, "-hide_banner", "-nostdin", "-nostats", "-skip_frame", "nokey",
+                "-i", path, "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        times = pts_time_pattern.findall(result.stderr)
+    if result.returncode:
+        raise ProbeError(f"Can't read the keyframes of {path}")
+    return sorted({round(float(time) * fps) for time in times})
+
+
+class Prober:
+    """
+    Probes files on a thread pool. submit() returns a Future of the probe result.
+    Results are kept by file fingerprint, in memory and in the result cache when one is given.
+    `command` is the ffmpeg executable, FFMPEG_COMMAND by default.
+    """
+
+    def __init__(self, cache=None, max_workers=MAX_WORKERS, command=None):
+        self.cache = cache
+        self.command = command or FFMPEG_COMMAND
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="probe")
+        self.infos = {}  # Probe results by fingerprint
+        self.lock = threading.Lock()
+
+    def submit(self, path):
+        return self.executor.submit(self.probe, path)
+
+    def probe(self, path):
+        try:
+            key = fingerprint(path)
+        except OSError as e:
+            raise ProbeError(f"Can't read {path}: {e.strerror}") from e
+        with self.lock:
+            probed = self.infos.get(key)
+        if probed is None and self.cache is not None:
+            probed = self.cache.get_probe(key)
+            # Probed before the pixel format was read, probe it again
+            if probed is not None and "pix_fmt" not in probed:
+                probed = None
+        if probed is None:
+            probed = probe(path, self.command)
+            log.debug(f"Probed {path}: {probed}")
+            if self.cache is not None:
+                self.cache.put_probe(key, probed)
+        with self.lock:
+            self.infos[key] = probed
+        return probed
+
+    def keyframes(self, path, fps):
+        """Keyframes of a file, see keyframes(). They are cached like the probe results."""
+        try:
+            key = f"{fingerprint(path)}:keyframes"
+        except OSError as e:
+            raise ProbeError(f"Can't read {path}: {e.strerror}") from e
+        with self.lock:
+            frames = self.infos.get(key)
+        if frames is None and self.cache is not None:
+            frames = self.cache.get_probe(key)
+        if frames is None:
+            frames = keyframes(path, fps, self.command)
+            if self.cache is not None:
+                self.cache.put_probe(key, frames)
+        with self.lock:
+            self.infos[key] = frames
+        return frames
+
+    def submit_keyframes(self, path, fps):
+        return self.executor.submit(self.keyframes, path, fps)
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
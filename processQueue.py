@@ -1,26 +1,357 @@
 from collections import deque  # Import the deque class
-from PySide6.QtCore import QProcess, QTimer   # Required imports from PySide6 for handling processes and timers respectively.
-import sys    # For system-specific parameters and functions (like exit codes)
+import asyncio
+import logging
+import os
+import threading
+import time
 
-class ProcessQueue:
-    def __init__(self):
-        self.queue = deque()  # Create a new empty queue of process commands/arguments pairs
-        self.current_process = None   # Initialize the current process to None as we don't have any running processes at start.
+from PySide6.QtCore import QObject, QTimer, Signal  # Required imports from PySide6 for handling processes and signals.
 
-    def add(self, command, args=[]):
-        """Adds a QProcess object with given `command` and arguments to queue."""
-        self.queue.append((command, args))   # Appending tuple of command and argument in the deque (queue).
-        if not self.current_process:  # If there's no process currently running...
-            self.run()    # ... then start one right away!
+from farm import FarmError
+from runtime import FFMPEG_COMMAND, JobResult, background_loop, parse_chunk, run_process, source_batches
+
+log = logging.getLogger("rich")
+
+# Deliveries of the parsed values of a job to the GUI per second, at most
+POST_RATE = 25
+
+
+class Job(QObject):
+    """
+    A single ffmpeg run, with its own process and parser state.
+
+    `parser` is a metrics_parser.StatsParser or MetadataParser: it gets the raw chunks of
+    stdout and returns the list of (metric, columns) they hold, with one array per column.
+    `renditions` are the Distorded videos scored by the job. When there are several
+    of them, the columns hold the index of the rendition they belong to.
+    A job resumed from frame `frame_offset` seeks its inputs there: ffmpeg numbers its frames
+    from 1 again, so `frame_offset` is added to the parsed frame numbers.
+    A sampled job (see sampling.py) only scores the source frames numbered `frames` (from 1),
+    the parsed frame numbers are mapped back to them.
+
+    The process runs on the loop of the runtime (see runtime.run_process and background_loop),
+    which reads and parses its output, so the thread of the job (the GUI) only gets the parsed
+    batches: they pile up while it is busy, and deliver() emits them at most POST_RATE times
+    per second. The signals are emitted on the thread of the job.
+    A job given a farm.Coordinator by the queue runs on one of its workers instead, its values
+    come the same way.
+    """
+
+    parsed = Signal(object, list)  # job, list of (metric, columns) parsed since the last delivery
+    progress = Signal(object, float)  # job, fps reported by ffmpeg
+    finished = Signal(object)  # job
+    failed = Signal(object, str)  # job, reason
+
+    # Emitted from the loop of the runtime, the slots run on the thread of the job
+    posted = Signal()
+    progressed = Signal(float)
+    ended = Signal(object)  # exit code of the process, None if it could not start
+
+    def __init__(self, args, parser, renditions=(), metrics=(), command=None, frame_offset=0, frames=None):
+        super().__init__()
+        self.command = command or FFMPEG_COMMAND
+        self.args = list(args)
+        self.parser = parser
+        self.renditions = list(renditions)
+        self.metrics = list(metrics)
+        self.frame_offset = frame_offset
+        self.frames = frames
+
+        self.running = None  # Future of the process on the loop of the runtime
+        self.task = None  # asyncio task of the process, cancelled to kill it
+        self.stopped = threading.Event()  # Set once the process exited
+        self.last_frame = 0  # Last frame number parsed
+        self.records = 0  # Number of frames successfully parsed
+        self.fps = 0.0
+        self.input_fps = None  # Frame rate of the first input, to seek when the job is resumed
+        self.cancelled = False
+        self.done = False
+        self.error = None  # Reason of the failure
+        self.budget = None  # governor.Budget of the job, when the queue has a governor
+        self.farm = None  # farm.Coordinator running the job on a worker, None to run it here
+        self.result = JobResult()  # Exit code, last lines of stderr and telemetry of the process
+        self.telemetry = self.result.telemetry
+
+        # Batches posted from the loop of the runtime and not delivered yet
+        self.lock = threading.Lock()
+        self.unposted = []
+        self.delivered_at = 0.0
+        self.delivery_scheduled = False
+        self.posted.connect(self.deliver)
+        self.progressed.connect(self.handle_progress)
+        self.ended.connect(self.handle_finished)
+
+    def rendition(self, columns):
+        """Distorded video some parsed columns belong to."""
+        return self.renditions[columns.get("rendition", 0)]
+
+    @property
+    def stderr_tail(self):
+        """Last lines of stderr, to report errors."""
+        return self.result.stderr_tail
+
+    def start(self):
+        """Starts the process of the job, on the loop of the runtime."""
+        self.telemetry.started()
+        self.running = background_loop().submit(self.run())
+
+    async def run(self):
+        # Set before cancelled is read, so cancel() either sees the task or the job never starts
+        self.task = asyncio.current_task()
+        try:
+            if self.cancelled:
+                if self.farm is not None:
+                    # The slot the queue reserved for the job
+                    self.farm.release()
+            elif self.farm is not None:
+                await self.farm.run(
+                    self.command, self.args, self.parser, self.post, self.result, self.progressed.emit, reserved=True
+                )
+            else:
+                await run_process(self.command, self.args, self.parser, self.post, self.result, self.progressed.emit)
+        except FarmError as e:
+            self.error = str(e)
+        except OSError as e:
+            log.debug(f"Can't start {self.command}: {e}")
+        except asyncio.CancelledError:
+            # The process is killed, the job fails as cancelled
+            pass
+        except Exception as e:
+            # The process is killed, like when the job is cancelled
+            log.exception(f"Job {self.describe()} failed")
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            self.input_fps = self.result.input_fps
+            self.stopped.set()
+            self.ended.emit(self.result.returncode)
+
+    def cancel(self):
+        """Kills the process. The job then fails with the reason "Cancelled"."""
+        self.cancelled = True
+        task = self.task
+        if task is not None:
+            background_loop().loop.call_soon_threadsafe(task.cancel)
+
+    def wait(self, msecs=3000):
+        if self.running is not None:
+            self.stopped.wait(msecs / 1000)
+
+    def is_running(self):
+        return self.running is not None and not self.done
+
+    @property
+    def state(self):
+        if self.cancelled:
+            return "cancelled"
+        if self.running is None:
+            return "queued"
+        if not self.done:
+            return "running"
+        return "failed" if self.error else "finished"
+
+    def describe(self):
+        """Metrics and videos of the job, for the jobs panel and the run report."""
+        paths = ", ".join(os.path.basename(distorded.video_path) for distorded in self.renditions)
+        description = f"{', '.join(self.metrics)}: {paths}"
+        if self.frame_offset:
+            description += f" (from frame {self.frame_offset + 1})"
+        if self.frames is not None:
+            description += f" ({len(self.frames)} sampled frames)"
+        if self.result.worker:
+            description += f" on {self.result.worker}"
+        return description
+
+    def parse_chunk(self, chunk, flush=False):
+        """Parses a chunk of stdout and posts its batches, what run_process does with each read."""
+        self.post(parse_chunk(self.parser, chunk, self.telemetry, flush))
+
+    def post(self, batches):
+        """Maps the frame numbers of parsed batches to the source, and posts them to deliver()."""
+        batches = source_batches(batches, self.frame_offset, self.frames)
+        if not batches:
+            return
+        for _, columns in batches:
+            self.last_frame = max(self.last_frame, int(columns["frame"][-1]))
+            self.records += len(columns["frame"])
+        self.telemetry.records = self.records
+        with self.lock:
+            # The batches already posted are delivered with these ones
+            notify = not self.unposted
+            self.unposted += batches
+        if notify:
+            self.posted.emit()
+
+    def deliver(self, force=False):
+        """
+        Emits parsed with the batches posted since the last delivery, at most POST_RATE times
+        per second: a delivery coming sooner is scheduled for later, unless `force`.
+        """
+        wait = self.delivered_at + 1 / POST_RATE - time.monotonic()
+        if wait > 0 and not force:
+            if not self.delivery_scheduled:
+                self.delivery_scheduled = True
+                QTimer.singleShot(int(wait * 1000) + 1, self.scheduled_delivery)
+            return
+        with self.lock:
+            batches, self.unposted = self.unposted, []
+        if not batches:
+            return
+        self.delivered_at = time.monotonic()
+        start = time.perf_counter()
+        self.parsed.emit(self, batches)
+        # The slots are called directly, this is the time the GUI spent on the values
+        self.telemetry.ui_time += time.perf_counter() - start
+
+    def scheduled_delivery(self):
+        # Timers may fire a bit early, this one schedules the next if it does
+        self.delivery_scheduled = False
+        self.deliver()
+
+    def handle_progress(self, fps):
+        self.fps = fps
+        self.progress.emit(self, fps)
+
+    def handle_finished(self, returncode):
+        if self.done:
+            return
+        self.done = True
+        # The values parsed after the last delivery
+        self.deliver(force=True)
+
+        if self.cancelled:
+            self.error = "Cancelled"
+            self.failed.emit(self, self.error)
+        elif self.error is not None:
+            # Set by run(): the farm or the parser failed
+            self.failed.emit(self, self.error)
+        elif returncode is None:
+            self.error = f"Failed to start {self.command}"
+            self.failed.emit(self, self.error)
+        elif returncode == 0:
+            self.finished.emit(self)
+        else:
+            self.error = self.result.error
+            self.failed.emit(self, self.error)
+
+
+class ProcessQueue(QObject):
+    """
+    Runs the queued jobs, with at most `max_jobs` of them at the same time.
+    `max_jobs` defaults to the number of cores of the machine, or to the jobs of the profile of `governor`.
+    A governor.ThreadGovernor gives each job its thread budget when it starts.
+    With a farm.Coordinator, the jobs that don't fit the local slots run on its workers
+    while they have free slots.
+    """
+
+    job_started = Signal(object)
+    job_finished = Signal(object)
+    job_failed = Signal(object, str)
+    drained = Signal()  # Emitted when the last job is done and nothing is queued
+    # Emitted from the loop of the runtime when workers join or leave the farm
+    farm_changed = Signal()
+
+    def __init__(self, max_jobs=None, parent=None, governor=None, farm=None):
+        super().__init__(parent)
+        self.governor = governor
+        self.max_jobs = max_jobs or (governor.max_jobs if governor else os.cpu_count() or 1)
+        self.queue = deque()  # Jobs waiting for a free slot
+        self.running = []  # Jobs currently running
+        self.farm = farm
+        if farm is not None:
+            self.farm_changed.connect(self.run)
+            farm.listeners.append(self.farm_changed.emit)
+
+    def set_max_jobs(self, max_jobs):
+        self.max_jobs = max(1, max_jobs)
+        self.run()
+
+    def add(self, job: Job):
+        """Adds a job to the queue, it starts right away if a slot is free."""
+        job.telemetry.queued()
+        self.queue.append(job)
+        self.run()
 
     def run(self):
-        """Starts next available QProcess object."""
-        if self.current_process and self.current_process.state() == QProcess.Running:  # If there's a process running already...
-            return   # ... then don't start any new ones until it finishes!
-        elif len(self.queue) > 0:    # Else, if the queue is not empty....
-            command, args = self.queue.popleft()  # Pop (remove and return) leftmost element from deque (command & arguments pair).
-            self.current_process = QProcess()   # Initialize a new process object...
-            self.current_process.finished.connect(self.run)    # ... connect its "finished" signal to our run method, so that next process in the queue will start automatically when this one finishes...
-            self.current_process.start(command, args)  # And finally start it!
-        else:   # If there's nothing left in the queue....
-            sys.exit()    # ... then exit our application gracefully (or do anything you want).
\ No newline at end of file
+        """Starts queued jobs until every slot is used, the local ones then the ones of the farm."""
+        while self.queue:
+            if self.local_jobs() >= self.max_jobs:
+                job = self.remote_job()
+                if job is None:
+                    break
+            else:
+                job = self.queue.popleft()
+            if self.governor is not None and job.farm is None:
+                # The jobs queued after this one start with it, as long as there are free slots
+                job.budget = self.governor.acquire(len(self.running) + 1 + len(self.queue))
+                (job.command, *launcher), args = self.governor.apply(job.budget, job.command, job.args)
+                job.args = [*launcher, *args]
+            job.finished.connect(self.handle_job_finished)
+            job.failed.connect(self.handle_job_failed)
+            self.running.append(job)
+            job.start()
+            self.job_started.emit(job)
+
+    def local_jobs(self):
+        """Number of jobs running here."""
+        return sum(1 for job in self.running if job.farm is None)
+
+    def remote_job(self):
+        """First queued job the farm takes, with a slot reserved for it, None if there is none."""
+        if self.farm is None:
+            return None
+        job = next((job for job in self.queue if self.farm.accepts(job.parser)), None)
+        if job is None or not self.farm.reserve():
+            return None
+        self.queue.remove(job)
+        job.farm = self.farm
+        return job
+
+    def jobs(self):
+        """Running and queued jobs."""
+        return self.running + list(self.queue)
+
+    def is_busy(self):
+        return bool(self.running or self.queue)
+
+    def cancel(self, job: Job):
+        """Cancels a job, whether it is running or still waiting in the queue."""
+        if job in self.queue:
+            self.queue.remove(job)
+            job.cancelled = True
+            self.job_failed.emit(job, "Cancelled")
+            self.check_drained()
+        else:
+            job.cancel()
+
+    def cancel_all(self, wait=False):
+        """Cancels every job. With `wait`, blocks until the processes are killed."""
+        while self.queue:
+            self.cancel(self.queue[-1])
+        for job in list(self.running):
+            job.cancel()
+            if wait:
+                job.wait()
+
+    def handle_job_finished(self, job: Job):
+        self.job_done(job)
+        self.job_finished.emit(job)
+        self.run()
+        self.check_drained()
+
+    def handle_job_failed(self, job: Job, reason: str):
+        self.job_done(job)
+        self.job_failed.emit(job, reason)
+        self.run()
+        self.check_drained()
+
+    def job_done(self, job: Job):
+        if job in self.running:
+            self.running.remove(job)
+        if job.budget is not None:
+            self.governor.release(job.budget)
+            job.budget = None
+
+    def check_drained(self):
+        # Unlike before, an empty queue doesn't exit the application
+        if not self.is_busy():
+            self.drained.emit()
@@ -0,0 +1,261 @@
+"""
+Project files: the reference, the distorded videos, the settings of the jobs and every per-frame
+series of a comparison session, so it can be opened again without scoring anything.
+
+Layout of a file:
+
+    preamble  MAGIC, VERSION, and the offset and length of the header (PREAMBLE)
+    blobs     for each series, its frames then its values, compressed with zlib
+    header    JSON table of contents: the videos, the settings, and for each series its number
+              of frames, its summary (see stats.py) and the offset and size of its blobs
+
+The header is written last, so the blobs are streamed to the file as they are compressed.
+Frames are delta-encoded, mostly ones that compress to almost nothing. Values are float32,
+one component after the other, with their bytes shuffled (the first byte of every value,
+then the second...) so the exponents, which barely change, compress well.
+
+Opening a project only reads the preamble and the header: the list is filled at once from
+the summaries, and each series is a StoredSeries read from the file when its values are
+first needed, like when its curve is first drawn.
+"""
+
+import json
+import logging
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from series import COMPONENTS, Series
+from stats import StoredSummary
+from video import Distorded, Reference
+
+log = logging.getLogger("rich")
+
+MAGIC = b"PYVQMPRJ"
+VERSION = 1
+# Magic, version, offset and length of the header
+PREAMBLE = struct.Struct("<8sIQQ")
+EXTENSION = ".pyvqm"
+COMPRESSION_LEVEL = 6
+
+METRICS = ("ssim", "psnr", "vmaf")
+# Fields of the videos stored with them, see probe.probe
+INFO_FIELDS = ("frame_count", "fps", "width", "height", "pix_fmt")
+
+
+class ProjectError(Exception):
+    pass
+
+
+def encode_frames(frames):
+    deltas = np.diff(np.asarray(frames, dtype=np.int64), prepend=0)
+    return zlib.compress(deltas.astype("<i8").tobytes(), COMPRESSION_LEVEL)
+
+
+def decode_frames(blob, count):
+    deltas = np.frombuffer(zlib.decompress(blob), dtype="<i8")
+    if len(deltas) != count:
+        raise ProjectError(f"Expected {count} frames, read {len(deltas)}")
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def encode_values(values):
+    """Values of every component, one row per component, as shuffled float32 bytes."""
+    data = np.ascontiguousarray(values, dtype="<f4")
+    shuffled = data.reshape(-1).view(np.uint8).reshape(-1, 4).T
+    return zlib.compress(shuffled.tobytes(), COMPRESSION_LEVEL)
+
+
+def decode_values(blob, count):
+    data = np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+    if len(data) != count * len(COMPONENTS) * 4:
+        raise ProjectError(f"Expected the values of {count} frames, read {len(data)} bytes")
+    values = np.ascontiguousarray(data.reshape(4, -1).T).view("<f4")
+    return values.reshape(len(COMPONENTS), count).astype(np.float32, copy=False)
+
+
+def read_blobs(path, entry):
+    """Compressed frames and values of the series described by a table of contents `entry`."""
+    blobs = []
+    with open(path, "rb") as file:
+        for name in ("frames", "values"):
+            offset, size = entry[name]
+            file.seek(offset)
+            blob = file.read(size)
+            if len(blob) != size:
+                raise ProjectError(f"{path} is truncated")
+            blobs.append(blob)
+    return blobs
+
+
+class StoredSeries(Series):
+    """
+    Series of a project file, read from it when its values are first needed. Until then, its
+    length and the summary of its "All" values come from the header, so listing it reads nothing.
+    Once read it is a Series like any other, values can be appended to it.
+    """
+
+    __slots__ = ("source", "_count", "_statistics")
+
+    def __init__(self, source, count, statistics=None):
+        super().__init__(capacity=1)
+        self.source = source  # Path of the project and entry of the series, None once read
+        self._count = count
+        self._statistics = statistics  # stats.Summary.to_dict() of the "All" values
+
+    @property
+    def loaded(self):
+        return self.source is None
+
+    def load(self):
+        """Reads the series from its project, on the first call."""
+        if self.source is None:
+            return
+        path, entry = self.source
+        frames_blob, values_blob = read_blobs(path, entry)
+        self._frames = decode_frames(frames_blob, self._count)
+        self._values = decode_values(values_blob, self._count)
+        self._size = self._count
+        self.source = None
+        log.debug(f"Read {self._count} frames from {path}")
+
+    def __len__(self):
+        return self._count if self.source is not None else self._size
+
+    def append(self, frame: int, values: dict):
+        self.load()
+        super().append(frame, values)
+
+    def extend(self, frames, values):
+        self.load()
+        super().extend(frames, values)
+
+    def truncate(self, size: int):
+        self.load()
+        super().truncate(size)
+
+    def summary(self, component: str = "All"):
+        if self.source is not None and component == "All" and self._statistics is not None:
+            return StoredSummary(self._statistics)
+        self.load()
+        return super().summary(component)
+
+    @property
+    def frames(self):
+        self.load()
+        return self._frames[: self._size]
+
+    def column(self, component: str = "All"):
+        self.load()
+        return super().column(component)
+
+    @property
+    def values(self):
+        self.load()
+        return self._values[:, : self._size]
+
+
+class Project:
+    """
+    Contents of a project file: the reference (None if none was chosen), the distorded videos,
+    with their series, and the settings of the jobs.
+    """
+
+    def __init__(self, reference, renditions, settings):
+        self.reference = reference
+        self.renditions = renditions
+        self.settings = settings
+
+
+def video_info(video):
+    return {field: getattr(video, field) for field in INFO_FIELDS}
+
+
+def save_project(path, reference, renditions, settings=None):
+    """
+    Writes a project file. `settings` are the settings of the jobs, anything JSON can store.
+    The series of another project that were never read are copied without decoding them.
+    """
+    temporary = f"{path}.tmp"
+    copied = []  # StoredSeries to read from `path` once it is written
+    with open(temporary, "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, VERSION, 0, 0))
+        videos = []
+        for distorded in renditions:
+            entries = {}
+            for metric in METRICS:
+                series = getattr(distorded, metric)
+                if not len(series):
+                    continue
+                if isinstance(series, StoredSeries) and not series.loaded:
+                    blobs = read_blobs(*series.source)
+                else:
+                    blobs = encode_frames(series.frames), encode_values(series.values)
+                entry = {"count": len(series), "summary": series.summary().to_dict(metric)}
+                for name, blob in zip(("frames", "values"), blobs):
+                    entry[name] = [file.tell(), len(blob)]
+                    file.write(blob)
+                if isinstance(series, StoredSeries) and not series.loaded:
+                    copied.append((series, entry))
+                entries[metric] = entry
+            videos.append(
+                {
+                    "path": distorded.video_path,
+                    "info": video_info(distorded),
+                    "computed": {metric: getattr(distorded, f"{metric}_computed") for metric in METRICS},
+                    "series": entries,
+                }
+            )
+        header = {
+            "reference": None
+            if reference is None
+            else {"path": reference.video_path, "info": video_info(reference)},
+            "settings": settings or {},
+            "videos": videos,
+        }
+        data = json.dumps(header).encode()
+        offset = file.tell()
+        file.write(data)
+        file.seek(0)
+        file.write(PREAMBLE.pack(MAGIC, VERSION, offset, len(data)))
+    os.replace(temporary, path)
+    # Their previous file may have been replaced, they are read from this one now
+    for series, entry in copied:
+        series.source = (path, entry)
+    log.info(f"Project of {len(videos)} videos saved to {path}")
+
+
+def open_project(path):
+    """Reads the header of a project file, see Project. The series are read when needed."""
+    with open(path, "rb") as file:
+        preamble = file.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            raise ProjectError(f"{path} is not a pyvqm project")
+        magic, version, offset, length = PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise ProjectError(f"{path} is not a pyvqm project")
+        if version > VERSION:
+            raise ProjectError(f"{path} was saved by a newer version of pyvqm (format {version})")
+        file.seek(offset)
+        data = file.read(length)
+    if len(data) != length:
+        raise ProjectError(f"{path} is truncated")
+    header = json.loads(data)
+
+    reference = None
+    if header["reference"] is not None:
+        reference = Reference(header["reference"]["path"])
+        reference.set_info(header["reference"]["info"])
+    renditions = []
+    for video in header["videos"]:
+        distorded = Distorded(video["path"])
+        distorded.set_info(video["info"])
+        for metric in METRICS:
+            setattr(distorded, f"{metric}_computed", video["computed"][metric])
+            entry = video["series"].get(metric)
+            if entry is not None:
+                setattr(distorded, metric, StoredSeries((path, entry), entry["count"], entry["summary"]))
+        renditions.append(distorded)
+    return Project(reference, renditions, header["settings"])
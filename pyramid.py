@@ -0,0 +1,142 @@
+"""
+Level of detail index of a series, to plot millions of frames at interactive rates.
+
+Level 0 holds the min, max and sum of the values of each bucket of BUCKET_FRAMES frames,
+and each next level merges FACTOR buckets of the previous one. The plot asks for the level
+matching the visible range and its width in pixels, and draws the min and the max of each
+bucket, so a dip of a few frames is still drawn when zoomed out.
+The pyramid is updated incrementally: only the buckets holding new frames are computed again.
+"""
+
+import numpy as np
+
+# Frames of a bucket of level 0
+BUCKET_FRAMES = 16
+# Buckets of a level merged in a bucket of the next one
+FACTOR = 4
+
+
+class Level:
+    """Min, max and sum of the values of each bucket of `size` frames."""
+
+    __slots__ = ("size", "min", "max", "sum", "count")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.min = np.empty(0, dtype=np.float32)
+        self.max = np.empty(0, dtype=np.float32)
+        self.sum = np.empty(0, dtype=np.float64)
+        self.count = 0  # Buckets holding values
+
+    def update(self, first: int, mins, maxs, sums):
+        """Replaces the buckets from `first` by the ones given."""
+        end = first + len(mins)
+        if end > len(self.min):
+            capacity = max(end, 2 * len(self.min), 64)
+            for name in ("min", "max", "sum"):
+                array = getattr(self, name)
+                grown = np.empty(capacity, dtype=array.dtype)
+                grown[:first] = array[:first]
+                setattr(self, name, grown)
+        self.min[first:end] = mins
+        self.max[first:end] = maxs
+        self.sum[first:end] = sums
+        self.count = end
+
+
+class Pyramid:
+    """
+    Level of detail index of a component of a series (see series.Series.pyramid).
+    `values` are the values of the component, the index covers the first `size` of them.
+    """
+
+    def __init__(self):
+        self.levels = []
+        self.size = 0  # Values covered by the index
+        # Truncated since the last update: the last buckets still hold the values after `size`
+        self.truncated = False
+
+    def truncate(self, size: int):
+        """Forgets the values after the first `size`, they are indexed again by the next update."""
+        if size < self.size:
+            self.size = size
+            self.truncated = True
+
+    def update(self, values):
+        """Indexes the values added since the last update."""
+        count = len(values)
+        if not count:
+            self.levels = []
+            self.size = 0
+            self.truncated = False
+            return
+        if count == self.size and not self.truncated:
+            return
+        self.size = min(self.size, count)
+        # The last bucket of each level may have been partial, it is computed again
+        size = BUCKET_FRAMES
+        start = self.size // size * size
+        chunk = np.asarray(values[start:count])
+        offsets = np.arange(0, len(chunk), size)
+        mins = np.minimum.reduceat(chunk, offsets)
+        maxs = np.maximum.reduceat(chunk, offsets)
+        sums = np.add.reduceat(chunk, offsets, dtype=np.float64)
+        depth = 0
+        while True:
+            if depth == len(self.levels):
+                self.levels.append(Level(size))
+            level = self.levels[depth]
+            first = start // size
+            level.update(first, mins, maxs, sums)
+            if level.count <= 1:
+                break
+            # Buckets of the next level holding the buckets updated on this one
+            size *= FACTOR
+            start = start // size * size
+            child = start // level.size
+            offsets = np.arange(0, level.count - child, FACTOR)
+            mins = np.minimum.reduceat(level.min[child : level.count], offsets)
+            maxs = np.maximum.reduceat(level.max[child : level.count], offsets)
+            sums = np.add.reduceat(level.sum[child : level.count], offsets)
+            depth += 1
+        del self.levels[depth + 1 :]
+        self.size = count
+        self.truncated = False
+
+    def level_for(self, count: int, pixels: int):
+        """Deepest level with at least `pixels` buckets over `count` values, None if the values fit as they are."""
+        if count <= 2 * pixels:
+            return None
+        chosen = None
+        for level in self.levels:
+            if count / level.size < pixels:
+                break
+            chosen = level
+        return chosen or (self.levels[0] if self.levels else None)
+
+    def envelope(self, frames, values, first: int, last: int, pixels: int):
+        """
+        Points to draw the values of indexes `first` to `last` (excluded) on `pixels` pixels:
+        the values themselves when they fit, or the min then the max of each bucket of the
+        matching level, at the frame of the bucket start.
+        """
+        self.update(values)
+        level = self.level_for(last - first, pixels)
+        if level is None:
+            return frames[first:last], values[first:last]
+        begin = first // level.size
+        end = min(-(-last // level.size), level.count)
+        x = np.repeat(frames[np.arange(begin, end) * level.size], 2)
+        y = np.empty(2 * (end - begin), dtype=np.float32)
+        y[0::2] = level.min[begin:end]
+        y[1::2] = level.max[begin:end]
+        return x, y
+
+    def means(self, frames, values, level: int = 0):
+        """Frame of the start and mean of each bucket of a level."""
+        self.update(values)
+        level = self.levels[level]
+        counts = np.full(level.count, level.size)
+        if level.count:
+            counts[-1] = self.size - (level.count - 1) * level.size
+        return frames[np.arange(level.count) * level.size], level.sum[: level.count] / counts
@@ -0,0 +1,565 @@
+"""
+Headless command line interface, to score videos without Qt or a display.
+
+    python -m pyvqm score --ref ref.mp4 --dist a.mp4 b.mp4 --metrics ssim,psnr --output scores.jsonl
+
+`worker` runs the jobs of a GUI started with PYVQM_FARM, see farm.py.
+
+It builds the same ffmpeg jobs as the GUI (filtergraph), and runs them with the same asyncio
+runtime (runtime.Runtime), without Qt: nothing here imports PySide6 or pyqtgraph.
+Per-frame values are written as they are parsed, followed by a summary of each metric,
+as JSON Lines or CSV.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from cache import ResultCache
+from engine import ENGINES, stats_job
+from farm import FARM_TOKEN, Worker
+from governor import PROFILES, ThreadGovernor
+from filtergraph import (
+    DURATION,
+    VMAF_LOG_PATH,
+    build_vmaf_args,
+    score_settings,
+)
+from metrics_parser import MetadataParser, VmafParser
+from probe import Prober, ProbeError
+from project import EXTENSION, save_project
+from runtime import JobError, Runtime, plan_jobs
+from sampling import Sampling
+from segments import SegmentedScore
+from series import COMPONENTS, MappedSeries, Series
+from stats import STATISTICS
+from telemetry import JobTelemetry, run_report, write_report
+from video import Distorded, Reference
+
+log = logging.getLogger("rich")
+
+METRICS = ("ssim", "psnr", "vmaf")
+
+
+def to_list(column):
+    """
+    Values of a column as they are stored in a Series (float32), with their shortest repr,
+    so the values parsed by a job and the ones loaded from the cache are written the same.
+    Missing values (NaN, like the planes of VMAF) are None.
+    """
+    return [None if value != value else float(str(value)) for value in np.asarray(column, dtype=np.float32)]
+
+
+class JsonLinesWriter:
+    """Writes a JSON object per frame and per summary."""
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()  # Jobs write from their own thread
+
+    def frames(self, distorded, metric, columns):
+        values = [to_list(columns[c]) for c in COMPONENTS]
+        lines = []
+        for i, frame in enumerate(columns["frame"].tolist()):
+            record = {"distorted": distorded.video_path, "metric": metric, "frame": frame}
+            record.update((c, values[k][i]) for k, c in enumerate(COMPONENTS))
+            lines.append(json.dumps(record))
+        with self.lock:
+            self.file.write("\n".join(lines) + "\n")
+
+    def summary(self, distorded, metric, summary):
+        record = {"distorted": distorded.video_path, "metric": metric, "summary": summary}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+
+
+class CsvWriter:
+    """
+    Writes a row per frame, then a row for each statistic of the summary:
+    its name is in the "kind" column and the number of frames in the "frame" column.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.writer = csv.writer(file, lineterminator="\n")
+        self.writer.writerow(["kind", "distorted", "metric", "frame", *COMPONENTS])
+
+    def frames(self, distorded, metric, columns):
+        values = [to_list(columns[c]) for c in COMPONENTS]
+        rows = [
+            ["frame", distorded.video_path, metric, frame, *(column[i] for column in values)]
+            for i, frame in enumerate(columns["frame"].tolist())
+        ]
+        with self.lock:
+            self.writer.writerows(rows)
+
+    def summary(self, distorded, metric, summary):
+        with self.lock:
+            for kind in STATISTICS:
+                self.writer.writerow(
+                    [kind, distorded.video_path, metric, summary["frames"],
+                     *(summary[kind][c] for c in COMPONENTS)]
+                )
+
+
+WRITERS = {"jsonl": JsonLinesWriter, "csv": CsvWriter}
+
+
+def summarize(series, metric):
+    """Number of frames, and the statistics of each component of a metric (see stats.Summary)."""
+    statistics = {c: series.summary(c).to_dict(metric) for c in COMPONENTS}
+    summary = {"frames": len(series)}
+    for name in STATISTICS:
+        summary[name] = {
+            c: None if statistics[c][name] != statistics[c][name] else round(float(statistics[c][name]), 6)
+            for c in COMPONENTS
+        }
+    return summary
+
+
+def store(renditions, writer=None):
+    """
+    on_batches of a job (see runtime.Runtime.run): stores the parsed values in the renditions,
+    and writes them as they come when there is a writer.
+    """
+
+    def on_batches(batches):
+        for metric, columns in batches:
+            distorded = renditions[columns.get("rendition", 0)]
+            distorded.extend(metric, columns)
+            if writer is not None:
+                writer.frames(distorded, metric, columns)
+
+    return on_batches
+
+
+def run_job(args, parser, renditions, writer=None, command="ffmpeg", frame_offset=0, telemetry=None, frames=None):
+    """
+    Runs an ffmpeg job until it ends with runtime.run_process, storing the parsed values in the
+    renditions and writing them as they come, when there is a writer. Raises JobError if ffmpeg fails.
+    `frame_offset` and `frames` map the frame numbers to the source, see runtime.source_batches.
+    The job records its telemetry.JobTelemetry in `telemetry` when it is given.
+    `command` is the ffmpeg executable, or the command line before its arguments, like ["nice", "ffmpeg"].
+    """
+    runtime = Runtime(max_jobs=1, command=command)
+    asyncio.run(
+        runtime.run(
+            args,
+            parser,
+            frame_offset=frame_offset,
+            frames=frames,
+            on_batches=store(renditions, writer),
+            telemetry=telemetry,
+        )
+    )
+
+
+async def run_jobs(runtime, jobs, writer, done):
+    """
+    Runs the jobs planned by score() on `runtime`, and calls done(index, telemetry, error) as each
+    of them ends, `error` being the exception of a failed job or None.
+    """
+    tasks = {}
+    for i, (args, parser, group, missing, frame_offset, segment, frames) in enumerate(jobs):
+        telemetry = JobTelemetry()
+        # Segments are written once they are stitched, in order
+        on_batches = store(group, writer if segment is None else None)
+        task = asyncio.ensure_future(
+            runtime.run(
+                args, parser, frame_offset=frame_offset, frames=frames, on_batches=on_batches, telemetry=telemetry
+            )
+        )
+        tasks[task] = (i, telemetry)
+    pending = set(tasks)
+    while pending:
+        finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in sorted(finished, key=lambda task: tasks[task][0]):
+            i, telemetry = tasks[task]
+            done(i, telemetry, task.exception())
+
+
+def plan_segments(reference, distorded, metrics, count, prober, build):
+    """
+    SegmentedScore splitting a pair in `count` segments, None if the videos can't be probed.
+    `build` returns the ffmpeg arguments of a segment, see engine.stats_job.
+    """
+    try:
+        for video in (reference, distorded):
+            video.set_info(prober.probe(video.video_path))
+        if not reference.keyframes and reference.fps:
+            reference.keyframes = prober.keyframes(reference.video_path, reference.fps)
+    except ProbeError as e:
+        log.warning(f"Can't split {distorded.video_path} in segments: {e}")
+        return None
+    counts = [video.frame_count for video in (reference, distorded) if video.frame_count]
+    if not counts or not reference.fps:
+        return None
+    frame_count = min(counts + [int(float(DURATION) * reference.fps)])
+    return SegmentedScore.split(distorded, metrics, frame_count, count, reference.keyframes, build=build)
+
+
+def plan_preview(reference, distorded, metrics, sampling, prober, engine="ffmpeg"):
+    """
+    Jobs scoring the frames of a pair picked by `sampling` (see sampling.py), as
+    (args, parser, renditions, metrics, frame offset, (SegmentedScore, index) or None, sampled frames or None).
+    None if the videos can't be probed.
+    """
+    try:
+        for video in (reference, distorded):
+            if not video.frame_count:
+                video.set_info(prober.probe(video.video_path))
+        fps = reference.fps or distorded.fps
+        keyframes = ()
+        if sampling.strategy == "keyframes" and fps:
+            keyframes = prober.keyframes(distorded.video_path, distorded.fps or fps)
+    except ProbeError as e:
+        log.warning(f"Can't sample {distorded.video_path}: {e}")
+        return None
+    counts = [video.frame_count for video in (reference, distorded) if video.frame_count]
+    if not counts or not fps:
+        log.warning(f"Can't sample {distorded.video_path}: its frame count or frame rate is unknown")
+        return None
+    frame_count = min(counts)
+    pix_fmts = (reference.pix_fmt, distorded.pix_fmt)
+    build, parser = stats_job(engine, reference.width, reference.height, metrics, pix_fmts)
+    if sampling.strategy == "windows":
+        # Windows are read past DURATION, until the end of the title
+        segmented = SegmentedScore(
+            distorded, metrics, sampling.segments(frame_count, fps), build=build, options={"duration": None}, to_end=False
+        )
+        return [
+            (args, parser(), [segmented.parts[i]], metrics, first, (segmented, i), None)
+            for i, (args, first) in enumerate(segmented.args(reference.video_path, fps))
+        ]
+    frames = sampling.frames(frame_count, keyframes)
+    if not len(frames):
+        log.warning(f"Can't sample {distorded.video_path}: no frame to score")
+        return None
+    args = build(distorded.video_path, reference.video_path, list(metrics), **sampling.job_args(frames, fps))
+    return [(args, parser(), [distorded], metrics, 0, None, frames + 1)]
+
+
+def write_stitched(writer, segmented, start):
+    """Writes the frames of a pair stitched after its `start` first segments."""
+    if segmented.stitched == start:
+        return
+    first = segmented.segments[start][0]
+    for metric in segmented.metrics:
+        series = getattr(segmented.distorded, metric)
+        begin = np.searchsorted(series.frames, first + 1)
+        columns = {"frame": series.frames[begin:]}
+        columns.update(zip(COMPONENTS, series.values[:, begin:]))
+        writer.frames(segmented.distorded, metric, columns)
+
+
+def score(options):
+    start = time.perf_counter()
+    metrics = [metric.strip() for metric in options.metrics.split(",") if metric.strip()]
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        log.error(f"Unknown metrics: {', '.join(unknown)}")
+        return 2
+    sampling = None
+    if options.sample:
+        try:
+            sampling = Sampling.parse(options.sample)
+        except ValueError as e:
+            log.error(str(e))
+            return 2
+        if "vmaf" in metrics:
+            log.error("Preview sampling only scores ssim and psnr")
+            return 2
+
+    output_format = options.format
+    if output_format is None:
+        output_format = "csv" if options.output and options.output.endswith(".csv") else "jsonl"
+    output = open(options.output, "w", newline="") if options.output else sys.stdout
+    writer = WRITERS[output_format](output)
+
+    reference = Reference(options.ref)
+    renditions = [Distorded(path, MappedSeries if options.on_disk else Series) for path in options.dist]
+
+    cache = None if options.no_cache else ResultCache()
+    if options.batch or options.engine == "numpy":
+        # The resolution of the reference sets how many videos a batch can hold, and the frame size of the engine
+        prober = Prober(cache, command=options.ffmpeg)
+        # The engine only scores 8 bits 4:2:0, the pixel formats of the encodes are needed too
+        videos = [reference, *renditions] if options.engine == "numpy" else [reference]
+        for video, future in [(video, prober.submit(video.video_path)) for video in videos]:
+            try:
+                video.set_info(future.result())
+            except ProbeError as e:
+                log.warning(f"Can't probe {video.video_path}: {e}")
+        prober.shutdown()
+
+    # Options of libvmaf given on the command line, see filtergraph.VMAF_OPTIONS
+    vmaf = {
+        name: value
+        for name, value in (
+            ("n_threads", options.vmaf_threads),
+            ("n_subsample", options.vmaf_subsample),
+            ("model", options.vmaf_model),
+        )
+        if value is not None
+    }
+
+    def key(distorded, metric, batch=options.batch):
+        # The values of a batch graph are stored apart, a lone video of --batch is scored on its own
+        settings = score_settings(metric, options.engine, vmaf, batch)
+        window = str(sampling) if sampling else DURATION
+        return cache.key(reference.video_path, distorded.video_path, metric, settings, window=window)
+
+    # Load what previous runs already computed, only the pairs missing a metric are scored
+    pending = {}
+    for distorded in renditions:
+        for metric in metrics:
+            cached = cache.get(key(distorded, metric)) if cache else None
+            if cached is None:
+                pending.setdefault(distorded, []).append(metric)
+                continue
+            frames, values = cached
+            getattr(distorded, metric).extend(frames, values)
+            setattr(distorded, f"{metric}_computed", True)
+            writer.frames(distorded, metric, {"frame": frames, **dict(zip(COMPONENTS, values))})
+
+    # VMAF has jobs of its own, the other metrics share their decodes
+    vmaf_pending = [distorded for distorded, missing in pending.items() if "vmaf" in missing]
+    for distorded in vmaf_pending:
+        pending[distorded].remove("vmaf")
+        if not pending[distorded]:
+            del pending[distorded]
+
+    # Jobs as (args, parser, renditions, missing metrics, frame offset, (SegmentedScore, index) or None,
+    # sampled frames or None)
+    jobs = []
+    governor = None
+    if options.threads_profile or options.affinity or options.nice is not None:
+        governor = ThreadGovernor(options.threads_profile or "throughput", affinity=options.affinity, nice=options.nice)
+    workers = options.jobs or (governor.max_jobs if governor else os.cpu_count() or 1)
+
+    failed = 0
+    if sampling:
+        prober = Prober(cache, command=options.ffmpeg)
+        for distorded, missing in list(pending.items()):
+            planned = plan_preview(reference, distorded, missing, sampling, prober, options.engine)
+            del pending[distorded]
+            if planned is None:
+                failed += 1
+                continue
+            jobs += planned
+        prober.shutdown()
+    if options.segments > 1 and not options.batch:
+        prober = Prober(cache, command=options.ffmpeg)
+        for distorded, missing in list(pending.items()):
+            build, parser = stats_job(
+                options.engine, reference.width, reference.height, missing, (reference.pix_fmt, distorded.pix_fmt)
+            )
+            segmented = plan_segments(reference, distorded, missing, options.segments, prober, build)
+            if segmented is None:
+                continue
+            del pending[distorded]
+            for i, (args, first) in enumerate(segmented.args(reference.video_path, reference.fps)):
+                jobs.append((args, parser(), [segmented.parts[i]], missing, first, (segmented, i), None))
+        prober.shutdown()
+
+    # Videos missing the same metrics share their jobs
+    groups = {}
+    for distorded, missing in pending.items():
+        groups.setdefault(tuple(missing), []).append(distorded)
+    jobs += [
+        (args, parser, group, missing, 0, None, None)
+        for missing, group in groups.items()
+        for args, parser, group in plan_jobs(reference, group, missing, options.batch, options.engine)
+    ]
+    for distorded in vmaf_pending:
+        log_path = VMAF_LOG_PATH or os.path.join(
+            tempfile.gettempdir(), f"pyvqm-vmaf-{os.getpid()}-{renditions.index(distorded)}.csv"
+        )
+        args = build_vmaf_args(
+            distorded.video_path, reference.video_path, options=vmaf, log_path=log_path
+        )
+        parser = VmafParser(None if log_path == VMAF_LOG_PATH else log_path)
+        jobs.append((args, parser, [distorded], ["vmaf"], 0, None, None))
+
+    report = []  # (description, state, telemetry) of each job, for the run report
+
+    def job_done(i, telemetry, error):
+        nonlocal failed
+        group, missing, segment = jobs[i][2], jobs[i][3], jobs[i][5]
+        if segment is not None:
+            segmented, index = segment
+            group = [segmented.distorded]
+        paths = ", ".join(distorded.video_path for distorded in group)
+        description = f"{', '.join(missing)}: {paths}"
+        if segment is not None:
+            description += f" (segment {index + 1}/{len(segmented.segments)})"
+        if error is not None:
+            if not isinstance(error, JobError):
+                raise error
+            report.append((description, "failed", telemetry))
+            failed += 1
+            log.error(f"{', '.join(missing)} on {paths} failed: {error}")
+            if segment is not None:
+                segmented.failed = True
+            return
+        report.append((description, "finished", telemetry))
+        if segment is not None:
+            stitched = segmented.stitched
+            if segmented.failed or not segmented.finish(index):
+                failed += 0 if segmented.failed else 1
+                segmented.failed = True
+                return
+            write_stitched(writer, segmented, stitched)
+            if not segmented.done():
+                return
+        batch = isinstance(jobs[i][1], MetadataParser)
+        for distorded in group:
+            for metric in missing:
+                setattr(distorded, f"{metric}_computed", True)
+                if cache:
+                    series = getattr(distorded, metric)
+                    cache.put(key(distorded, metric, batch), series.frames, series.values)
+
+    # The governor gives each job a share of the cores, with the jobs running and waiting alongside it
+    runtime = Runtime(max_jobs=workers, governor=governor, command=options.ffmpeg)
+    asyncio.run(run_jobs(runtime, jobs, writer, job_done))
+
+    for distorded in renditions:
+        for metric in metrics:
+            if getattr(distorded, f"{metric}_computed"):
+                writer.summary(distorded, metric, summarize(getattr(distorded, metric), metric))
+
+    if output is not sys.stdout:
+        output.close()
+    if options.report:
+        write_report(options.report, run_report(report))
+    if options.project:
+        settings = {
+            "metrics": metrics,
+            "vmaf_options": vmaf,
+            "batch_mode": options.batch,
+            "segment_mode": options.segments > 1,
+            "engine": options.engine,
+            "sampling": None if sampling is None else str(sampling),
+        }
+        save_project(options.project, reference, renditions, settings)
+    log.info(f"Scored {len(renditions)} videos in {time.perf_counter() - start:.2f}s, {failed} jobs failed")
+    return 1 if failed else 0
+
+
+def worker(options):
+    path_map = []
+    for mapping in options.map:
+        prefix, separator, local_prefix = mapping.partition("=")
+        if not separator:
+            log.error(f"--map expects PREFIX=LOCAL_PREFIX, not {mapping}")
+            return 2
+        path_map.append((prefix, local_prefix))
+    farm_worker = Worker(
+        options.connect,
+        slots=options.jobs,
+        name=options.name,
+        command=options.ffmpeg,
+        token=FARM_TOKEN,
+        path_map=path_map,
+        stage=options.stage,
+    )
+    try:
+        asyncio.run(farm_worker.serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="pyvqm", description="Video quality metrics without a GUI")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    score_parser = commands.add_parser("score", help="Score distorted videos against a reference")
+    score_parser.add_argument("--ref", required=True, help="Reference video")
+    score_parser.add_argument("--dist", required=True, nargs="+", help="Distorted videos")
+    score_parser.add_argument("--metrics", default="ssim,psnr", help="Comma separated metrics (ssim, psnr, vmaf)")
+    score_parser.add_argument("--output", "-o", help="Output file, stdout by default")
+    score_parser.add_argument(
+        "--format", choices=sorted(WRITERS), help="Output format, from the output extension by default (jsonl)"
+    )
+    score_parser.add_argument("--jobs", "-j", type=int, help="Jobs run at the same time, the core count by default")
+    score_parser.add_argument(
+        "--batch", action="store_true", help="Score the distorted videos against a single decode of the reference"
+    )
+    score_parser.add_argument(
+        "--segments", type=int, default=1, help="Split each pair in this many time segments scored in parallel"
+    )
+    score_parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="ffmpeg",
+        help="Compute ssim and psnr with the ffmpeg filters, or with NumPy from the decoded frames",
+    )
+    score_parser.add_argument(
+        "--sample",
+        help="Preview: only score every:N frames, the keyframes, or windows:K[:seconds] of the whole title",
+    )
+    score_parser.add_argument(
+        "--threads-profile",
+        choices=PROFILES,
+        help="Give each job a share of the cores as its decode and filter threads (see governor.py): "
+        "a job per core (throughput), or fewer jobs with more threads (latency)",
+    )
+    score_parser.add_argument("--affinity", action="store_true", help="Pin each job to its share of the cores")
+    score_parser.add_argument("--nice", type=int, help="Nice level of the ffmpeg jobs")
+    score_parser.add_argument("--vmaf-threads", type=int, help="Threads of libvmaf, the core count by default")
+    score_parser.add_argument(
+        "--vmaf-subsample", type=int, help="Compute VMAF every N frames only, 1 (every frame) by default"
+    )
+    score_parser.add_argument("--vmaf-model", help="libvmaf model, version=vmaf_v0.6.1 by default")
+    score_parser.add_argument(
+        "--on-disk", action="store_true", help="Keep the per-frame values in memory-mapped files, for very long videos"
+    )
+    score_parser.add_argument("--report", help="JSON file of the telemetry of the jobs (see telemetry.py)")
+    score_parser.add_argument("--project", help=f"Project file ({EXTENSION}) of the scores, to open them in the GUI")
+    score_parser.add_argument("--no-cache", action="store_true", help="Don't read or store results in the cache")
+    score_parser.add_argument(
+        "--ffmpeg", default=os.environ.get("PYVQM_FFMPEG", "ffmpeg"), help="ffmpeg executable, $PYVQM_FFMPEG by default"
+    )
+    score_parser.set_defaults(func=score)
+
+    worker_parser = commands.add_parser("worker", help="Run the jobs of a GUI listening on PYVQM_FARM")
+    worker_parser.add_argument("--connect", required=True, help="Address of the GUI: host:port or unix:path")
+    worker_parser.add_argument("--jobs", "-j", type=int, help="Jobs run at the same time, the core count by default")
+    worker_parser.add_argument("--name", help="Name shown in the jobs panel, the host name by default")
+    worker_parser.add_argument(
+        "--map",
+        action="append",
+        default=[],
+        metavar="PREFIX=LOCAL_PREFIX",
+        help="Read the inputs under PREFIX on the GUI machine under LOCAL_PREFIX here, like a shared volume",
+    )
+    worker_parser.add_argument(
+        "--stage", help="Directory the inputs not found here are copied to from the GUI, and kept for the next jobs"
+    )
+    worker_parser.add_argument(
+        "--ffmpeg", default=os.environ.get("PYVQM_FFMPEG", "ffmpeg"), help="ffmpeg executable, $PYVQM_FFMPEG by default"
+    )
+    worker_parser.set_defaults(func=worker)
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level="INFO", format="%(message)s", stream=sys.stderr)
+    options = build_parser().parse_args(argv)
+    return options.func(options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,391 @@
+"""
+asyncio runtime of the ffmpeg jobs, usable without Qt.
+
+run_process() runs an ffmpeg command line with asyncio.create_subprocess_exec, streams its stdout
+through a parser of metrics_parser (or engine.FrameEngine) and its stderr through the progress
+parsers, and kills the process when it is cancelled or fails. The loop only reads the pipes:
+each job parses its stdout on a thread of its own, so a job parsing (or computing the metrics
+of engine.FrameEngine) doesn't hold the reads of the others. The raw frames of an engine job don't
+go through the loop: its thread reads them from the pipe straight into the buffer of the engine
+(see read_frames). On top of it:
+
+- Runtime runs jobs with a concurrency limit and the budgets of a governor.ThreadGovernor.
+  Runtime.run() returns the JobResult of a job, so scripts and services can await it:
+
+      runtime = Runtime(max_jobs=4)
+      results = await runtime.score(reference, renditions, ("ssim", "psnr"))
+
+- BackgroundLoop runs a loop on a thread of its own, for code that has no loop of its own:
+  the jobs of the GUI (processQueue.Job) run on background_loop(), so their output is read and
+  parsed off the Qt event loop.
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import FrameEngine, stats_job
+from filtergraph import build_batch_args, max_batch_size
+from metrics_parser import MetadataParser, simple_fps_parser, speed_parser, stream_fps_parser
+from sampling import source_frames
+from telemetry import JobTelemetry
+
+log = logging.getLogger("rich")
+
+# ffmpeg executable run by the jobs, PYVQM_FFMPEG can point to another build (or to benchmarks/fake_ffmpeg.py)
+FFMPEG_COMMAND = os.environ.get("PYVQM_FFMPEG", "ffmpeg")
+# Bytes read from stdout at once
+CHUNK_SIZE = 64 * 1024
+# Chunks of stdout a job reads while the previous ones are parsed
+PARSE_AHEAD = 4
+
+
+class JobError(Exception):
+    """An ffmpeg job failed."""
+
+
+class JobResult:
+    """
+    What a job reported: the exit code of its process (None until it exits), the last lines of
+    its stderr, the frame rate of its first input, the last fps of its progress, and its telemetry.
+    `worker` is the name of the worker of the farm that ran it (see farm.py), None when it ran here.
+    """
+
+    def __init__(self, telemetry=None):
+        self.returncode = None
+        self.stderr_tail = deque(maxlen=5)
+        self.input_fps = None
+        self.fps = 0.0
+        self.telemetry = telemetry if telemetry is not None else JobTelemetry()
+        self.worker = None
+
+    @property
+    def records(self):
+        return self.telemetry.records
+
+    @property
+    def error(self):
+        """Reason of the failure, None if the job succeeded."""
+        if self.returncode == 0:
+            return None
+        reason = self.stderr_tail[-1] if self.stderr_tail else ""
+        return f"Exited with code {self.returncode}: {reason}"
+
+
+def parse_chunk(parser, chunk, telemetry, flush=False):
+    """Batches of (metric, columns) parsed from a chunk of stdout, the parsing is timed in `telemetry`."""
+    start = time.perf_counter()
+    # The parser keeps the partial trailing line until the next chunk
+    batches = parser.feed(chunk)
+    if flush:
+        batches += parser.flush()
+    telemetry.parse_time += time.perf_counter() - start
+    telemetry.bytes_read += len(chunk)
+    return batches
+
+
+def source_batches(batches, frame_offset=0, frames=None):
+    """
+    Parsed batches with the frame numbers of the source: `frame_offset` is added to them for
+    a job that seeks its inputs, and a sampled job maps them to the frames it selected
+    (see sampling.source_frames). The batches left without frames are dropped.
+    """
+    kept = []
+    for metric, columns in batches:
+        if frame_offset:
+            columns["frame"] = columns["frame"] + frame_offset
+        if frames is not None:
+            source_frames(columns, frames)
+        if len(columns["frame"]):
+            kept.append((metric, columns))
+    return kept
+
+
+async def read_stderr(stream, result, progress=None):
+    """Reads the stderr of ffmpeg until it is closed, `progress` gets each fps it reports."""
+    while chunk := await stream.read(CHUNK_SIZE):
+        stderr = chunk.decode("utf8", errors="replace")
+        result.stderr_tail.extend(line for line in stderr.splitlines() if line.strip())
+        if result.input_fps is None:
+            result.input_fps = stream_fps_parser(stderr)
+        fps = simple_fps_parser(stderr)
+        speed = speed_parser(stderr)
+        if fps is not None or speed is not None:
+            result.telemetry.report_progress(fps, speed)
+        if fps is not None:
+            result.fps = fps
+            if progress is not None:
+                progress(fps)
+
+
+def read_frames(parser, stream, telemetry, put):
+    """
+    Reads the stdout of an engine job into the buffer of `parser` (an engine.FrameEngine) until
+    it is closed, on the thread of the job. `put` gets the batches of each computed batch of
+    frames, then None once the stream ends or the engine fails.
+    """
+    try:
+        with stream:
+            batches = []
+            while batches is not None:
+                compute_time, bytes_read = parser.compute_time, parser.bytes_read
+                batches = parser.readinto(stream)
+                # The frames left in the buffer once the stream ends
+                computed = parser.flush() if batches is None else batches
+                telemetry.parse_time += parser.compute_time - compute_time
+                telemetry.bytes_read += parser.bytes_read - bytes_read
+                if computed:
+                    put(computed)
+    finally:
+        put(None)
+
+
+async def run_process(command, args, parser, post, result, progress=None):
+    """
+    Runs ffmpeg with `args` until it exits, and returns its exit code, also set in `result`.
+    The chunks of stdout go through `parser` on a thread of the job, so the loop only reads the
+    pipes of the jobs, and the batches it returns go to `post`, in order, on the loop. `post` can be
+    a coroutine function: stdout is not read while it is awaited, so a slow consumer holds ffmpeg.
+    stderr fills `result` (a JobResult), see read_stderr. `command` is the ffmpeg executable,
+    or the command line before its arguments, like ["nice", "-n", "10", "ffmpeg"].
+    Raises OSError if the process can't be started. The process is killed when the coroutine
+    is cancelled or fails, like when the parser raises.
+    """
+    loop = asyncio.get_running_loop()
+    telemetry = result.telemetry
+    if telemetry.started_at is None:
+        telemetry.started()
+    # The stdout of an engine job is a pipe of its own, read by its thread (see read_frames)
+    frames_pipe = os.pipe() if isinstance(parser, FrameEngine) else None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *([command] if isinstance(command, str) else command),
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=frames_pipe[1] if frames_pipe else asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except BaseException:
+        if frames_pipe:
+            os.close(frames_pipe[0])
+        raise
+    finally:
+        if frames_pipe:
+            os.close(frames_pipe[1])
+    telemetry.spawned(process.pid)
+    stderr_task = asyncio.create_task(read_stderr(process.stderr, result, progress))
+    # A single thread, the parser gets the chunks in order
+    parse_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pyvqm-parse")
+    parsing = deque()  # Futures of the batches of the chunks being parsed
+    reader = None  # Future of read_frames
+    if frames_pipe:
+        computed = asyncio.Queue()
+        # The thread waits while PARSE_AHEAD computed batches are not posted, until the job is aborted
+        slots = threading.Semaphore(PARSE_AHEAD)
+        aborted = threading.Event()
+
+        def put(batches):
+            if batches is not None and not aborted.is_set():
+                slots.acquire()
+            loop.call_soon_threadsafe(computed.put_nowait, batches)
+
+        stream = open(frames_pipe[0], "rb", buffering=0)
+        reader = loop.run_in_executor(parse_thread, read_frames, parser, stream, telemetry, put)
+
+    async def deliver(batches):
+        if inspect.iscoroutinefunction(post):
+            await post(batches)
+        else:
+            post(batches)
+
+    async def post_parsed(ahead):
+        # Posts the chunks parsed so far, and waits for the oldest ones beyond `ahead`
+        while parsing and (len(parsing) > ahead or parsing[0].done()):
+            await deliver(await parsing.popleft())
+
+    try:
+        if reader is not None:
+            while (batches := await computed.get()) is not None:
+                await deliver(batches)
+                slots.release()
+            await reader
+        else:
+            while chunk := await process.stdout.read(CHUNK_SIZE):
+                parsing.append(loop.run_in_executor(parse_thread, parse_chunk, parser, chunk, telemetry))
+                await post_parsed(PARSE_AHEAD)
+            # The line or record being read
+            parsing.append(loop.run_in_executor(parse_thread, parse_chunk, parser, b"", telemetry, True))
+            await post_parsed(0)
+        await stderr_task
+        result.returncode = await process.wait()
+    except BaseException:
+        # Cancelled, or the parser failed: nothing reads the pipes anymore
+        if process.returncode is None:
+            process.kill()
+        stderr_task.cancel()
+        result.returncode = await asyncio.shield(process.wait())
+        if reader is not None:
+            # The pipe is closed with the process, the thread reading it ends and closes it
+            aborted.set()
+            slots.release()
+            await asyncio.shield(asyncio.wait([reader]))
+        raise
+    finally:
+        parse_thread.shutdown(wait=False, cancel_futures=True)
+        telemetry.finished()
+    return result.returncode
+
+
+def plan_jobs(reference, renditions, metrics, batch, engine="ffmpeg"):
+    """
+    List of (args, parser, renditions) to run: one job per distorded video,
+    or batches sharing a decode of the reference with `batch` and the ffmpeg filters.
+    """
+    if batch and engine == "ffmpeg" and len(renditions) > 1:
+        size = max_batch_size(reference.width, reference.height)
+        return [
+            (
+                build_batch_args(
+                    reference.video_path,
+                    [distorded.video_path for distorded in renditions[start : start + size]],
+                    list(metrics),
+                ),
+                MetadataParser(),
+                renditions[start : start + size],
+            )
+            for start in range(0, len(renditions), size)
+        ]
+    jobs = []
+    for distorded in renditions:
+        pix_fmts = (reference.pix_fmt, distorded.pix_fmt)
+        build, parser = stats_job(engine, reference.width, reference.height, metrics, pix_fmts)
+        jobs.append((build(distorded.video_path, reference.video_path, list(metrics)), parser(), [distorded]))
+    return jobs
+
+
+class Runtime:
+    """
+    Runs ffmpeg jobs on the running asyncio loop, at most `max_jobs` at the same time.
+    `max_jobs` defaults to the number of cores, or to the jobs of the profile of `governor`:
+    a governor.ThreadGovernor gives each job its thread budget when it starts.
+    """
+
+    def __init__(self, max_jobs=None, governor=None, command=None):
+        self.governor = governor
+        self.max_jobs = max_jobs or (governor.max_jobs if governor else os.cpu_count() or 1)
+        self.command = command or FFMPEG_COMMAND
+        self.slots = asyncio.Semaphore(self.max_jobs)
+        self.waiting = 0  # Jobs waiting for a slot
+        self.running = 0
+
+    async def run(
+        self, args, parser, renditions=(), frame_offset=0, frames=None, on_batches=None, progress=None, telemetry=None
+    ):
+        """
+        Runs a job once a slot is free, and returns its JobResult. The parsed values are stored in
+        the Distorded `renditions` (several of them when the columns hold a "rendition" index),
+        or given to `on_batches` instead. `frame_offset` and `frames` map the frame numbers to the
+        source, see source_batches. Raises JobError if ffmpeg fails, cancelling the job kills it.
+        """
+        result = JobResult(telemetry)
+        result.telemetry.queued()
+        renditions = list(renditions)
+
+        def post(batches):
+            batches = source_batches(batches, frame_offset, frames)
+            result.telemetry.records += sum(len(columns["frame"]) for _, columns in batches)
+            if on_batches is not None:
+                start = time.perf_counter()
+                on_batches(batches)
+                # Storing and writing the values is the part the GUI does in its slots
+                result.telemetry.ui_time += time.perf_counter() - start
+                return
+            for metric, columns in batches:
+                renditions[columns.get("rendition", 0)].extend(metric, columns)
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        command, budget = self.command, None
+        try:
+            if self.governor is not None:
+                # The jobs waiting for a slot run alongside this one
+                budget = self.governor.acquire(self.running + self.waiting)
+                command, args = self.governor.apply(budget, command, list(args))
+            try:
+                await run_process(command, args, parser, post, result, progress)
+            except OSError as e:
+                raise JobError(f"Failed to start {self.command}: {e}") from e
+        finally:
+            if budget is not None:
+                self.governor.release(budget)
+            self.running -= 1
+            self.slots.release()
+        if result.returncode:
+            raise JobError(result.error)
+        return result
+
+    def submit(self, args, parser, renditions=(), **kwargs):
+        """Task of run(), on the running loop."""
+        return asyncio.ensure_future(self.run(args, parser, renditions, **kwargs))
+
+    async def score(self, reference, renditions, metrics=("ssim", "psnr"), batch=False, engine="ffmpeg"):
+        """
+        Scores ssim and psnr of `renditions` against `reference`, see plan_jobs. A batch needs the
+        resolution of the reference, see probe.probe. Returns the result of each job, in the order of
+        plan_jobs: a JobResult, or the JobError of a failed job. The metrics of the videos of the jobs
+        that succeeded are marked computed.
+        """
+        unknown = [metric for metric in metrics if metric not in ("ssim", "psnr")]
+        if unknown:
+            raise ValueError(f"The runtime scores ssim and psnr, not {', '.join(unknown)}")
+        jobs = plan_jobs(reference, list(renditions), list(metrics), batch, engine)
+        results = await asyncio.gather(
+            *(self.run(args, parser, group) for args, parser, group in jobs), return_exceptions=True
+        )
+        for (_, _, group), result in zip(jobs, results):
+            if isinstance(result, BaseException) and not isinstance(result, JobError):
+                raise result
+            if isinstance(result, JobResult):
+                for distorded in group:
+                    for metric in metrics:
+                        setattr(distorded, f"{metric}_computed", True)
+        return results
+
+
+class BackgroundLoop:
+    """An asyncio loop running on a thread of its own, submit() runs a coroutine on it from any thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="pyvqm-runtime", daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine):
+        """Schedules a coroutine on the loop, returns its concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def background_loop():
+    """BackgroundLoop shared by the jobs of the process, started on the first call."""
+    global _background
+    with _background_lock:
+        if _background is None:
+            _background = BackgroundLoop()
+        return _background
@@ -0,0 +1,164 @@
+"""
+Preview sampling: score only some frames of each pair, for a quick quality estimate of a whole catalogue.
+
+The samples are spread over the whole title, not only over the first DURATION seconds:
+
+- "every": every Nth frame, kept by the same select filter on both inputs.
+- "keyframes": the keyframes of the distorded video. Its decoder skips the other frames
+  (-skip_frame nokey), and the reference keeps the frames with the same numbers: they are not
+  its own keyframes, so its select expression lists them (see select_expression).
+- "windows": K windows of a few seconds, evenly spaced. Each window is a segment of its own
+  (see segments.SegmentedScore) whose job seeks both inputs, so nothing between them is decoded.
+
+ffmpeg numbers the frames it scores from 1 whatever their place in the source: a sampled job
+maps them back to the frames it selected (see source_frames), so the values keep the frame
+numbers of the source.
+"""
+
+import logging
+
+import numpy as np
+
+log = logging.getLogger("rich")
+
+STRATEGIES = ("every", "keyframes", "windows")
+
+# Default settings of the strategies
+STEP = 10
+WINDOWS = 10
+WINDOW_SECONDS = 2.0
+
+
+def progressions(frames):
+    """
+    Splits sorted frame numbers in runs of a constant step, as (first, last, step) tuples.
+    The keyframes of a fixed GOP are a single run, a scene cut starts a new one.
+    """
+    runs = []
+    i = 0
+    while i < len(frames):
+        if i + 1 == len(frames):
+            runs.append((int(frames[i]), int(frames[i]), 1))
+            break
+        step = frames[i + 1] - frames[i]
+        j = i + 1
+        while j + 1 < len(frames) and frames[j + 1] - frames[j] == step:
+            j += 1
+        runs.append((int(frames[i]), int(frames[j]), int(step)))
+        i = j + 1
+    return runs
+
+
+def select_expression(frames):
+    """
+    select expression keeping the frames numbered `frames` (from 0, sorted). Each run of a constant
+    step is a single term, and the terms are the leaves of a binary search on n, so ffmpeg evaluates
+    a few of them for each frame instead of one per keyframe.
+    """
+    terms = []
+    for first, last, step in progressions(np.asarray(frames)):
+        if first == last:
+            terms.append((first, f"eq(n,{first})"))
+        elif step == 1:
+            terms.append((first, f"between(n,{first},{last})"))
+        else:
+            terms.append((first, f"between(n,{first},{last})*not(mod(n-{first},{step}))"))
+
+    def search(terms):
+        if len(terms) == 1:
+            return terms[0][1]
+        middle = len(terms) // 2
+        return f"if(lt(n,{terms[middle][0]}),{search(terms[:middle])},{search(terms[middle:])})"
+
+    return search(terms)
+
+
+def source_frames(columns, frames):
+    """
+    Replaces the frame numbers of parsed columns by the ones of the source, in place.
+    `frames` are the numbers (from 1) of the frames a sampled job selected: the parsed
+    frame n is the source frame frames[n - 1]. Frames beyond them are dropped.
+    """
+    numbers = columns["frame"]
+    keep = numbers <= len(frames)
+    if not keep.all():
+        log.error(f"Dropped {np.count_nonzero(~keep)} frames parsed beyond the {len(frames)} sampled ones")
+        for name, column in columns.items():
+            if isinstance(column, np.ndarray):
+                columns[name] = column[keep]
+        numbers = numbers[keep]
+    columns["frame"] = frames[numbers - 1]
+
+
+class Sampling:
+    """
+    A sampling strategy of STRATEGIES, `step` is the interval of "every",
+    `windows` the number of windows of "windows" and `window_seconds` their length.
+    """
+
+    def __init__(self, strategy, step=STEP, windows=WINDOWS, window_seconds=WINDOW_SECONDS):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown sampling {strategy}, expected one of {', '.join(STRATEGIES)}")
+        if step < 1 or windows < 1 or window_seconds <= 0:
+            raise ValueError("The step, the number of windows and their length must be positive")
+        self.strategy = strategy
+        self.step = step
+        self.windows = windows
+        self.window_seconds = window_seconds
+
+    @classmethod
+    def parse(cls, text):
+        """Sampling from its description: "every:N", "keyframes" or "windows:K[:seconds]"."""
+        strategy, *settings = text.strip().split(":")
+        try:
+            if strategy == "every" and len(settings) <= 1:
+                return cls(strategy, step=int(settings[0]) if settings else STEP)
+            if strategy == "keyframes" and not settings:
+                return cls(strategy)
+            if strategy == "windows" and len(settings) <= 2:
+                return cls(
+                    strategy,
+                    windows=int(settings[0]) if settings else WINDOWS,
+                    window_seconds=float(settings[1]) if len(settings) > 1 else WINDOW_SECONDS,
+                )
+        except ValueError:
+            pass
+        raise ValueError(f"Invalid sampling {text!r}, expected every:N, keyframes or windows:K[:seconds]")
+
+    def __str__(self):
+        if self.strategy == "every":
+            return f"every:{self.step}"
+        if self.strategy == "windows":
+            return f"windows:{self.windows}:{self.window_seconds:g}"
+        return self.strategy
+
+    def frames(self, frame_count, keyframes=()):
+        """Numbers (from 0) of the frames scored by the job of an "every" or "keyframes" sampling."""
+        if self.strategy == "every":
+            return np.arange(0, frame_count, self.step)
+        return np.array(sorted(frame for frame in set(keyframes) if 0 <= frame < frame_count), dtype=np.int64)
+
+    def job_args(self, frames, fps):
+        """
+        Options of the job scoring `frames` (see frames()) for filtergraph.build_metrics_args:
+        the select expressions, the decoder options of the distorded video, and the duration read,
+        so nothing is decoded after the last sampled frame.
+        """
+        if self.strategy == "every":
+            expression = f"not(mod(n,{self.step}))"
+            select, options = (expression, expression), ()
+        else:
+            # The distorded decoder only outputs its keyframes, they are the frames to score
+            select, options = (None, select_expression(frames)), ("-skip_frame", "nokey")
+        return {"select": select, "distorded_options": options, "duration": f"{(frames[-1] + 0.5) / fps:.6f}"}
+
+    def segments(self, frame_count, fps):
+        """Windows of a "windows" sampling as segments (first frame, number of frames), frames numbered from 0."""
+        length = max(1, round(self.window_seconds * fps))
+        if length * self.windows >= frame_count:
+            return [(0, frame_count)]
+        # Each window is centered in its share of the title
+        return [
+            (round((i + 0.5) * frame_count / self.windows - length / 2), length)
+            for i in range(self.windows)
+        ]
@@ -0,0 +1,120 @@
+"""
+Scoring of a single pair in time segments, so a long video uses every core.
+
+Each segment is scored by its own ffmpeg job, which seeks both inputs to its first frame.
+Jobs store their values in a part (a Distorded of their own), and the parts are stitched
+back into the distorded video in order, with their global frame numbers.
+"""
+
+import logging
+
+import numpy as np
+
+from filtergraph import build_metrics_args, seek_time, split_segments
+from video import Distorded
+
+log = logging.getLogger("rich")
+
+
+class SegmentedScore:
+    """
+    Segments of a pair: `segments` is a list of (first frame, number of frames), frames numbered from 0.
+
+    Metrics using the neighbour frames (the motion of VMAF) need `overlap`: the number of frames
+    read before and after each segment, whose values are dropped. `step` is the interval between
+    the scored frames when the metric subsamples them. `build` returns the ffmpeg arguments of a
+    segment, like filtergraph.build_metrics_args, and is given `options`.
+    The segments cover the whole video, and the last one reads until its end, unless `to_end`
+    is False: then they are windows of it (see sampling.py) and every job stops after its segment.
+    """
+
+    def __init__(
+        self, distorded, metrics, segments, overlap=(0, 0), step=1, build=build_metrics_args, options=None, to_end=True
+    ):
+        self.distorded = distorded
+        self.metrics = list(metrics)
+        self.segments = list(segments)
+        self.overlap = overlap
+        self.step = step
+        self.build = build
+        self.options = options or {}
+        self.to_end = to_end
+        # Parts store their values like the distorded video, in memory or on disk
+        self.parts = [Distorded(distorded.video_path, type(distorded.ssim)) for _ in self.segments]
+        self.finished = [False] * len(self.segments)
+        self.stitched = 0  # Segments already copied into the distorded video
+        self.failed = False
+
+    @classmethod
+    def split(cls, distorded, metrics, frame_count, count, keyframes=(), **kwargs):
+        """Splits the `frame_count` frames of a pair in `count` segments starting on keyframes."""
+        segments = split_segments(frame_count, count, keyframes, kwargs.get("step", 1))
+        return cls(distorded, metrics, segments, **kwargs)
+
+    def args(self, reference_path, fps):
+        """ffmpeg arguments of each segment, with the frame offset of its job."""
+        before, after = self.overlap
+        jobs = []
+        for i, (first, count) in enumerate(self.segments):
+            start = max(first - before, 0)
+            # The last segment reads until the end, in case the frame count is an estimate
+            length = (first + count + after - start) / fps if i < len(self.segments) - 1 or not self.to_end else None
+            args = self.build(
+                self.distorded.video_path,
+                reference_path,
+                self.metrics,
+                start=seek_time(start, fps),
+                length=length,
+                **self.options,
+            )
+            jobs.append((args, start))
+        return jobs
+
+    def values(self, i, metric):
+        """Frames and values of segment `i`, without the frames read for the overlap."""
+        first, count = self.segments[i]
+        series = getattr(self.parts[i], metric)
+        frames = series.frames
+        keep = frames > first
+        if i < len(self.segments) - 1 or not self.to_end:
+            keep &= frames <= first + count
+        return frames[keep], series.values[:, keep]
+
+    def check(self, i):
+        """True if segment `i` holds every frame it should, numbered from its first frame."""
+        first, count = self.segments[i]
+        last = i == len(self.segments) - 1
+        for metric in self.metrics:
+            frames, _ = self.values(i, metric)
+            expected = np.arange(first + 1, first + count + 1)
+            expected = expected[(expected - 1) % self.step == 0]
+            if last:
+                # The frame count of the last segment may be an estimate
+                expected = np.arange(len(frames)) * self.step + (expected[0] if len(expected) else first + 1)
+            if not np.array_equal(frames, expected):
+                log.error(
+                    f"Segment {i} of {self.distorded.video_path} has {len(frames)} {metric} frames, "
+                    f"{len(expected)} expected from frame {first + 1}"
+                )
+                return False
+        return True
+
+    def finish(self, i):
+        """
+        Marks segment `i` as finished, and stitches the finished segments that follow the
+        ones already stitched. Returns False if the segment is incomplete.
+        """
+        if not self.check(i):
+            self.failed = True
+            return False
+        self.finished[i] = True
+        while self.stitched < len(self.parts) and self.finished[self.stitched]:
+            for metric in self.metrics:
+                frames, values = self.values(self.stitched, metric)
+                getattr(self.distorded, metric).extend(frames, values)
+            self.parts[self.stitched] = None  # Its values are in the distorded video now
+            self.stitched += 1
+        return True
+
+    def done(self):
+        return self.stitched == len(self.parts)
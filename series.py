@@ -0,0 +1,208 @@
+import mmap
+import tempfile
+
+import numpy as np
+
+from pyramid import Pyramid
+from stats import Summary
+
+# Components stored for each metric, in the order of the value columns
+COMPONENTS = ("Y", "U", "V", "All")
+
+
+class Series:
+    """
+    Per-frame values of a metric, stored in NumPy buffers: one column for the frame numbers,
+    and one for each component (Y, U, V, All).
+    Buffers double their capacity when full, so appends are amortized O(1).
+    The properties return views on the buffers, they are not copied.
+    """
+
+    __slots__ = ("_frames", "_values", "_size", "_pyramids", "_summaries")
+
+    def __init__(self, capacity: int = 1024):
+        self._frames = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty((len(COMPONENTS), capacity), dtype=np.float32)
+        self._size = 0
+        self._pyramids = {}
+        self._summaries = {}
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, count: int):
+        """Makes sure `count` more frames fit in the buffers."""
+        needed = self._size + count
+        capacity = len(self._frames)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        frames = np.empty(capacity, dtype=self._frames.dtype)
+        frames[: self._size] = self._frames[: self._size]
+        values = np.empty((len(COMPONENTS), capacity), dtype=self._values.dtype)
+        values[:, : self._size] = self._values[:, : self._size]
+        self._frames, self._values = frames, values
+
+    def append(self, frame: int, values: dict):
+        """Appends a frame, `values` holds a value for each component."""
+        self._reserve(1)
+        self._frames[self._size] = frame
+        for i, component in enumerate(COMPONENTS):
+            self._values[i, self._size] = values[component]
+        self._size += 1
+
+    def extend(self, frames, values):
+        """
+        Appends several frames at once.
+        `values` is a 2D array with one row per component, or a dict of arrays by component.
+        """
+        count = len(frames)
+        self._reserve(count)
+        end = self._size + count
+        self._frames[self._size : end] = frames
+        for i, component in enumerate(COMPONENTS):
+            column = values[component] if isinstance(values, dict) else values[i]
+            self._values[i, self._size : end] = column
+        self._size = end
+
+    def clear(self):
+        self.truncate(0)
+
+    def truncate(self, size: int):
+        """Keeps the first `size` frames."""
+        self._size = min(self._size, max(0, size))
+        for index in (*self._pyramids.values(), *self._summaries.values()):
+            index.truncate(self._size)
+
+    def pyramid(self, component: str = "All"):
+        """Level of detail index of a component (see pyramid.py), built on the first call."""
+        if component not in self._pyramids:
+            self._pyramids[component] = Pyramid()
+        return self._pyramids[component]
+
+    def summary(self, component: str = "All"):
+        """Summary of a component (see stats.py), updated with the frames added since the last call."""
+        if component not in self._summaries:
+            self._summaries[component] = Summary()
+        summary = self._summaries[component]
+        summary.update(self.column(component))
+        return summary
+
+    def envelope(self, first_frame, last_frame, pixels: int, component: str = "All"):
+        """
+        Points drawing the values of a component between two frames on `pixels` pixels,
+        see pyramid.Pyramid.envelope. The frames can be None for the start or the end of the series.
+        """
+        frames = self.frames
+        # One more frame on each side, so the line goes to the edges of the range
+        first = 0 if first_frame is None else max(np.searchsorted(frames, first_frame) - 1, 0)
+        last = len(frames) if last_frame is None else np.searchsorted(frames, last_frame, side="right") + 1
+        return self.pyramid(component).envelope(frames, self.column(component), first, last, pixels)
+
+    @property
+    def frames(self):
+        return self._frames[: self._size]
+
+    def column(self, component: str = "All"):
+        """Values of a component."""
+        return self._values[COMPONENTS.index(component), : self._size]
+
+    @property
+    def values(self):
+        """Values of all the components, one row per component."""
+        return self._values[:, : self._size]
+
+
+# Frames a MappedSeries reserves at once, its files grow by this many frames
+MAPPED_CAPACITY = 1 << 16
+# Bytes written to a MappedSeries before they are written back to its files
+FLUSH_BYTES = 16 * 1024**2
+
+
+class MappedSeries(Series):
+    """
+    Series stored in memory-mapped files, for videos too long to keep their values in memory.
+    Frames and values are appended to two anonymous temporary files in `directory`
+    (one int64 frame per row, and one row of float32 values per frame), which are deleted
+    once the series is. Every FLUSH_BYTES, the written pages are flushed and released from the
+    process (MADV_DONTNEED): only the page being written stays resident, the others are read
+    back from the files when they are used.
+    The properties return read-only views on the mappings.
+    """
+
+    __slots__ = ("_frames_file", "_values_file", "_maps", "_unflushed")
+
+    def __init__(self, capacity: int = MAPPED_CAPACITY, directory: str = None):
+        self._frames_file = tempfile.TemporaryFile(prefix="pyvqm-frames-", dir=directory)
+        self._values_file = tempfile.TemporaryFile(prefix="pyvqm-values-", dir=directory)
+        self._size = 0
+        self._pyramids = {}
+        self._summaries = {}
+        self._unflushed = 0
+        self._map(capacity)
+
+    def _map(self, capacity: int):
+        """Grows the files to `capacity` frames, and maps them."""
+        self._frames_file.truncate(capacity * 8)
+        self._values_file.truncate(capacity * len(COMPONENTS) * 4)
+        self._maps = [mmap.mmap(file.fileno(), 0) for file in (self._frames_file, self._values_file)]
+        self._frames = np.ndarray((capacity,), dtype=np.int64, buffer=self._maps[0])
+        self._values = np.ndarray((capacity, len(COMPONENTS)), dtype=np.float32, buffer=self._maps[1])
+
+    def _reserve(self, count: int):
+        needed = self._size + count
+        capacity = len(self._frames)
+        if needed <= capacity:
+            return
+        # The views already returned keep the previous mappings, which stay valid
+        self.flush()
+        self._map(max(capacity + MAPPED_CAPACITY, needed))
+
+    def _written(self, count: int):
+        self._size += count
+        self._unflushed += count * (8 + len(COMPONENTS) * 4)
+        if self._unflushed >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Writes the values back to the files, and releases the written pages but the last one."""
+        for mapping, row_size in zip(self._maps, (8, len(COMPONENTS) * 4)):
+            mapping.flush()
+            # The pages are clean once flushed, dropping them loses nothing
+            length = self._size * row_size // mmap.PAGESIZE * mmap.PAGESIZE
+            if length and hasattr(mmap, "MADV_DONTNEED"):
+                mapping.madvise(mmap.MADV_DONTNEED, 0, length)
+        self._unflushed = 0
+
+    def append(self, frame: int, values: dict):
+        self._reserve(1)
+        self._frames[self._size] = frame
+        self._values[self._size] = [values[component] for component in COMPONENTS]
+        self._written(1)
+
+    def extend(self, frames, values):
+        count = len(frames)
+        self._reserve(count)
+        end = self._size + count
+        self._frames[self._size : end] = frames
+        for i, component in enumerate(COMPONENTS):
+            column = values[component] if isinstance(values, dict) else values[i]
+            self._values[self._size : end, i] = column
+        self._written(count)
+
+    def _view(self, array):
+        view = array.view(np.ndarray)
+        view.flags.writeable = False
+        return view
+
+    @property
+    def frames(self):
+        return self._view(self._frames[: self._size])
+
+    def column(self, component: str = "All"):
+        return self._view(self._values[: self._size, COMPONENTS.index(component)])
+
+    @property
+    def values(self):
+        return self._view(self._values[: self._size].T)
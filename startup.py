@@ -0,0 +1,55 @@
+"""
+Startup timing of the GUI: app.py marks the end of each phase of its start (QApplication,
+imports, main window), and finish() reports them once the event loop shows the first window.
+
+Heavy modules are only imported when they are needed: pyqtgraph with the plot window
+(see modelview.MainWindowList.plotWindow) and rich with the first log record
+(see modelview.DeferredRichHandler). The report lists the ones startup didn't import.
+
+PYVQM_STARTUP_REPORT is the path of a JSON file the report is also written to.
+"""
+
+import logging
+import os
+import sys
+import time
+
+from telemetry import write_report
+
+log = logging.getLogger("rich")
+
+# Modules startup should not import, see the docstring
+DEFERRED_MODULES = ("pyqtgraph", "rich")
+
+
+class Startup:
+    """Phases of the start of the GUI, timed from the creation of the Startup."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = []  # (name, seconds)
+
+    def mark(self, name):
+        """Ends the phase `name`, the next one starts now."""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        return {
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases},
+            "total": round(self.last - self.started, 4),
+            "deferred": [module for module in DEFERRED_MODULES if module not in sys.modules],
+        }
+
+    def finish(self, name="first window"):
+        """Ends the last phase, and reports the startup."""
+        self.mark(name)
+        report = self.report()
+        phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in report["phases"].items())
+        log.info(f"Started in {report['total'] * 1000:.0f} ms: {phases}")
+        path = os.environ.get("PYVQM_STARTUP_REPORT")
+        if path:
+            write_report(path, report)
+        return report
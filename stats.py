@@ -0,0 +1,188 @@
+"""
+Streaming summary of a series: mean, min, max, harmonic mean and low percentiles, the numbers
+quality decisions are made on.
+
+A summary is updated incrementally, like the pyramid of its series: only the values added since
+the last update are read, so the series is never scanned again. Its memory doesn't grow with the
+number of frames, the percentiles come from a t-digest of about COMPRESSION centroids.
+"""
+
+import numpy as np
+
+# Percentiles of a summary
+PERCENTILES = (1, 5, 50)
+# Statistics of a summary, see Summary.to_dict
+STATISTICS = ("mean", "min", "max", "harmonic_mean", *(f"p{p}" for p in PERCENTILES))
+# Centroids of the t-digest, the error on P1 stays well under the difference between two frames
+COMPRESSION = 200
+# Values read at once by an update, so a series on disk is never loaded whole
+UPDATE_VALUES = 1 << 20
+# Decimals shown for the values of each metric
+METRIC_DIGITS = {"ssim": 4, "psnr": 2, "vmaf": 2}
+# Metrics whose harmonic mean is computed on the values plus one, like the one of VMAF by Netflix,
+# so a zero score doesn't make it zero whatever the other frames
+HARMONIC_OFFSET_METRICS = ("vmaf",)
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning, "Computing extremely accurate quantiles using t-digests").
+    Values are added in batches: they are sorted with the centroids, and the points whose middle
+    falls in the same unit of the k1 scale function are merged, so centroids are small in the tails,
+    where the low percentiles are read, and large around the median.
+    """
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """Adds the values of an array, without NaN."""
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        means = np.concatenate((self.means, values))
+        weights = np.concatenate((self.weights, np.ones(len(values))))
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        # Unit of the k1 scale of the middle of each point
+        cumulative = np.cumsum(weights)
+        middle = (cumulative - weights / 2) / cumulative[-1]
+        k = np.floor(self.compression * (np.arcsin(2 * middle - 1) / np.pi + 0.5))
+        starts = np.flatnonzero(np.diff(k, prepend=-1))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        """Value below which the fraction `q` of the values are, NaN without values."""
+        if not len(self.weights):
+            return float("nan")
+        middles = np.cumsum(self.weights) - self.weights / 2
+        total = middles[-1] + self.weights[-1] / 2
+        # The min and the max bound the first and the last centroid
+        return float(
+            np.interp(q * total, np.r_[0, middles, total], np.r_[self.min, self.means, self.max])
+        )
+
+
+class Summary:
+    """
+    Streaming summary of a component of a series (see series.Series.summary).
+    `values` are the values of the component, the summary covers the first `size` of them.
+    The harmonic mean depends on the metric: VMAF offsets its values by one (see
+    HARMONIC_OFFSET_METRICS), the others take the plain one, only defined for positive values.
+    """
+
+    def __init__(self):
+        self.size = 0  # Values read
+        self.count = 0  # Values read that are not NaN
+        self.total = 0.0
+        self.inverses = 0.0  # Sum of 1 / value
+        self.offset_inverses = 0.0  # Sum of 1 / (value + 1)
+        self.min = np.inf
+        self.max = -np.inf
+        self.digest = TDigest()
+
+    def truncate(self, size: int):
+        """
+        Forgets the values after the first `size`. Values can't be removed from the summary,
+        it is computed again by the next update.
+        """
+        if size < self.size:
+            self.__init__()
+
+    def update(self, values):
+        """Reads the values added since the last update."""
+        count = len(values)
+        if count < self.size:
+            self.__init__()
+        for start in range(self.size, count, UPDATE_VALUES):
+            chunk = np.asarray(values[start : min(start + UPDATE_VALUES, count)], dtype=np.float64)
+            chunk = chunk[~np.isnan(chunk)]
+            if len(chunk):
+                self.count += len(chunk)
+                self.total += chunk.sum()
+                with np.errstate(divide="ignore"):
+                    self.inverses += (1 / chunk).sum()
+                self.offset_inverses += (1 / (chunk + 1)).sum()
+                self.min = min(self.min, float(chunk.min()))
+                self.max = max(self.max, float(chunk.max()))
+                self.digest.update(chunk)
+        self.size = count
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else float("nan")
+
+    def harmonic_mean(self, metric: str = None):
+        """Harmonic mean of the values of `metric`, NaN if it is not defined."""
+        if not self.count:
+            return float("nan")
+        if metric in HARMONIC_OFFSET_METRICS:
+            return self.count / self.offset_inverses - 1
+        return self.count / self.inverses if self.min > 0 else float("nan")
+
+    def percentile(self, p):
+        return self.digest.quantile(p / 100)
+
+    def to_dict(self, metric: str = None):
+        """Statistics by name of the values of `metric`: frames, mean, min, max, harmonic_mean and p1, p5, p50."""
+        summary = {
+            "frames": self.count,
+            "mean": self.mean,
+            "min": self.min if self.count else float("nan"),
+            "max": self.max if self.count else float("nan"),
+            "harmonic_mean": self.harmonic_mean(metric),
+        }
+        for p in PERCENTILES:
+            summary[f"p{p}"] = self.percentile(p)
+        return summary
+
+
+class StoredSummary:
+    """
+    Summary read back from its to_dict(), like the ones stored in a project (see project.py).
+    It describes values that are not loaded, so it can't be updated.
+    """
+
+    def __init__(self, statistics):
+        self.statistics = statistics
+        self.count = statistics["frames"]
+
+    @property
+    def mean(self):
+        return self.statistics["mean"]
+
+    def harmonic_mean(self, metric: str = None):
+        # Stored for the metric of the values
+        return self.statistics["harmonic_mean"]
+
+    @property
+    def min(self):
+        return self.statistics["min"]
+
+    @property
+    def max(self):
+        return self.statistics["max"]
+
+    def percentile(self, p):
+        return self.statistics[f"p{p}"]
+
+    def to_dict(self, metric: str = None):
+        return dict(self.statistics)
+
+
+def describe(summary: Summary, metric: str):
+    """One line description of the summary of a metric, empty without values."""
+    if not summary.count:
+        return ""
+    digits = METRIC_DIGITS[metric]
+    percentiles = " ".join(f"P{p} {summary.percentile(p):.{digits}f}" for p in PERCENTILES)
+    return (
+        f"mean {summary.mean:.{digits}f} hmean {summary.harmonic_mean(metric):.{digits}f} "
+        f"min {summary.min:.{digits}f} {percentiles}"
+    )
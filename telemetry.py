@@ -0,0 +1,161 @@
+"""
+Performance telemetry of the ffmpeg jobs, to tell whether a slow run is limited by the decode
+(ffmpeg), by the parsing of its output or by the GUI.
+
+Each job records when it was queued, spawned and finished, the fps and speed ffmpeg reports,
+the bytes and records it parsed, the time spent parsing them and in the slots storing and
+plotting them, and the peak memory of its process. run_report() gathers them in a JSON
+friendly run report.
+"""
+
+import json
+import os
+import time
+
+# Share of the run time a job spent parsing, or in the GUI, from which it is limited by it
+LIMITING_SHARE = 0.5
+
+
+def peak_rss(pid):
+    """Peak resident memory of a process in bytes (VmHWM), None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class JobTelemetry:
+    """
+    Telemetry of a job. Times are time.monotonic() values, durations are in seconds.
+    """
+
+    def __init__(self):
+        self.queued_at = None  # Added to the queue
+        self.started_at = None  # Process started
+        self.spawned_at = None  # Process running
+        self.finished_at = None
+        self.pid = None
+        self.progress = []  # (seconds since the start, fps, speed) reported by ffmpeg
+        self.bytes_read = 0
+        self.records = 0
+        self.parse_time = 0.0
+        self.ui_time = 0.0  # Time spent in the slots of the parsed values (storing and marking the plots)
+        self.peak_rss = None
+
+    def queued(self):
+        self.queued_at = time.monotonic()
+
+    def started(self):
+        self.started_at = time.monotonic()
+
+    def spawned(self, pid):
+        self.spawned_at = time.monotonic()
+        self.pid = pid
+        self.sample_rss()
+
+    def finished(self):
+        self.finished_at = time.monotonic()
+
+    def sample_rss(self):
+        """Updates the peak memory of the process, while it runs."""
+        if self.pid:
+            rss = peak_rss(self.pid)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def report_progress(self, fps=None, speed=None):
+        elapsed = time.monotonic() - (self.started_at or time.monotonic())
+        self.progress.append((round(elapsed, 3), fps, speed))
+        self.sample_rss()
+
+    @property
+    def queue_wait(self):
+        if self.queued_at is None or self.started_at is None:
+            return None
+        return self.started_at - self.queued_at
+
+    @property
+    def spawn_time(self):
+        if self.started_at is None or self.spawned_at is None:
+            return None
+        return self.spawned_at - self.started_at
+
+    @property
+    def duration(self):
+        """Run time of the process, up to now while it runs."""
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def fps(self):
+        """Last fps reported by ffmpeg."""
+        return next((fps for _, fps, _ in reversed(self.progress) if fps is not None), None)
+
+    @property
+    def speed(self):
+        return next((speed for _, _, speed in reversed(self.progress) if speed is not None), None)
+
+    def limited_by(self):
+        """What limited the job: "parsing", "gui" or "decode" (ffmpeg itself)."""
+        duration = self.duration
+        if not duration:
+            return None
+        if self.ui_time / duration >= LIMITING_SHARE:
+            return "gui"
+        if self.parse_time / duration >= LIMITING_SHARE:
+            return "parsing"
+        return "decode"
+
+    def to_dict(self):
+        duration = self.duration
+        return {
+            "queue_wait": self.queue_wait,
+            "spawn_time": self.spawn_time,
+            "duration": duration,
+            "fps": self.fps,
+            "speed": self.speed,
+            "progress": self.progress,
+            "bytes_read": self.bytes_read,
+            "records": self.records,
+            "records_per_s": self.records / duration if duration else None,
+            "parse_time": self.parse_time,
+            "ui_time": self.ui_time,
+            "peak_rss": self.peak_rss,
+            "limited_by": self.limited_by(),
+        }
+
+
+def run_report(jobs, **extra):
+    """
+    Report of a run: `jobs` is a list of (description, state, JobTelemetry),
+    `extra` adds fields, like the render time of the plots.
+    """
+    telemetries = [telemetry for _, _, telemetry in jobs]
+    starts = [t.queued_at or t.started_at for t in telemetries if (t.queued_at or t.started_at)]
+    ends = [t.finished_at for t in telemetries if t.finished_at]
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pid": os.getpid(),
+        "duration": max(ends) - min(starts) if starts and ends else None,
+        "jobs": [
+            {"job": description, "state": state, **telemetry.to_dict()}
+            for description, state, telemetry in jobs
+        ],
+        "totals": {
+            "bytes_read": sum(t.bytes_read for t in telemetries),
+            "records": sum(t.records for t in telemetries),
+            "parse_time": sum(t.parse_time for t in telemetries),
+            "ui_time": sum(t.ui_time for t in telemetries),
+        },
+        **extra,
+    }
+
+
+def write_report(path, report):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
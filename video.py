@@ -1,3 +1,6 @@
+from series import Series
+
+
 class Reference():
     def __init__(self, video_path):
         self.video_path = video_path
@@ -5,28 +8,96 @@ class Reference():
         self.fps = 0
         self.width = 0
         self.height = 0
+        self.pix_fmt = ""  # Pixel format of the video, empty if it is unknown
+        self.keyframes = []  # Numbers of the keyframes, from 0
+
+    def set_info(self, info):
+        """Sets the fields found by probe.probe()."""
+        for field in ("frame_count", "fps", "width", "height"):
+            setattr(self, field, info[field])
+        # Not in the projects saved by older versions
+        self.pix_fmt = info.get("pix_fmt", "")
 
 
 
 class Distorded():
-    def __init__(self, video_path):
+    def __init__(self, video_path, series=Series):
         self.video_path = video_path
         self.frame_count = 0
         self.fps = 0
         self.width = 0
         self.height = 0
-        self.frames = []
+        self.pix_fmt = ""  # Pixel format of the video, empty if it is unknown
         self.ssim_computed = False
         self.psnr_computed = False  
         self.vmaf_computed = False
-        self.ssim_values = []
-        self.psnr_values = []
-        self.vmaf_values = []
-
-    def reset_values(self):
-        self.ssim_values = []
-        self.psnr_values = []
-        self.vmaf_values = []
+        # Per-frame values of each metric, they can be computed by concurrent jobs.
+        # `series` makes their storage, series.MappedSeries keeps them on disk
+        self.ssim = series()
+        self.psnr = series()
+        self.vmaf = series()
+
+    def set_info(self, info):
+        """Sets the fields found by probe.probe()."""
+        for field in ("frame_count", "fps", "width", "height"):
+            setattr(self, field, info[field])
+        # Not in the projects saved by older versions
+        self.pix_fmt = info.get("pix_fmt", "")
+
+    def set_series(self, series):
+        """Moves the values of every metric to new series made by `series`."""
+        for metric in ("ssim", "psnr", "vmaf"):
+            current = getattr(self, metric)
+            moved = series()
+            moved.extend(current.frames, current.values)
+            setattr(self, metric, moved)
+
+    @property
+    def frames(self):
+        return self.ssim.frames if len(self.ssim) else self.psnr.frames
+
+    @property
+    def ssim_values(self):
+        return self.ssim.column("All")
+
+    @property
+    def psnr_values(self):
+        return self.psnr.column("All")
+
+    @property
+    def vmaf_values(self):
+        return self.vmaf.column("All")
+
+    def reset_values(self, metrics=("ssim", "psnr", "vmaf")):
+        for metric in metrics:
+            getattr(self, metric).clear()
+            setattr(self, f"{metric}_computed", False)
+
+    def resume_frame(self, metrics):
+        """
+        Number of frames of `metrics` kept from an interrupted run, a new run can start after them.
+        Frames are numbered from 1, the values must be there for every frame up to this one.
+        """
+        kept = []
+        for metric in metrics:
+            series = getattr(self, metric)
+            if len(series) and series.frames[-1] != len(series):
+                return 0
+            kept.append(len(series))
+        return min(kept, default=0)
+
+    def append(self, metric, values):
+        """Stores the values parsed for a frame, `values` holds the frame and its components."""
+        getattr(self, metric).append(values["frame"], values)
+
+    def extend(self, metric, columns):
+        """Stores the columns parsed for several frames at once."""
+        getattr(self, metric).extend(columns["frame"], columns)
+
+    def series(self, metric, component="All"):
+        """Returns views on the frames and values computed for a metric."""
+        series = getattr(self, metric)
+        return series.frames, series.column(component)
     
     
 